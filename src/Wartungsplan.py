@@ -31,16 +31,40 @@
 import argparse
 import datetime
 import sys
+import os
+import time
+import json
+import socket
+import itertools
+import hashlib
+import gzip
+import lzma
+import mmap
+import random
+import tempfile
+import csv
+import struct
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import threading
+import http.server
+import urllib.parse
 import logging
 import configparser
 import smtplib
 import re
 import warnings
 import importlib.metadata
+import email
+import email.policy
 from email.message import EmailMessage
 
 import dateutil.parser
+import dateutil.rrule
 import icalendar
+import requests
 # under active development, few issues, nothing major
 # https://github.com/niccokunzmann/python-recurring-ical-events
 import recurring_ical_events
@@ -50,15 +74,391 @@ try:
 except ModuleNotFoundError:
     pass
 
+try:
+    # icalendar < 6 resolves time zones with pytz
+    import pytz
+except ModuleNotFoundError:
+    pytz = None
+
 
 logger = logging.getLogger(__name__)
 
 
+class Spool:
+    """ Maildir like on-disk queue for prepared backend payloads.
+
+        Items are written to tmp/ and atomically renamed to new/. A drain
+        claims an item by renaming it to cur/ and removes it after delivery,
+        so several drain processes can work on the same spool. """
+    # claimed items older than this are considered left behind by a crashed
+    # drain and are put back into new/
+    stale_after = 3600
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._counter = itertools.count()
+        for subdir in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    def _path(self, subdir, name):
+        return os.path.join(self.directory, subdir, name)
+
+    def put(self, kind, data):
+        """ Atomically add one serialized payload for backend kind """
+        # time first so sorting by name keeps the order items were produced
+        name = f"{time.time():.6f}.{os.getpid()}_{next(self._counter)}." \
+               f"{socket.gethostname()}.{kind}"
+        with open(self._path("tmp", name), 'wb') as item:
+            item.write(data)
+            item.flush()
+            os.fsync(item.fileno())
+        os.rename(self._path("tmp", name), self._path("new", name))
+        logger.debug("Spooled %s", name)
+        return name
+
+    def pending(self):
+        """ Names of all items waiting for delivery, oldest first """
+        self._recover_stale()
+        return sorted(os.listdir(os.path.join(self.directory, "new")))
+
+    def claim(self, name):
+        """ Take an item for delivery. Returns its data or None if another
+            drain was faster. """
+        try:
+            # the age in cur/ counts from the claim, rename keeps the mtime
+            # of when the item was spooled
+            os.utime(self._path("new", name))
+            os.rename(self._path("new", name), self._path("cur", name))
+        except FileNotFoundError:
+            return None
+        with open(self._path("cur", name), 'rb') as item:
+            return item.read()
+
+    def done(self, name):
+        """ Remove a delivered item """
+        os.unlink(self._path("cur", name))
+
+    def release(self, name):
+        """ Give a claimed item back for a later drain """
+        os.rename(self._path("cur", name), self._path("new", name))
+
+    def _recover_stale(self):
+        now = time.time()
+        for name in os.listdir(os.path.join(self.directory, "cur")):
+            try:
+                if now - os.stat(self._path("cur", name)).st_mtime > self.stale_after:
+                    logger.warning("Recover stale spool item %s", name)
+                    self.release(name)
+            except FileNotFoundError:
+                pass
+
+
+class SpillQueue:
+    """ Prepared payloads of Backend.act, returned most urgent first. Up to
+        budget bytes of event text are kept in memory, further payloads are
+        serialized to a temporary file and read back one by one while they
+        are delivered. """
+    def __init__(self, backend, budget=None):
+        self.backend = backend
+        self.budget = budget
+        self.held = 0
+        self.spilled = 0
+        self.spilled_bytes = 0
+        # (urgency, number, payload or None, (offset, size) if spilled)
+        self._items = []
+        self._file = None
+
+    def append(self, urgency, action_data, size):
+        """ Add a payload built from size bytes of event text """
+        if (self.budget is None or self.held + size <= self.budget
+                or not self.backend.spool_kind):
+            self.held += size
+            self._items.append((urgency, len(self._items), action_data, None))
+            return
+        if self._file is None:
+            logger.info("Memory budget of %d bytes exceeded, spill payloads "
+                        "to disk", self.budget)
+            # deleted on close, TMPDIR should not be a tmpfs
+            self._file = tempfile.TemporaryFile(prefix="wartungsplan-")
+        data = self.backend._serialize(action_data) # pylint: disable=protected-access
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self._items.append((urgency, len(self._items), None,
+                            (offset, len(data))))
+        self.spilled += 1
+        self.spilled_bytes += len(data)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        """ The payloads, most urgent first. Delivered payloads are
+            released. """
+        self._items.sort(key=lambda item: item[:2])
+        for number, (_, _, action_data, spilled) in enumerate(self._items):
+            self._items[number] = None
+            if spilled:
+                self._file.seek(spilled[0])
+                action_data = self.backend._deserialize( # pylint: disable=protected-access
+                    self._file.read(spilled[1]))
+            yield action_data
+
+    def close(self):
+        """ Remove the temporary file """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, 0 where the
+        platform doesn't tell """
+    try:
+        # Unix only
+        import resource # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ConnectionPool:
+    """ Keeps one open connection per server and login, e.g. for profiles
+        running in parallel threads that send to the same SMTP server. Users
+        of the same connection take turns. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    @contextlib.contextmanager
+    def get(self, key, connect, close, check=None):
+        """ Use the connection for key. It is created with connect(), reused
+            if check(connection) is true and closed with close(connection)
+            when it breaks or the pool is closed. """
+        with self._lock:
+            entry = self._connections.setdefault(key, {"lock": threading.Lock(),
+                                                       "connection": None,
+                                                       "close": close})
+        with entry["lock"]:
+            if entry["connection"] is not None and check:
+                try:
+                    usable = check(entry["connection"])
+                except Exception: # pylint: disable=broad-exception-caught
+                    usable = False
+                if not usable:
+                    logger.debug("Connection %s is gone, reconnect", key[:2])
+                    self._close(entry)
+            if entry["connection"] is None:
+                entry["connection"] = connect()
+            try:
+                yield entry["connection"]
+            except Exception:
+                self._close(entry)
+                raise
+
+    def close(self):
+        """ Close all connections """
+        with self._lock:
+            for entry in self._connections.values():
+                with entry["lock"]:
+                    self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        connection, entry["connection"] = entry["connection"], None
+        if connection is not None:
+            try:
+                entry["close"](connection)
+            except Exception as err: # pylint: disable=broad-exception-caught
+                logger.debug("Error closing connection: %s", err)
+
+
+class Span:
+    """ One timed operation of a Tracer """
+    def __init__(self, name, attributes, parent, sampled):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.sampled = sampled
+        self.span_id = os.urandom(8).hex()
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, key, value):
+        """ Add an attribute """
+        self.attributes[key] = value
+
+    def duration(self):
+        """ Seconds the span took """
+        return (self.end - self.start) / 1e9
+
+
+class Tracer:
+    """ Optional tracing spans written as OpenTelemetry (OTLP/JSON) lines to
+        a file. Item spans (sample=True) are kept with probability sample,
+        their child spans follow that decision. Spans that take at least
+        slow seconds are always kept and listed in report(). Disabled
+        tracing costs one function call per span. """
+    batch = 1000
+    # spans listed in the slow item report
+    report_size = 20
+
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.sample = 1.0
+        self.slow = None
+        self.trace_id = None
+        self.spans = []
+        self.slow_spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def configure(self, path, sample=1.0, slow=1.0):
+        """ Start writing spans to path """
+        self.file = open(path, 'a', encoding='utf-8') # pylint: disable=consider-using-with
+        self.sample = sample
+        self.slow = slow
+        self.trace_id = os.urandom(16).hex()
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def _span(self, name, event, sample, attributes):
+        stack = self._local.__dict__.setdefault("stack", [])
+        parent = stack[-1] if stack else None
+        if sample or not parent:
+            sampled = self._random.random() < self.sample if sample else True
+        else:
+            sampled = parent.sampled
+        if event is not None:
+            attributes["uid"] = str(event.get("UID", ""))
+            attributes["summary"] = str(event.get("SUMMARY", ""))
+        span = Span(name, attributes, parent, sampled)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.error = repr(err)
+            raise
+        finally:
+            stack.pop()
+            span.end = time.time_ns()
+            self._finish(span)
+
+    def span(self, name, event=None, sample=False, **attributes):
+        """ Context manager timing name. UID and SUMMARY of event are added
+            as attributes. """
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, event, sample, attributes)
+
+    def _finish(self, span):
+        slow = self.slow is not None and span.duration() >= self.slow
+        if not (span.sampled or slow):
+            return
+        with self._lock:
+            if slow:
+                self.slow_spans.append(span)
+            self.spans.append(span)
+            if len(self.spans) >= self.batch:
+                self._write()
+
+    def _write(self):
+        """ Write the collected spans as one OTLP/JSON line """
+        if not self.spans:
+            return
+        spans = []
+        for span in self.spans:
+            data = {"traceId": self.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start),
+                    "endTimeUnixNano": str(span.end),
+                    "attributes": [{"key": key, "value": _otlp_value(value)}
+                                   for key, value in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error}
+                              if span.error else {"code": 1}}
+            if span.parent:
+                data["parentSpanId"] = span.parent.span_id
+            spans.append(data)
+        self.spans = []
+        self.file.write(json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": "Wartungsplan"}}]},
+            "scopeSpans": [{"scope": {"name": "Wartungsplan"}, "spans": spans}]}]}) + "\n")
+        self.file.flush()
+
+    def report(self, out=None):
+        """ Print the slowest spans """
+        out = out or sys.stderr
+        if not self.slow_spans:
+            return
+        out.write(f"{len(self.slow_spans)} slow items (>= {self.slow}s):\n")
+        for span in sorted(self.slow_spans, key=Span.duration,
+                           reverse=True)[:self.report_size]:
+            attributes = " ".join(f"{key}={value}"
+                                  for key, value in span.attributes.items())
+            out.write(f"{span.duration():9.3f}s {span.name} {attributes}\n")
+
+    def close(self):
+        """ Write the remaining spans and report the slow ones """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._write()
+            self.file.close()
+        self.report()
+        self.enabled = False
+        self.slow_spans = []
+
+
+def _otlp_value(value):
+    """ OTLP AnyValue of an attribute value """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_NO_SPAN = contextlib.nullcontext()
+tracer = Tracer()
+
+
 class Backend:
     """ Interface for Wartungsplan backends """
+    # name of spooled items of this backend, None if it can't be spooled
+    spool_kind = None
+    # perform the action for every event as soon as it is prepared instead
+    # of collecting all first. See Wartungsplan for "starts".
+    streaming = False
+
     def __init__(self, config, dry_run=False):
         self.config = config
         self.dry_run = dry_run
+        # if set, act() queues payloads here instead of performing the action
+        self.spool = None
+        # if not None, act() combines the events per value of this header
+        # ("" for one digest of all events)
+        self.digest = None
+        # time.monotonic() after which act() hands the remaining payloads to
+        # the next run by putting them into the overflow spool
+        self.deadline = None
+        self.overflow = None
+        # bytes of event text act() keeps prepared in memory, the payloads
+        # beyond are spilled to disk
+        self.memory_budget = None
+        # (payloads, bytes) spilled by the last act()
+        self.spilled = (0, 0)
+        # ConnectionPool shared with the backends of other profiles. Without
+        # one act() and drain() open their own and close it at their end.
+        self.connections = None
         logger.debug("Create backend %s", type(self).__name__)
 
     def act(self, events):
@@ -66,22 +466,212 @@ class Backend:
             implementation to apply headers and possibly prepare an action
             and finally perform the in subclass implemented action. """
         # e.g. for the email backend actions_data contains the msg objects
-        actions_data = []
+        actions_data = SpillQueue(self, self.memory_budget)
+        if self.digest is not None:
+            events = self._digests(events)
+        try:
+            with self._pool():
+                self._act(events, actions_data)
+        finally:
+            actions_data.close()
+            self.spilled = (actions_data.spilled, actions_data.spilled_bytes)
+        if self.memory_budget is not None:
+            logger.info("Peak RSS %.1f MiB, %d payloads (%d bytes) spilled to "
+                        "disk", peak_rss() / 2**20, *self.spilled)
+
+    def _act(self, events, actions_data):
+        """ Prepare the events and perform the action """
 
         for event in events:
-            # the DESCRIPTION only contains txt, no HTML
-            # HTML body is contained in
-            #  DESCRIPTION;ALTREP="data:text/html or
-            #  X-ALT-DESC:FMTTYPE=text/html
-            # see also
-            # https://www.rfc-editor.org/rfc/rfc5545#section-3.2.1
-            data = str(event.get("description", ""))
-
-            headers,text = self._split_message(data)
-            pre_action_object = self._prepare_event(headers, text, event)
-            actions_data.append(self._apply_headers(headers, event,
-                                                    pre_action_object))
-        self._perform_action(actions_data)
+            with tracer.span("occurrence", event, sample=True):
+                # the DESCRIPTION only contains txt, no HTML
+                # HTML body is contained in
+                #  DESCRIPTION;ALTREP="data:text/html or
+                #  X-ALT-DESC:FMTTYPE=text/html
+                # see also
+                # https://www.rfc-editor.org/rfc/rfc5545#section-3.2.1
+                data = str(event.get("description", ""))
+
+                with tracer.span("split_message", size=len(data)):
+                    headers,text = self._split_message(data)
+                urgency = self._urgency(headers, event)
+                with tracer.span("prepare_event"):
+                    pre_action_object = self._prepare_event(headers, text, event)
+                with tracer.span("apply_headers"):
+                    action_data = self._apply_headers(headers, event,
+                                                      pre_action_object)
+                if self.streaming:
+                    with tracer.span("perform_action"):
+                        self._perform_action([action_data])
+                else:
+                    actions_data.append(urgency, action_data, len(data))
+        if self.streaming:
+            return
+
+        # most urgent first
+        count = len(actions_data)
+        actions_data = iter(actions_data)
+        if self.spool:
+            self._enqueue(actions_data)
+        elif self.deadline is None:
+            self._perform_action(actions_data)
+        else:
+            for number, action_data in enumerate(actions_data):
+                if time.monotonic() >= self.deadline:
+                    if self.dry_run:
+                        logger.warning("Runtime budget exhausted, %d items "
+                                       "are not shown", count - number)
+                        break
+                    logger.warning("Runtime budget exhausted, %d items are "
+                                   "left for the next run", count - number)
+                    self._enqueue(itertools.chain([action_data], actions_data),
+                                  self.overflow)
+                    break
+                self._perform_action([action_data])
+
+    def _urgency(self, headers, event):
+        """ Sort key of an event: highest priority header first (like the
+            OTRS priorities "5 very high" to "1 very low"), then the
+            earliest start """
+        priority = headers.get("priority", None)
+        if priority is None and self.config and "headers" in self.config:
+            priority = self.config["headers"].get("priority", None)
+        match = re.match(r'\s*(\d+)', priority or "")
+        if "dtstart" not in event:
+            return (-int(match.group(1)) if match else 0, 1, None)
+        return (-int(match.group(1)) if match else 0, 0,
+                _as_datetime(event.decoded("dtstart")))
+
+    def _digests(self, events):
+        """ One event per value of the digest header combining the events
+            with that value. Headers all events of a group agree on are kept,
+            the body lists the events by start time. """
+        defaults = {}
+        if self.config and "headers" in self.config:
+            defaults = self.config["headers"]
+        groups = {}
+        for event in events:
+            headers, text = self._split_message(str(event.get("description", "")))
+            headers = dict(headers)
+            value = headers.get(self.digest.lower(),
+                                defaults.get(self.digest, "")) if self.digest else ""
+            groups.setdefault(value, []).append((event, headers, text))
+
+        for value, members in groups.items():
+            members.sort(key=lambda member: _as_datetime(member[0].decoded("dtstart")))
+            common = dict(members[0][1])
+            for _, headers, _ in members[1:]:
+                common = {key: header for key, header in common.items()
+                          if headers.get(key) == header}
+            if self.digest:
+                common[self.digest.lower()] = value
+
+            body = [f"{key}: {header}" for key, header in common.items()]
+            tasks = f"{len(members)} task" + ("s" if len(members) > 1 else "")
+            body.extend(["", tasks, ""])
+            for event, _, text in members:
+                body.append(f"* {event.decoded('dtstart')} "
+                            f"{event.get('summary', '')}")
+                body.extend("  " + line for line in text.strip().split('\n')
+                            if line.strip())
+                body.append("")
+
+            digest = icalendar.Event()
+            digest.add("summary", tasks + (f" for {value}" if value else ""))
+            digest.add("dtstart", members[0][0].decoded("dtstart"))
+            digest.add("dtend", max((event.decoded("dtend") if "dtend" in event
+                                     else event.decoded("dtstart")
+                                     for event, _, _ in members),
+                                    key=_as_datetime))
+            digest.add("description", "\n".join(body))
+            logger.info("Digest of %d events for %s", len(members), value)
+            yield digest
+
+    def _enqueue(self, actions_data, spool=None):
+        """ Write prepared payloads to the spool for a later drain """
+        spool = spool or self.spool
+        if not self.spool_kind:
+            raise NotImplementedError(f"{type(self).__name__} can't be spooled")
+        count = 0
+        for count, action_data in enumerate(actions_data, 1):
+            spool.put(self.spool_kind, self._serialize(action_data))
+        logger.info("%d items spooled to %s", count, spool.directory)
+
+    def drain(self, spool, retries=5, backoff=2.0):
+        """ Deliver the spooled items of this backend. Every item is tried
+            retries times waiting backoff, 2*backoff, 4*backoff, ... seconds
+            in between. Undeliverable items stay in the spool, as do the
+            items left when the deadline is reached. Returns the number of
+            items that could not be delivered. """
+        with self._pool():
+            return self._drain(spool, retries, backoff)
+
+    def _drain(self, spool, retries, backoff):
+        failed = 0
+        suffix = "." + self.spool_kind
+        for name in spool.pending():
+            if not name.endswith(suffix):
+                continue
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                logger.warning("Runtime budget exhausted, spooled items are "
+                               "left for the next run")
+                break
+            data = spool.claim(name)
+            if data is None:
+                logger.debug("Item %s was claimed by another drain", name)
+                continue
+
+            for attempt in range(retries):
+                try:
+                    if self._perform_action([self._deserialize(data)]) is False:
+                        raise RuntimeError("Backend reported failure")
+                    break
+                except Exception as err: # pylint: disable=broad-exception-caught
+                    logger.warning("Delivery of %s failed (attempt %d/%d): %s",
+                                   name, attempt + 1, retries, err)
+                    if attempt + 1 < retries:
+                        wait = backoff * 2 ** attempt
+                        if (self.deadline is not None
+                                and time.monotonic() + wait >= self.deadline):
+                            logger.warning("No time left to retry %s", name)
+                            spool.release(name)
+                            return failed
+                        time.sleep(wait)
+            else:
+                logger.error("Giving up on %s for now", name)
+                failed += 1
+                spool.release(name)
+                continue
+
+            if self.dry_run:
+                # nothing was delivered, keep the item
+                spool.release(name)
+            else:
+                spool.done(name)
+        return failed
+
+    @contextlib.contextmanager
+    def _pool(self):
+        """ The shared connection pool or, without one, a pool that is
+            closed when the outermost user is done """
+        if self.connections is not None:
+            yield self.connections
+            return
+        self.connections = ConnectionPool()
+        try:
+            yield self.connections
+        finally:
+            pool, self.connections = self.connections, None
+            pool.close()
+
+    def _serialize(self, action_data):
+        """ Implemented in subclasses with a spool_kind. Returns bytes """
+        return action_data
+
+    def _deserialize(self, data):
+        """ Implemented in subclasses with a spool_kind. Inverse of
+            _serialize """
+        return data
 
     def _prepare_event(self, headers, text, event):
         """ Implemented in the subclass. """
@@ -132,12 +722,39 @@ class Backend:
 
 
 class ListStdout(Backend):
-    """ Lists events to stdout """
-    def __init__(self, config, dry_run):
+    """ Lists events to stdout, every event is written as soon as it is
+        expanded """
+    formats = ['text', 'jsonl', 'csv', 'ics']
+    fields = ['uid', 'summary', 'dtstart', 'dtend', 'description']
+    streaming = True
+
+    def __init__(self, config, dry_run, output_format='text', out=None):
         _ = config
         super().__init__(config, dry_run)
+        if output_format not in self.formats:
+            raise ValueError(f"Unknown output format {output_format}")
+        self.output_format = output_format
+        self.out = out or sys.stdout
+        self._csv = None
+
+    def act(self, events):
+        if self.output_format == 'csv':
+            self._csv = csv.writer(self.out)
+            self._csv.writerow(self.fields)
+        if self.output_format == 'ics':
+            self.out.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+                           "PRODID:-//Wartungsplan//EN\r\n")
+        super().act(events)
+        if self.output_format == 'ics':
+            self.out.write("END:VCALENDAR\r\n")
+        self.out.flush()
 
     def _prepare_event(self, headers, text, event):
+        if self.output_format == 'ics':
+            return event.to_ical().decode('utf-8')
+        if self.output_format != 'text':
+            return self.as_dict(event)
+
         text = [str(event.get("summary")),
                 str(event.get("description")),
                 str(event.decoded("dtstart")),
@@ -146,14 +763,118 @@ class ListStdout(Backend):
         logger.debug("Event content: %s", text)
         return '\n'.join(text)
 
+    @staticmethod
+    def as_dict(event):
+        """ The fields of an event for jsonl and csv """
+        return {"uid": str(event.get("uid", "")),
+                "summary": str(event.get("summary", "")),
+                "dtstart": event.decoded("dtstart").isoformat(),
+                "dtend": event.decoded("dtend").isoformat()
+                         if "dtend" in event else None,
+                "description": str(event.get("description", ""))}
+
     def _perform_action(self, actions_data):
         """ List all Jobs in given Date """
         for data in actions_data:
-            print(data)
+            if self.output_format == 'jsonl':
+                self.out.write(json.dumps(data, ensure_ascii=False) + '\n')
+            elif self.output_format == 'csv':
+                self._csv.writerow([data[field] for field in self.fields])
+            elif self.output_format == 'ics':
+                self.out.write(data)
+            else:
+                print(data, file=self.out)
+        self.out.flush()
+
+
+class Forecast(Backend):
+    """ Counts occurrences per day, week or month and optionally per value
+        of a header like queue or priority. No backend payloads are built,
+        only the start times are counted. """
+    periods = ['day', 'week', 'month']
+    # only needs the start time and the component of an occurrence
+    streaming = "starts"
+
+    def __init__(self, config, dry_run, period='week', group_by=None,
+                 output_format='text', out=None):
+        super().__init__(config, dry_run)
+        if period not in self.periods:
+            raise ValueError(f"Unknown period {period}")
+        if output_format not in ('text', 'jsonl', 'csv'):
+            raise ValueError(f"Output format {output_format} not supported")
+        self.period = period
+        self.group_by = group_by
+        self.output_format = output_format
+        self.out = out or sys.stdout
+
+    def act(self, events):
+        self._perform_action(self.count(events))
+
+    def count(self, starts):
+        """ Returns Counter (period, group) -> number of occurrences for
+            (start, component) tuples """
+        days = collections.Counter()
+        # all occurrences of a series share the description, split it once
+        groups = {}
+        last = group = None
+        for start, component in starts:
+            if component is not last:
+                description = str(component.get("description", ""))
+                if description not in groups:
+                    groups[description] = self._group(description)
+                last, group = component, groups[description]
+            if isinstance(start, datetime.datetime):
+                start = start.date()
+            days[(start, group)] += 1
+        # counted by day first, a period is formatted once per day
+        counts = collections.Counter()
+        for (day, group), number in days.items():
+            counts[(self._bucket(day), group)] += number
+        return counts
+
+    def _group(self, description):
+        if not self.group_by:
+            return ""
+        headers, _ = self._split_message(description)
+        default = ""
+        if self.config and "headers" in self.config:
+            default = self.config["headers"].get(self.group_by, "") or ""
+        return headers.get(self.group_by, default)
+
+    def _bucket(self, start):
+        if self.period == 'day':
+            return start.strftime("%Y-%m-%d")
+        if self.period == 'week':
+            year, week, _ = start.isocalendar()
+            return f"{year}-W{week:02d}"
+        return start.strftime("%Y-%m")
+
+    def _perform_action(self, actions_data):
+        """ Print the counts sorted by period and group """
+        rows = sorted(actions_data.items())
+        if self.output_format == 'csv':
+            writer = csv.writer(self.out)
+            writer.writerow(["period", self.group_by or "group", "count"])
+            for (bucket, group), number in rows:
+                writer.writerow([bucket, group, number])
+        elif self.output_format == 'jsonl':
+            for (bucket, group), number in rows:
+                self.out.write(json.dumps({"period": bucket,
+                                           self.group_by or "group": group,
+                                           "count": number},
+                                          ensure_ascii=False) + '\n')
+        else:
+            width = max((len(group) for (_, group) in actions_data), default=0)
+            for (bucket, group), number in rows:
+                print(f"{bucket:10} {group:{width}} {number:6d}", file=self.out)
+            print(f"Total: {sum(actions_data.values())}", file=self.out)
+        self.out.flush()
 
 
 class SendEmail(Backend):
     """ Sends events via email to the configured target"""
+    spool_kind = "send"
+
     def _prepare_event(self, headers, text, event):
         sender_address = self.config["mail"]["sender"]
         recipient_address = self.config["mail"]["recipient"]
@@ -200,28 +921,59 @@ class SendEmail(Backend):
         else:
             logger.info("We are sending the Emails to %s", recipient_address)
 
-            logger.debug("Connecting to %s with port %s",
-                         self.config["mail"]["server"],
-                         self.config["mail"]["port"])
-            # Connect to Server with SSL from the beginning of the
-            # connection. 'context' is an optional argument and can contain a
-            # SSLContext that allows configuring various aspects of the secure
-            # connection.
-            # Read https://docs.python.org/3/library/ssl.html#ssl-security and
-            # https://docs.python.org/3/library/ssl.html#ssl.SSLContext for more
-            # information.
-            with smtplib.SMTP_SSL(self.config["mail"]["server"],
-                                  self.config["mail"]["port"]) as smtp:
-                logger.info("Connected to: %s", smtp.sock.getpeername())
-                logger.info("Connection cypher: %s", smtp.sock.cipher())
-                smtp.login(sender_address, self.config["mail"]["password"])
+            key = (self.config["mail"]["server"], self.config["mail"]["port"],
+                   sender_address, self.config["mail"]["password"])
+            with self._pool() as pool, \
+                 pool.get(key, self._connect, lambda smtp: smtp.quit(),
+                          lambda smtp: smtp.noop()[0] == 250) as smtp:
                 for msg in messages:
-                    smtp.send_message(msg)
+                    with tracer.span("smtp.send_message", sample=True,
+                                     summary=str(msg["Subject"])):
+                        smtp.send_message(msg)
                     logger.info("Email sent")
 
+    def _connect(self):
+        logger.debug("Connecting to %s with port %s",
+                     self.config["mail"]["server"],
+                     self.config["mail"]["port"])
+        # Connect to Server with SSL from the beginning of the
+        # connection. 'context' is an optional argument and can contain a
+        # SSLContext that allows configuring various aspects of the secure
+        # connection.
+        # Read https://docs.python.org/3/library/ssl.html#ssl-security and
+        # https://docs.python.org/3/library/ssl.html#ssl.SSLContext for more
+        # information.
+        # str() as the config may also be a dict with a bool
+        ssl = str(self.config["mail"].get("ssl", "yes")).lower()
+        if ssl in ("no", "false", "off", "0"):
+            # plain SMTP, e.g. to a local relay
+            smtp = smtplib.SMTP(self.config["mail"]["server"],
+                                self.config["mail"]["port"])
+        else:
+            smtp = smtplib.SMTP_SSL(self.config["mail"]["server"],
+                                    self.config["mail"]["port"])
+        try:
+            logger.info("Connected to: %s", smtp.sock.getpeername())
+            if hasattr(smtp.sock, "cipher"):
+                logger.info("Connection cypher: %s", smtp.sock.cipher())
+            smtp.login(self.config["mail"]["sender"],
+                       self.config["mail"]["password"])
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def _serialize(self, action_data):
+        return action_data.as_bytes()
+
+    def _deserialize(self, data):
+        return email.message_from_bytes(data, policy=email.policy.default)
+
 
 class OtrsApi(Backend):
     """ Open a ticket in OTRS """
+    spool_kind = "otrs"
+
     def __init__(self, config, dry_run):
         super().__init__(config, dry_run)
         if "pyotrs" not in sys.modules:
@@ -260,60 +1012,406 @@ class OtrsApi(Backend):
                                         "Body":
                                           text +
                                           "\n\n" +
-                                          self.config.get("footer", "")
+                                          self.config["otrs"].get("footer", "")
                                         })
         return (new_ticket, first_article)
 
     def _perform_action(self, actions_data):
         """ Open a ticket in OTRS for every event in range """
+        success = True
         for event in actions_data:
             (new_ticket, first_article) = event
             if self.dry_run:
                 logger.info("new_ticket: %s", new_ticket.to_dct())
                 logger.info("first_article: %s", first_article.to_dct())
             else:
-                client = pyotrs.Client(self.config['otrs']['server'],
-                                       self.config['otrs']['username'],
-                                       self.config['otrs']['password'])
-
-                logger.info("Opening connection to OTRS")
-
-                if not client.session_restore_or_create():
-                    logger.error("Session to OTRS could not be opened")
+                key = (self.config['otrs']['server'],
+                       self.config['otrs']['username'],
+                       self.config['otrs']['password'])
+                try:
+                    with self._pool() as pool, \
+                         pool.get(key, self._connect,
+                                  lambda client: None) as client, \
+                         tracer.span("otrs.ticket_create", sample=True,
+                                     summary=new_ticket.fields["Title"]):
+                        resp = client.ticket_create(new_ticket, first_article)
+                except ConnectionRefusedError as err:
+                    logger.error("%s", err)
                     return False
-
-                resp = client.ticket_create(new_ticket, first_article)
                 #resp == {u'ArticleID': u'9', u'TicketID': u'7',
                 #         u'TicketNumber': u'2016110528000013'}
+                if not resp:
+                    logger.error("OTRS did not create the ticket: %s",
+                                 new_ticket.to_dct())
+                    success = False
+                    continue
                 logger.info("Reply from OTRS: %s", resp)
-        return True
+        return success
+
+    def _connect(self):
+        client = pyotrs.Client(self.config['otrs']['server'],
+                               self.config['otrs']['username'],
+                               self.config['otrs']['password'])
+
+        logger.info("Opening connection to OTRS")
+
+        if not client.session_restore_or_create():
+            raise ConnectionRefusedError("Session to OTRS could not be opened")
+        return client
+
+    def _serialize(self, action_data):
+        (new_ticket, first_article) = action_data
+        return json.dumps({"ticket": new_ticket.to_dct(),
+                           "article": first_article.to_dct()}).encode('utf-8')
+
+    def _deserialize(self, data):
+        data = json.loads(data)
+        return (pyotrs.Ticket(data["ticket"]["Ticket"]),
+                pyotrs.Article(data["article"]))
+
+
+def iter_occurrences(calendar, start, end):
+    """ Yields the events between start and end series by series in the
+        order of the calendar, the occurrences of a series by start. Only
+        the occurrences of one series (UID) are in memory at a time. """
+    for single_series in _iter_series(calendar):
+        with tracer.span("expand", single_series.subcomponents[0],
+                         sample=True) as span:
+            events = recurring_ical_events.of(single_series).between(start, end)
+            if span:
+                span.set("occurrences", len(events))
+        # moved occurrences come after the series
+        events.sort(key=lambda event: _as_datetime(event["DTSTART"].dt))
+        yield from events
+
+
+def iter_occurrence_starts(calendar, start, end):
+    """ Yields (start, component) for the events between start and end
+        without building an event per occurrence. The starts of a series
+        are computed with a dateutil rruleset of its RRULE, RDATE and EXDATE,
+        occurrences moved by a RECURRENCE-ID component replace the original
+        one of that day. UIDs with several series are expanded completely
+        to get the same result as between(). """
+    for single_series in _iter_series(calendar):
+        components = single_series.walk("VEVENT")
+        masters = [component for component in components
+                   if "RECURRENCE-ID" not in component]
+        if len(masters) > 1:
+            for event in recurring_ical_events.of(single_series).between(start, end):
+                yield event["DTSTART"].dt, event
+            continue
+
+        moved = set()
+        for component in components:
+            if "RECURRENCE-ID" in component:
+                moved.add(_day(component["RECURRENCE-ID"].dt))
+                occurrence = component["DTSTART"].dt
+                if _in_span(occurrence, occurrence + _duration(component),
+                            start, end):
+                    yield occurrence, component
+        if not masters:
+            continue
+
+        master, = masters
+        first = master["DTSTART"].dt
+        duration = _duration(master)
+        # the window in local time of the series, converted once instead of
+        # every occurrence
+        zone = getattr(first, "tzinfo", None)
+        window_start, window_end = _naive(start, zone), _naive(end, zone)
+        # between() keeps only the last occurrence of a day for events with
+        # a SEQUENCE
+        one_per_day = "SEQUENCE" in master
+        last = None
+        for occurrence in _iter_starts(master, start - duration, end):
+            day = occurrence.date()
+            if day in moved:
+                continue
+            if duration:
+                if not (occurrence < window_end
+                        and window_start < occurrence + duration):
+                    continue
+            elif not window_start <= occurrence < window_end:
+                continue
+            if last is not None and not (one_per_day and last.date() == day):
+                yield _like(last, first), master
+            last = occurrence
+        if last is not None:
+            yield _like(last, first), master
+
+
+def _iter_starts(component, start, end):
+    """ Yields the starts of component from a day before start to a day
+        after end as naive datetimes in the time zone of its DTSTART. The
+        rules are expanded in local time of DTSTART, so the occurrences keep
+        their time of day across daylight saving time changes. """
+    first = component["DTSTART"].dt
+    zone = getattr(first, "tzinfo", None)
+    rules = dateutil.rrule.rruleset()
+    rules.rdate(_naive(first, zone))
+    values = component.get("RRULE", [])
+    for value in values if isinstance(values, list) else [values]:
+        value = icalendar.vRecur(value)
+        until = value.pop("UNTIL", None)
+        rule = dateutil.rrule.rrulestr(value.to_ical().decode(),
+                                       dtstart=_naive(first, zone))
+        if until:
+            until = until[0] if isinstance(until, list) else until
+            if not isinstance(until, datetime.datetime):
+                until = datetime.datetime.combine(until, datetime.time.max)
+            rule = rule.replace(until=_naive(until, zone))
+        rules.rrule(rule)
+    for date in _dates(component, "RDATE"):
+        rules.rdate(_naive(date, zone))
+    excluded_days = set()
+    for date in _dates(component, "EXDATE"):
+        if isinstance(date, datetime.datetime):
+            rules.exdate(_naive(date, zone))
+        else:
+            # a date excludes every occurrence of that day
+            excluded_days.add(date)
+
+    margin = datetime.timedelta(days=1)
+    for occurrence in rules.between(_naive(start, zone) - margin,
+                                    _naive(end, zone) + margin, inc=True):
+        if occurrence.date() not in excluded_days:
+            yield occurrence
+
+
+def _like(occurrence, first):
+    """ The naive datetime occurrence as the type and in the time zone of
+        first """
+    zone = getattr(first, "tzinfo", None)
+    if not isinstance(first, datetime.datetime):
+        return occurrence.date()
+    if zone is None:
+        return occurrence
+    if hasattr(zone, "localize"):
+        # pytz needs the offset of the occurrence's day
+        return zone.localize(occurrence)
+    return occurrence.replace(tzinfo=zone)
+
+
+def _naive(date, zone):
+    """ Naive datetime of a date or datetime in the time zone zone """
+    if not isinstance(date, datetime.datetime):
+        return datetime.datetime.combine(date, datetime.time())
+    if date.tzinfo is not None:
+        date = date.astimezone(zone)
+    return date.replace(tzinfo=None)
+
+
+def _dates(component, name):
+    """ Yields the dates of the RDATE or EXDATE properties of component """
+    values = component.get(name, [])
+    for value in values if isinstance(values, list) else [values]:
+        for date in value.dts:
+            # periods start at their first value
+            yield date.dt[0] if isinstance(date.dt, tuple) else date.dt
+
+
+def _duration(component):
+    """ The duration of component like between() computes it """
+    first = component["DTSTART"].dt
+    if "DTEND" in component:
+        return component["DTEND"].dt - first
+    if "DURATION" in component:
+        return component["DURATION"].dt
+    if isinstance(first, datetime.datetime):
+        return datetime.timedelta()
+    return datetime.timedelta(days=1)
+
+
+def _in_span(occurrence_start, occurrence_end, start, end):
+    """ Whether an occurrence is between start (inclusive) and end
+        (exclusive), occurrences without a duration included """
+    occurrence_start = _as_datetime(occurrence_start)
+    occurrence_end = _as_datetime(occurrence_end)
+    if occurrence_start == occurrence_end:
+        return start <= occurrence_start < end
+    return occurrence_start < end and start < occurrence_end
+
+
+def _as_datetime(date):
+    """ An aware datetime of a date or datetime to compare them """
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime.combine(date, datetime.time())
+    return date.astimezone()
+
+
+def _day(date):
+    """ The date of a date or datetime """
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    return date
+
+
+def sort_by_series(calendar, events):
+    """ The events series by series in the order of the calendar, the
+        occurrences of a series by start, like iter_occurrences() """
+    series = {}
+    for component in calendar.walk("VEVENT"):
+        series.setdefault(str(component.get("UID", "")), len(series))
+    return sorted(events, key=lambda event: (
+        series[str(event.get("UID", ""))],
+        _as_datetime(event["DTSTART"].dt)))
+
+
+def _iter_series(calendar):
+    """ Yields a calendar per series (UID) """
+    series = {}
+    for component in calendar.walk("VEVENT"):
+        # events without UID are matched against each other, keep them
+        # together
+        series.setdefault(str(component.get("UID", "")), []).append(component)
+
+    for components in series.values():
+        single_series = icalendar.Calendar(calendar)
+        for component in components:
+            single_series.add_component(component)
+        yield single_series
+
+
+# marks the events of a shard with the position of their source component
+_ORDER_PROPERTY = "X-WARTUNGSPLAN-ORDER"
+# calendars with fewer VEVENTs are expanded in this process, starting the
+# processes and copying the events back takes longer than the expansion
+SHARD_MIN_EVENTS = 100
+
+
+def shard_jobs(calendar, jobs):
+    """ Number of processes to expand calendar in: jobs, but not more than
+        CPUs, and 1 for small calendars """
+    cpus = os.cpu_count() or 1
+    if jobs > cpus:
+        logger.info("Only %d CPUs, expand in %d processes instead of %d",
+                    cpus, cpus, jobs)
+        jobs = cpus
+    if jobs > 1 and len(calendar.walk("VEVENT")) < SHARD_MIN_EVENTS:
+        logger.info("Small calendar, expand in this process")
+        jobs = 1
+    return jobs
+
+
+def expand_sharded(calendar, start, end, jobs):
+    """ recurring_ical_events.of(calendar).between(start, end) in jobs
+        processes. The series (UIDs) are split into jobs groups, every group
+        is expanded in its own process and the results are merged back into
+        the order between() returns them in. """
+    series = _series_positions(calendar)
+
+    # biggest series first onto the smallest shard
+    shards = [[] for _ in range(jobs)]
+    for components in sorted(series.values(), key=len, reverse=True):
+        min(shards, key=len).extend(components)
+    shards = [shard for shard in shards if shard]
+    logger.info("Expand %d series in %d shards", len(series), len(shards))
+
+    properties = dict(calendar)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        results = pool.map(_expand_shard, [properties] * len(shards), shards,
+                           [start] * len(shards), [end] * len(shards))
+        events = [event for result in results for event in result]
+
+    # a series is in one shard only, so nothing is expanded twice and a
+    # stable sort restores the order
+    events.sort(key=lambda event: event[_ORDER_PROPERTY])
+    for event in events:
+        del event[_ORDER_PROPERTY]
+    return events
+
+
+def expand_traced(calendar, start, end):
+    """ recurring_ical_events.of(calendar).between(start, end) series by
+        series in this process with a tracing span per series """
+    properties = dict(calendar)
+    events = []
+    for components in _series_positions(calendar).values():
+        try:
+            with tracer.span("expand", components[0][1], sample=True) as span:
+                result = _expand_shard(properties, components, start, end)
+                if span:
+                    span.set("occurrences", len(result))
+        finally:
+            for _, component in components:
+                component.pop(_ORDER_PROPERTY, None)
+        events.extend(result)
+
+    events.sort(key=lambda event: event[_ORDER_PROPERTY])
+    for event in events:
+        del event[_ORDER_PROPERTY]
+    return events
+
+
+def _series_positions(calendar):
+    """ Lists of (position, component) by UID. between() orders the events
+        by the first component of their (UID, RECURRENCE-ID), that is the
+        order the components are read in. """
+    order = {}
+    series = {}
+    for number, component in enumerate(calendar.walk("VEVENT")):
+        position = order.setdefault(
+            recurring_ical_events.RepeatedEvent.id_of(component), number)
+        series.setdefault(str(component.get("UID", "")), []).append(
+            (position, component))
+    return series
+
+
+def _expand_shard(properties, components, start, end):
+    """ Expands components in a worker process, see expand_sharded() """
+    shard = icalendar.Calendar(properties)
+    for position, component in components:
+        component[_ORDER_PROPERTY] = position
+        shard.add_component(component)
+    return recurring_ical_events.of(shard).between(start, end)
 
 
 class Wartungsplan:
     """ Builds the events for the given range and allow to call
         into the backend """
-    def __init__(self, start_date, end_date, calendar, backend):
+    def __init__(self, start_date, end_date, calendar, backend, stream=False,
+                 jobs=1):
+        """ With stream=True the events are expanded while the backend walks
+            over them, with stream="starts" the backend gets (start,
+            component) tuples instead of events. With jobs > 1 the events are
+            expanded in that many processes. """
         self.calendar = calendar
         self.backend = backend
 
-        # parse start-date
-        if not start_date:
-            self.start_date = datetime.datetime.today()
-        else:
-            self.start_date = dateutil.parser.parse(start_date)
+        self.start_date, self.end_date = parse_date_range(start_date, end_date)
         logger.info("Start Date: %s", self.start_date.astimezone())
-
-        # parse end-date
-        if not end_date:
-            self.end_date = self.start_date + datetime.timedelta(7)
-        else:
-            self.end_date = dateutil.parser.parse(end_date)
         logger.info("End Date: %s", self.end_date.astimezone())
 
+        if jobs > 1:
+            jobs = shard_jobs(calendar, jobs)
+
+        if stream == "starts":
+            self.events = iter_occurrence_starts(calendar,
+                                                 self.start_date.astimezone(),
+                                                 self.end_date.astimezone())
+            return
+        if stream and jobs <= 1:
+            # expanded while the backend walks over them
+            self.events = iter_occurrences(calendar,
+                                           self.start_date.astimezone(),
+                                           self.end_date.astimezone())
+            return
+
         # Get all Events from start_date to end_date
-        self.events = recurring_ical_events.of(calendar).between(
-                          self.start_date.astimezone(),
-                          self.end_date.astimezone())
+        if jobs > 1:
+            self.events = expand_sharded(calendar,
+                                         self.start_date.astimezone(),
+                                         self.end_date.astimezone(), jobs)
+            if stream:
+                # the order iter_occurrences() streams them in
+                self.events = sort_by_series(calendar, self.events)
+        elif tracer.enabled:
+            self.events = expand_traced(calendar, self.start_date.astimezone(),
+                                        self.end_date.astimezone())
+        else:
+            self.events = recurring_ical_events.of(calendar).between(
+                              self.start_date.astimezone(),
+                              self.end_date.astimezone())
         logger.info("%i Events in time range %s - %s", len(self.events),
                     start_date, end_date)
 
@@ -325,15 +1423,1274 @@ class Wartungsplan:
         return self.backend.act(self.events)
 
 
+def parse_date_range(start_date, end_date):
+    """ Parse the start and end date arguments. Default is today until one
+        week later """
+    # parse start-date
+    if not start_date:
+        start = datetime.datetime.today()
+    else:
+        start = dateutil.parser.parse(start_date)
+
+    # parse end-date
+    if not end_date:
+        end = start + datetime.timedelta(7)
+    else:
+        end = dateutil.parser.parse(end_date)
+    return start, end
+
+
+def cache_directory(cachedir=None):
+    """ Directory for downloaded calendars and calendar indexes """
+    if not cachedir:
+        # systemd sets CACHE_DIRECTORY for CacheDirectory=
+        cachedir = os.environ.get("CACHE_DIRECTORY",
+                       os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                        os.path.expanduser("~/.cache")),
+                                    "wartungsplan"))
+    os.makedirs(cachedir, exist_ok=True)
+    return cachedir
+
+
+def read_calendar(calendarfile, config=None, window=None):
+    """ Parse the calendar from a file or a http(s) URL. With the index
+        option and a window (start, end) only the events that can take
+        place in the window are parsed. """
+    options = {}
+    if config and config.has_section("calendar"):
+        options = config["calendar"]
+
+    if re.match(r'^https?://', calendarfile):
+        return RemoteCalendar(calendarfile,
+                              options.get("cachedir", None),
+                              float(options.get("timeout", 30))).read()
+
+    index = window and str(options.get("index", "no")).lower() in ("yes", "true", "on", "1")
+    journal = CalendarJournal(calendarfile)
+    # events added to the journal meanwhile are not lost
+    with journal.lock(exclusive=False):
+        with open_calendar(calendarfile) as calendar_file:
+            data = calendar_file.read(len(BinaryCalendar.magic))
+            # binary calendars are read completely, they are fast anyway.
+            # The index needs positions in the uncompressed file.
+            if (index and data != BinaryCalendar.magic
+                    and not isinstance(calendar_file, (gzip.GzipFile,
+                                                       lzma.LZMAFile))):
+                calendar = CalendarIndex(calendarfile,
+                                         options.get("cachedir", None)).read(*window)
+            else:
+                calendar = parse_calendar(data + calendar_file.read())
+                logger.debug("Read calendar file %s", calendarfile)
+        for event in journal.events():
+            calendar.add_component(event)
+    return calendar
+
+
+class CalendarJournal:
+    """ Events added to a calendar file are appended to <calendar>.journal,
+        so adding an event doesn't rewrite the calendar. Writers and readers
+        take an advisory lock on <calendar>.lock. compact() folds the
+        journal into the calendar. """
+    def __init__(self, calendarfile):
+        self.calendarfile = calendarfile
+        self.journal_file = calendarfile + ".journal"
+        self.lock_file = calendarfile + ".lock"
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=True):
+        """ Exclusive lock for writers, shared lock for readers. Readers
+            don't create the lock file, without it there is no journal. """
+        if exclusive:
+            lock = open(self.lock_file, 'ab') # pylint: disable=consider-using-with
+        else:
+            try:
+                lock = open(self.lock_file, 'rb') # pylint: disable=consider-using-with
+            except FileNotFoundError:
+                yield
+                return
+        # Unix only, the calendars without journal don't need it
+        import fcntl # pylint: disable=import-outside-toplevel
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def append(self, event):
+        """ Add event to the journal """
+        data = event.to_ical()
+        with self.lock():
+            with open(self.journal_file, 'ab') as journal:
+                journal.write(data)
+
+    def events(self):
+        """ The events in the journal, call with the lock held """
+        try:
+            with open(self.journal_file, 'rb') as journal:
+                data = journal.read()
+        except FileNotFoundError:
+            return []
+        complete = data.rfind(b"END:VEVENT")
+        if complete < 0:
+            return []
+        if data[complete:].strip() != b"END:VEVENT":
+            # e.g. a writer was killed
+            logger.warning("Ignore incomplete event at the end of %s",
+                           self.journal_file)
+        calendar = icalendar.Calendar.from_ical(
+            b"BEGIN:VCALENDAR\r\n" + data[:complete] + b"END:VEVENT\r\n"
+            + b"END:VCALENDAR\r\n")
+        return calendar.walk("VEVENT")
+
+    def compact(self, events=(), check=None):
+        """ Write the calendar with the events of the journal and events
+            and empty the journal. check(calendar) is called before the
+            calendar is written. Returns the number of events folded. """
+        with self.lock():
+            try:
+                with open_calendar(self.calendarfile) as calendar:
+                    calendar = parse_calendar(calendar.read())
+            except FileNotFoundError:
+                calendar = icalendar.Calendar()
+            journal = self.events()
+            for event in itertools.chain(journal, events):
+                calendar.add_component(event)
+            if check:
+                check(calendar)
+            if journal or events:
+                with open_calendar(self.calendarfile + ".tmp", 'wb',
+                                   self.calendarfile) as tmp:
+                    tmp.write(calendar.to_ical())
+                os.replace(self.calendarfile + ".tmp", self.calendarfile)
+            if os.path.exists(self.journal_file):
+                os.unlink(self.journal_file)
+        logger.info("Folded %d events into %s", len(journal), self.calendarfile)
+        return len(journal)
+
+
+class BinaryCalendar:
+    """ Compact binary form of the events of a calendar with the properties
+        Wartungsplan uses. Every string is stored once and time zones by
+        name, so loading skips the ics parser and VTIMEZONE resolution. ics
+        remains the format to exchange calendars.
+
+        Layout: magic, version, string table, X-WR-TIMEZONE of the calendar,
+        then per event the number of properties and per property its number
+        in properties and value. """
+    magic = b"WPCAL"
+    version = 3
+    extension = ".wpcal"
+    properties = ("UID", "SEQUENCE", "RECURRENCE-ID", "DTSTART", "DTEND",
+                  "DURATION", "RRULE", "RDATE", "EXDATE", "SUMMARY",
+                  "DESCRIPTION")
+    _kinds = {"UID": "text", "SUMMARY": "text", "DESCRIPTION": "text",
+              "SEQUENCE": "int", "DURATION": "duration", "RRULE": "rrule",
+              "RDATE": "list", "EXDATE": "list"}
+    _header = struct.Struct(">5sH")
+    _count = struct.Struct(">I")
+    _int = struct.Struct(">i")
+    _long = struct.Struct(">q")
+    _time = struct.Struct(">BIq")
+    _epoch = datetime.datetime(1970, 1, 1)
+
+    @classmethod
+    def dumps(cls, events, timezone=None):
+        """ The binary form of events. timezone is the X-WR-TIMEZONE of their
+            calendar, recurring_ical_events uses it for floating times. """
+        strings = {"": 0}
+        records = []
+
+        def string(value):
+            return strings.setdefault(str(value), len(strings))
+
+        timezone = string(timezone) if timezone else 0
+
+        def time_value(value):
+            if not isinstance(value, datetime.datetime):
+                return cls._time.pack(0, 0, value.toordinal())
+            zone = 0
+            if value.tzinfo is not None:
+                zone = string(cls._zone_name(value.tzinfo))
+            wall = value.replace(tzinfo=None) - cls._epoch
+            return cls._time.pack(1, zone, wall // datetime.timedelta(microseconds=1))
+
+        events = list(events)
+        for event in events:
+            values = []
+            for code, name in enumerate(cls.properties):
+                prop = event.get(name)
+                if prop is None:
+                    continue
+                for value in prop if isinstance(prop, list) else [prop]:
+                    kind = cls._kinds.get(name, "time")
+                    if kind == "text":
+                        data = cls._count.pack(string(value))
+                    elif kind == "int":
+                        data = cls._int.pack(int(value))
+                    elif kind == "duration":
+                        data = cls._long.pack(value.dt // datetime.timedelta(microseconds=1))
+                    elif kind == "rrule":
+                        data = cls._count.pack(string(value.to_ical().decode()))
+                    elif kind == "list":
+                        dts = [dt.dt for dt in value.dts]
+                        if any(isinstance(dt, tuple) for dt in dts):
+                            raise ValueError(f"{name} periods can't be stored "
+                                             + "in a binary calendar")
+                        data = cls._count.pack(len(dts)) + b"".join(
+                                   time_value(dt) for dt in dts)
+                    else:
+                        data = time_value(value.dt)
+                    values.append(bytes([code]) + data)
+            records.append(cls._count.pack(len(values)) + b"".join(values))
+
+        encoded = [text.encode('utf-8') for text in strings]
+        return b"".join([cls._header.pack(cls.magic, cls.version),
+                         cls._count.pack(len(encoded))]
+                        + [cls._count.pack(len(text)) + text for text in encoded]
+                        + [cls._count.pack(timezone),
+                           cls._count.pack(len(records))] + records)
+
+    @staticmethod
+    def _zone_name(tzinfo):
+        """ IANA name of tzinfo """
+        zone = getattr(tzinfo, "zone", None) or getattr(tzinfo, "key", None)
+        if zone is None and tzinfo.utcoffset(None) == datetime.timedelta(0):
+            zone = "UTC"
+        try:
+            _localize(zone)
+        except Exception as err: # pylint: disable=broad-exception-caught
+            raise ValueError(f"Time zone {zone or tzinfo} has no known name, "
+                             + "keep the calendar as ics") from err
+        return zone
+
+    @classmethod
+    def loads(cls, data):
+        """ The icalendar Calendar of the binary form data """
+        magic, version = cls._header.unpack_from(data)
+        if magic != cls.magic:
+            raise ValueError("Not a binary calendar")
+        if version != cls.version:
+            raise ValueError(f"Binary calendar version {version} not "
+                             + f"supported, {cls.version} is")
+        position = cls._header.size
+        count, = cls._count.unpack_from(data, position)
+        position += 4
+        strings = []
+        for _ in range(count):
+            size, = cls._count.unpack_from(data, position)
+            position += 4
+            strings.append(data[position:position + size].decode('utf-8'))
+            position += size
+
+        # values of the same string are shared
+        texts = {}
+        rules = {}
+        def time_value(position):
+            kind, zone, value = cls._time.unpack_from(data, position)
+            if not kind:
+                return datetime.date.fromordinal(value)
+            value = cls._epoch + datetime.timedelta(microseconds=value)
+            return _localize(strings[zone])(value) if zone else value
+
+        calendar = icalendar.Calendar()
+        timezone, = cls._count.unpack_from(data, position)
+        if timezone:
+            calendar.add("X-WR-TIMEZONE", strings[timezone])
+        count, = cls._count.unpack_from(data, position + 4)
+        position += 8
+        for _ in range(count):
+            event = icalendar.Event()
+            size, = cls._count.unpack_from(data, position)
+            position += 4
+            for _ in range(size):
+                name = cls.properties[data[position]]
+                kind = cls._kinds.get(name, "time")
+                position += 1
+                if kind == "text":
+                    text, = cls._count.unpack_from(data, position)
+                    if text not in texts:
+                        texts[text] = icalendar.vText(strings[text])
+                    value = texts[text]
+                    position += 4
+                elif kind == "int":
+                    value = icalendar.prop.vInt(cls._int.unpack_from(data, position)[0])
+                    position += 4
+                elif kind == "duration":
+                    value = icalendar.vDuration(datetime.timedelta(
+                        microseconds=cls._long.unpack_from(data, position)[0]))
+                    position += 8
+                elif kind == "rrule":
+                    rule, = cls._count.unpack_from(data, position)
+                    if rule not in rules:
+                        rules[rule] = icalendar.vRecur.from_ical(strings[rule])
+                    value = icalendar.vRecur(rules[rule])
+                    position += 4
+                elif kind == "list":
+                    size, = cls._count.unpack_from(data, position)
+                    position += 4
+                    value = icalendar.prop.vDDDLists(
+                        [time_value(position + number * cls._time.size)
+                         for number in range(size)])
+                    position += size * cls._time.size
+                else:
+                    value = icalendar.vDDDTypes(time_value(position))
+                    position += cls._time.size
+                event.add(name, value, encode=False)
+            calendar.add_component(event)
+        return calendar
+
+    @classmethod
+    def write(cls, events, path, timezone=None):
+        """ Write the binary form of events to path, replaced atomically """
+        with open_calendar(path + ".tmp", 'wb', path) as binary:
+            binary.write(cls.dumps(events, timezone))
+        os.replace(path + ".tmp", path)
+
+
+@functools.lru_cache(maxsize=None)
+def _localize(zone):
+    """ Function making a naive datetime aware in the time zone called zone,
+        the way icalendar resolves TZID """
+    if pytz:
+        return pytz.timezone(zone).localize
+    import zoneinfo # pylint: disable=import-outside-toplevel
+    tzinfo = zoneinfo.ZoneInfo(zone)
+    return lambda value: value.replace(tzinfo=tzinfo)
+
+
+# magic bytes, extension and module of the compressed calendar formats
+_compressions = ((b"\x1f\x8b", ".gz", gzip), (b"\xfd7zXZ\x00", ".xz", lzma))
+
+
+def open_calendar(path, mode='rb', name=None):
+    """ Open a calendar file, text modes with utf-8 encoding. gzip and xz
+        files are (de)compressed while they are read or written. They are
+        recognized by their magic bytes when reading and by the extension
+        .gz or .xz of name (default path) when writing. """
+    opener = open
+    if mode.startswith('r'):
+        with open(path, 'rb') as calendar:
+            magic = calendar.read(6)
+        for prefix, _, module in _compressions:
+            if magic.startswith(prefix):
+                opener = module.open
+    else:
+        for _, extension, module in _compressions:
+            if (name or path).endswith(extension):
+                opener = module.open
+    if 'b' in mode:
+        return opener(path, mode)
+    # gzip and lzma open in binary mode without a t
+    return opener(path, mode.replace('t', '') + 't', encoding='utf-8')
+
+
+def parse_calendar(data):
+    """ The calendar of the ics or binary calendar data, which can be gzip
+        or xz compressed """
+    for prefix, _, module in _compressions:
+        if data.startswith(prefix):
+            data = module.decompress(data)
+            break
+    if data.startswith(BinaryCalendar.magic):
+        return BinaryCalendar.loads(data)
+    return icalendar.Calendar.from_ical(data)
+
+
+class RemoteCalendar:
+    """ A calendar downloaded via http(s) and cached locally. Downloads are
+        revalidated with ETag/Last-Modified so unchanged calendars are
+        neither downloaded nor parsed again. The parsed calendar is cached
+        in the binary calendar format. """
+    def __init__(self, url, cachedir=None, timeout=30):
+        self.url = url
+        self.timeout = timeout
+        cachedir = cache_directory(cachedir)
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        self.ics_file = os.path.join(cachedir, name + ".ics")
+        self.meta_file = os.path.join(cachedir, name + ".json")
+        self.parsed_file = os.path.join(cachedir,
+                                        name + BinaryCalendar.extension)
+
+    def read(self):
+        """ Returns the parsed calendar """
+        meta = {}
+        if os.path.exists(self.ics_file) and os.path.exists(self.meta_file):
+            with open(self.meta_file, encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last-modified"):
+            headers["If-Modified-Since"] = meta["last-modified"]
+
+        try:
+            # requests asks for and decodes gzip transfer by default
+            response = requests.get(self.url, headers=headers,
+                                    timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            if not meta:
+                raise
+            logger.warning("Download of %s failed, use cached copy: %s",
+                           self.url, err)
+            return self._cached()
+
+        if response.status_code == 304:
+            logger.info("Calendar %s not modified", self.url)
+            return self._cached()
+
+        logger.info("Downloaded calendar %s (%d bytes)", self.url,
+                    len(response.content))
+        try:
+            calendar = parse_calendar(response.content)
+        except Exception as err: # pylint: disable=broad-exception-caught
+            # e.g. an error page of a proxy delivered with 200
+            if not meta:
+                raise
+            logger.warning("Download of %s is no calendar, use cached copy: %s",
+                           self.url, err)
+            return self._cached()
+
+        # invalidate the old copy first, then replace atomically
+        for old in (self.meta_file, self.parsed_file):
+            if os.path.exists(old):
+                os.unlink(old)
+        self._write(self.ics_file, response.content)
+        try:
+            self._write(self.parsed_file, BinaryCalendar.dumps(
+                calendar.walk("VEVENT"), calendar.get("X-WR-TIMEZONE")))
+        except ValueError as err:
+            logger.debug("Calendar %s is cached as ics only: %s", self.url, err)
+        self._write(self.meta_file, json.dumps({
+            "url": self.url,
+            "etag": response.headers.get("ETag"),
+            "last-modified": response.headers.get("Last-Modified")
+            }).encode('utf-8'))
+        return calendar
+
+    def _cached(self):
+        """ The parsed calendar of the last good download """
+        try:
+            with open(self.parsed_file, 'rb') as parsed:
+                return BinaryCalendar.loads(parsed.read())
+        except Exception as err: # pylint: disable=broad-exception-caught
+            logger.debug("No usable parsed calendar: %s", err)
+        with open(self.ics_file, 'rb') as calendar:
+            return parse_calendar(calendar.read())
+
+    @staticmethod
+    def _write(path, data):
+        with open(path + ".tmp", 'wb') as out:
+            out.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def _vevent_ranges(data):
+    """ Yields the (start, end) byte ranges of the VEVENTs in ics data """
+    position = 0
+    while True:
+        first = data.find(b"BEGIN:VEVENT", position)
+        while first > 0 and data[first - 1:first] != b"\n":
+            first = data.find(b"BEGIN:VEVENT", first + 1)
+        last = data.find(b"END:VEVENT", first)
+        while last > 0 and data[last - 1:last] != b"\n":
+            last = data.find(b"END:VEVENT", last + 1)
+        if first < 0 or last < 0:
+            return
+        last += len(b"END:VEVENT")
+        if data[last:last + 1] == b"\r":
+            last += 1
+        if data[last:last + 1] == b"\n":
+            last += 1
+        yield first, last
+        position = last
+
+
+class CalendarIndex:
+    """ Reads only the events of an ics file that can take place in a time
+        window. A sidecar index keeps the byte range, UID, DTSTART and the
+        last possible day of every VEVENT. The file is memory mapped and only
+        the matching VEVENTs are sliced out and parsed. """
+    version = 2
+    # events are compared by date, a day covers every UTC offset
+    slack = datetime.timedelta(days=1)
+
+    _event_re = re.compile(rb'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?\n?',
+                           re.M | re.S)
+    _property_re = re.compile(
+        rb'^(UID|DTSTART|DTEND|DURATION|RRULE|RDATE|RECURRENCE-ID)'
+        rb'(?:;[^:\r\n]*)?:([^\r\n]*)', re.M)
+    _fold_re = re.compile(rb'\r?\n[ \t]')
+    _date_re = re.compile(r'(\d{8})')
+
+    def __init__(self, calendarfile, cachedir=None):
+        self.calendarfile = calendarfile
+        # the calendar directory might not be writable, keep the index in the
+        # cache directory
+        name = hashlib.sha256(os.path.abspath(calendarfile).encode('utf-8'))
+        self.index_file = os.path.join(cache_directory(cachedir),
+                                       name.hexdigest()[:16] + ".idx")
+
+    def read(self, start, end):
+        """ Returns a calendar with all non VEVENT parts and the VEVENTs
+            that can take place between start and end """
+        stat = os.stat(self.calendarfile)
+        if stat.st_size == 0:
+            return icalendar.Calendar()
+
+        with open(self.calendarfile, 'rb') as calendar, \
+             mmap.mmap(calendar.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = self._load(stat)
+            if not index:
+                index = self._build(data, stat)
+
+            selected = self._select(index["events"], start.date(), end.date())
+            logger.info("Index: parse %d of %d events", len(selected),
+                        len(index["events"]))
+
+            # slices of the memoryview don't copy, join copies once
+            view = memoryview(data)
+            pieces = [view[first:last] for first, last in index["skeleton"][:1]]
+            pieces.extend(view[event["range"][0]:event["range"][1]]
+                          for event in selected)
+            pieces.extend(view[first:last] for first, last in index["skeleton"][1:])
+            ics = b"".join(pieces)
+            pieces.clear()
+            view.release()
+
+        return icalendar.Calendar.from_ical(ics)
+
+    def _select(self, events, start, end):
+        """ Events that can take place in the window and all events of the
+            same series (UID) """
+        first_possible = (start - self.slack).strftime("%Y%m%d")
+        last_possible = (end + self.slack).strftime("%Y%m%d")
+        uids = set()
+        hits = set()
+        for number, event in enumerate(events):
+            if event["dtstart"] and event["dtstart"] > last_possible:
+                hit = False
+            else:
+                hit = not event["last"] or event["last"] >= first_possible
+            if event["recurrence-id"]:
+                # a modified occurrence also removes one from the series
+                hit = hit or first_possible <= event["recurrence-id"] <= last_possible
+            if hit:
+                hits.add(number)
+                if event["uid"]:
+                    uids.add(event["uid"])
+        return [event for number, event in enumerate(events)
+                if number in hits or (event["uid"] and event["uid"] in uids)]
+
+    def _load(self, stat):
+        """ The index if it matches the calendar file, else None """
+        try:
+            with open(self.index_file, encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if (index.get("version") != self.version
+                or index.get("mtime") != stat.st_mtime_ns
+                or index.get("size") != stat.st_size):
+            logger.debug("Index %s is outdated", self.index_file)
+            return None
+        return index
+
+    def _build(self, data, stat):
+        """ Scan the calendar and write the index """
+        logger.info("Build index %s for %s", self.index_file, self.calendarfile)
+        events = []
+        skeleton = []
+        position = 0
+        for match in self._event_re.finditer(data):
+            if match.start() > position:
+                skeleton.append((position, match.start()))
+            position = match.end()
+            events.append(self._describe(match.start(), match.end(),
+                                         match.group()))
+        skeleton.append((position, len(data)))
+        index = {"version": self.version,
+                 "mtime": stat.st_mtime_ns,
+                 "size": stat.st_size,
+                 "skeleton": skeleton,
+                 "events": events}
+        with open(self.index_file + ".tmp", 'w', encoding='utf-8') as index_file:
+            json.dump(index, index_file)
+        os.replace(self.index_file + ".tmp", self.index_file)
+        return index
+
+    def _describe(self, first, last, vevent):
+        """ Index entry of one VEVENT: the byte range and the dates (YYYYMMDD)
+            of its first and last possible day """
+        properties = {}
+        for name, value in self._property_re.findall(self._fold_re.sub(b'', vevent)):
+            # the first one wins, later ones belong to sub components
+            properties.setdefault(name.decode(), value.decode('utf-8', 'replace'))
+
+        dtstart = self._date(properties.get("DTSTART"))
+        until = None
+        rrule = properties.get("RRULE")
+        if rrule:
+            rule = dict(part.split('=', 1) for part in rrule.split(';') if '=' in part)
+            until = self._date(rule.get("UNTIL"))
+            if dtstart and not until and rule.get("COUNT", "").isdigit():
+                until = self._last_occurrence(properties["DTSTART"], rrule)
+
+        # last day an occurrence can end, None if unknown or unbounded
+        last_day = None
+        if dtstart and not properties.get("RDATE"):
+            duration = datetime.timedelta(0)
+            if properties.get("DTEND") and self._date(properties["DTEND"]):
+                duration = (self._day(self._date(properties["DTEND"]))
+                            - self._day(dtstart))
+            elif properties.get("DURATION"):
+                try:
+                    duration = icalendar.vDuration.from_ical(properties["DURATION"])
+                except ValueError:
+                    duration = None
+            if duration is not None:
+                if not rrule:
+                    last_day = self._day(dtstart) + duration
+                elif until:
+                    last_day = self._day(until) + duration
+        return {"range": (first, last),
+                "uid": properties.get("UID"),
+                "dtstart": dtstart,
+                "until": until,
+                "recurrence-id": self._date(properties.get("RECURRENCE-ID")),
+                "last": last_day.strftime("%Y%m%d") if last_day else None}
+
+    @classmethod
+    def _last_occurrence(cls, dtstart, rrule):
+        """ YYYYMMDD of the last occurrence of a RRULE with COUNT, None if
+            the rule can't be read """
+        try:
+            if 'T' in dtstart:
+                start = datetime.datetime.strptime(dtstart[:15], "%Y%m%dT%H%M%S")
+            else:
+                start = cls._day(dtstart[:8])
+            rule = dateutil.rrule.rrulestr(rrule, dtstart=start)
+        except ValueError:
+            return None
+        last = collections.deque(rule, maxlen=1)
+        return last[0].strftime("%Y%m%d") if last else None
+
+    @classmethod
+    def _date(cls, value):
+        """ YYYYMMDD of an ical DATE or DATE-TIME value """
+        match = cls._date_re.match(value or "")
+        return match.group(1) if match else None
+
+    @staticmethod
+    def _day(value):
+        return datetime.datetime.strptime(value, "%Y%m%d")
+
+
+class CalendarDiff:
+    """ Compares two versions of an ics file by VEVENT. Components are
+        matched by UID and RECURRENCE-ID (components without UID by content)
+        and compared by a hash of their content without DTSTAMP. Both files
+        are scanned once, only the changed series are parsed. """
+    _property_re = re.compile(
+        rb'^(UID|RECURRENCE-ID|SEQUENCE|LAST-MODIFIED)(?:;[^:\r\n]*)?:([^\r\n]*)',
+        re.M)
+    # occurrences only differing in these are the same
+    _volatile_re = re.compile(
+        rb'^(DTSTAMP|LAST-MODIFIED|SEQUENCE|CREATED)[;:][^\r\n]*\r?\n', re.M)
+
+    def __init__(self, old, new):
+        """ old and new are the contents of the ics files """
+        self.old, self.new = old, new
+        self._old_skeleton, self._old = self._scan(old)
+        self._new_skeleton, self._new = self._scan(new)
+        self.added = [key for key in self._new if key not in self._old]
+        self.removed = [key for key in self._old if key not in self._new]
+        self.modified = [key for key, component in self._new.items()
+                         if key in self._old
+                         and self._old[key]["hash"] != component["hash"]]
+        logger.info("Diff: %d added, %d removed, %d modified components",
+                    len(self.added), len(self.removed), len(self.modified))
+
+    @classmethod
+    def from_files(cls, old_file, new_file):
+        """ Diff of two files, a missing old file is an empty calendar """
+        try:
+            with open_calendar(old_file) as old:
+                old = old.read()
+        except FileNotFoundError:
+            logger.warning("%s not found, everything is new", old_file)
+            old = b""
+        with open_calendar(new_file) as new:
+            return cls(old, new.read())
+
+    def changes(self):
+        """ Yields dicts describing the added, removed and modified
+            components """
+        for change, keys in (("added", self.added), ("removed", self.removed),
+                             ("modified", self.modified)):
+            for key in keys:
+                component = (self._old if change == "removed" else self._new)[key]
+                description = {"change": change, "uid": component["uid"],
+                               "recurrence-id": component["recurrence-id"],
+                               "sequence": component["sequence"],
+                               "last-modified": component["last-modified"]}
+                if change == "modified":
+                    description["old-sequence"] = self._old[key]["sequence"]
+                yield description
+
+    def calendar(self, version="new"):
+        """ The changed series of the old or new version as a calendar """
+        if version == "new":
+            data, skeleton, components = self.new, self._new_skeleton, self._new
+        else:
+            data, skeleton, components = self.old, self._old_skeleton, self._old
+        uids = {self._uid(key) for key in self.added + self.removed + self.modified}
+        pieces = [data[first:last] for first, last in skeleton[:1]]
+        pieces.extend(data[component["range"][0]:component["range"][1]]
+                      for key, component in components.items()
+                      if self._uid(key) in uids)
+        pieces.extend(data[first:last] for first, last in skeleton[1:])
+        ics = b"".join(pieces)
+        if not ics.strip():
+            return icalendar.Calendar()
+        return icalendar.Calendar.from_ical(ics)
+
+    def occurrences(self, start, end):
+        """ Returns (new, cancelled): the occurrences between start and end
+            that are new or changed in the new version and those of the old
+            version that are gone or changed """
+        old = self._expand(self.calendar("old"), start, end)
+        new = self._expand(self.calendar("new"), start, end)
+        return ([event for key, event in new.items() if key not in old],
+                [event for key, event in old.items() if key not in new])
+
+    def _expand(self, calendar, start, end):
+        """ The occurrences by (UID, start, content hash) """
+        occurrences = {}
+        for event in recurring_ical_events.of(calendar).between(start, end):
+            content = self._volatile_re.sub(b"", event.to_ical())
+            occurrences[(str(event.get("UID", "")), str(event["DTSTART"].dt),
+                         hashlib.sha1(content).hexdigest())] = event
+        return occurrences
+
+    @staticmethod
+    def _uid(key):
+        """ Components without UID are their own series """
+        return key if key[0] is None else key[0]
+
+    @staticmethod
+    def _line(data, name, first, last):
+        """ Byte range of the first content line name between first and last
+            including its folded continuation lines, None if there is none """
+        position = data.find(b"\n" + name, first, last)
+        while (position >= 0 and data[position + 1 + len(name):
+                                      position + 2 + len(name)] not in (b":", b";")):
+            position = data.find(b"\n" + name, position + 1, last)
+        if position < 0:
+            return None
+        end = data.find(b"\n", position + 1, last)
+        while end >= 0 and data[end + 1:end + 2] in (b" ", b"\t"):
+            end = data.find(b"\n", end + 1, last)
+        return position + 1, (end + 1 if end >= 0 else last)
+
+    def _properties(self, data, first, last):
+        """ UID, RECURRENCE-ID, SEQUENCE and LAST-MODIFIED of the VEVENT
+            between first and last. The first one wins, later ones belong to
+            sub components. """
+        properties = {}
+        for name in (b"UID", b"RECURRENCE-ID", b"SEQUENCE", b"LAST-MODIFIED"):
+            span = self._line(data, name, first, last)
+            if span:
+                line = CalendarIndex._fold_re.sub(b"", data[span[0]:span[1]]) # pylint: disable=protected-access
+                match = self._property_re.match(line)
+                if match:
+                    properties[name.decode()] = match.group(2).decode('utf-8', 'replace')
+        return properties
+
+    def _scan(self, data):
+        """ Returns the non VEVENT parts (skeleton) and the components by key """
+        components = {}
+        skeleton = []
+        position = 0
+        for first, last in _vevent_ranges(data):
+            if first > position:
+                skeleton.append((position, first))
+            position = last
+            properties = self._properties(data, first, last)
+
+            # the content without DTSTAMP, hashed without copying
+            digest = hashlib.sha1()
+            dtstamp = self._line(data, b"DTSTAMP", first, last)
+            if dtstamp:
+                digest.update(data[first:dtstamp[0]])
+                digest.update(data[dtstamp[1]:last])
+            else:
+                digest.update(data[first:last])
+            digest = digest.hexdigest()
+
+            sequence = properties.get("SEQUENCE", "").strip()
+            if properties.get("UID"):
+                key = (properties["UID"], properties.get("RECURRENCE-ID"))
+            else:
+                key = (None, digest)
+            components[key] = {"range": (first, last),
+                               "uid": properties.get("UID"),
+                               "recurrence-id": properties.get("RECURRENCE-ID"),
+                               "sequence": int(sequence) if sequence.isdigit() else 0,
+                               "last-modified": properties.get("LAST-MODIFIED"),
+                               "hash": digest}
+        skeleton.append((position, len(data)))
+        return skeleton, components
+
+
+class CalendarPreview:
+    """ Keeps the parsed calendar and the expanded windows in memory for the
+        serve action. The calendar is parsed again when the file changes. """
+    # the file is checked for changes at most this often (seconds)
+    check_interval = 1.0
+    # number of windows kept
+    cache_size = 64
+
+    def __init__(self, calendarfile, config=None, refresh=300):
+        self.calendarfile = calendarfile
+        self.config = config
+        self.remote = None
+        if re.match(r'^https?://', calendarfile):
+            options = {}
+            if config and config.has_section("calendar"):
+                options = config["calendar"]
+            self.remote = RemoteCalendar(calendarfile,
+                                         options.get("cachedir", None),
+                                         float(options.get("timeout", 30)))
+            # remote calendars are revalidated every refresh seconds
+            self.check_interval = refresh
+        self.version = None
+        self.calendar = None
+        self.windows = collections.OrderedDict()
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def _load(self):
+        """ Returns the version of the calendar file and the calendar, None
+            if the version didn't change """
+        if self.remote:
+            calendar = self.remote.read()
+            stat = os.stat(self.remote.ics_file)
+        else:
+            stat = os.stat(self.calendarfile)
+            calendar = None
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if not self.remote:
+            # events added to the journal
+            try:
+                version += (os.stat(CalendarJournal(self.calendarfile)
+                                    .journal_file).st_size,)
+            except FileNotFoundError:
+                pass
+        if version == self.version:
+            return version, None
+        logger.info("Parse %s", self.calendarfile)
+        if calendar is None:
+            calendar = read_calendar(self.calendarfile, self.config)
+        return version, calendar
+
+    def _check(self):
+        """ Parse the calendar again if it changed """
+        now = time.monotonic()
+        if self.calendar is not None and now - self._checked < self.check_interval:
+            return
+        # one thread reloads, the others keep answering from the cache
+        if not self._reload_lock.acquire(blocking=self.calendar is None):
+            return
+        try:
+            self._checked = now
+            version, calendar = self._load()
+            if calendar is None:
+                return
+            with self._lock:
+                self.calendar, self.version = calendar, version
+                self.windows.clear()
+            # precompute the default window
+            self.occurrences(*self.window(None, None))
+        finally:
+            self._reload_lock.release()
+
+    @staticmethod
+    def window(start_date, end_date):
+        """ parse_date_range() but starting at midnight, so the default
+            window is the same for all requests of a day """
+        return parse_date_range(start_date or datetime.date.today().isoformat(),
+                                end_date)
+
+    def occurrences(self, start, end):
+        """ Returns (etag, JSON body) of the occurrences between start and
+            end """
+        self._check()
+        key = (start, end)
+        with self._lock:
+            calendar, version = self.calendar, self.version
+            if key in self.windows:
+                self.windows.move_to_end(key)
+                return self.windows[key]
+
+        events = recurring_ical_events.of(calendar).between(start.astimezone(),
+                                                            end.astimezone())
+        body = json.dumps({"start": start.isoformat(), "end": end.isoformat(),
+                           "occurrences": [ListStdout.as_dict(event)
+                                           for event in events]},
+                          ensure_ascii=False).encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        with self._lock:
+            if version == self.version:
+                self.windows[key] = (etag, body)
+                if len(self.windows) > self.cache_size:
+                    self.windows.popitem(last=False)
+        return etag, body
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    """ GET /occurrences?start=&end= of the CalendarPreview of the server """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Answer with the occurrences as JSON """
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/occurrences":
+            self._answer(404, json.dumps({"error": "Not found"}).encode())
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            start, end = CalendarPreview.window(query.get("start", [None])[0],
+                                                query.get("end", [None])[0])
+        except (ValueError, OverflowError) as err:
+            self._answer(400, json.dumps({"error": str(err)}).encode())
+            return
+
+        try:
+            etag, body = self.server.preview.occurrences(start, end)
+        except Exception as err: # pylint: disable=broad-exception-caught
+            logger.error("%s", err)
+            self._answer(500, json.dumps({"error": str(err)}).encode())
+            return
+        if etag in self.headers.get("If-None-Match", ""):
+            self._answer(304, b"", etag)
+        else:
+            self._answer(200, body, etag)
+
+    def _answer(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def preview_server(calendarfile, config):
+    """ The http server of the serve action, configured in [serve] """
+    options = config["serve"] if config.has_section("serve") else {}
+    preview = CalendarPreview(calendarfile, config,
+                              float(options.get("refresh", 300)))
+    preview.occurrences(*preview.window(None, None))
+
+    server = http.server.ThreadingHTTPServer(
+                 (options.get("address", "127.0.0.1"),
+                  int(options.get("port", 8080))), PreviewHandler)
+    server.daemon_threads = True
+    server.preview = preview
+    return server
+
+
+def serve(calendarfile, config):
+    """ Answer GET /occurrences until interrupted """
+    server = preview_server(calendarfile, config)
+    logger.info("Serving %s on http://%s:%d/occurrences", calendarfile,
+                *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def make_backend(action, config, dry_run, output_format='text',
+                 period='week', group_by=None):
+    """ Create the backend for action from the config """
+    if action == 'list':
+        return ListStdout(None, dry_run, output_format)
+    if action == 'forecast':
+        headers = config["headers"] if config.has_section("headers") else {}
+        return Forecast({"headers": headers}, dry_run, period, group_by,
+                        output_format)
+    if action == 'send':
+        return SendEmail({"mail":config["mail"],
+                          "headers":config["headers"]}, dry_run)
+    if action == 'otrs':
+        return OtrsApi({"otrs":config["otrs"],
+                        "headers":config["headers"]}, dry_run)
+    raise NameError("Action not found")
+
+
+def spool_directory(config):
+    """ Spool directory from the config """
+    if config.has_section("spool"):
+        return config["spool"].get("directory", "/var/spool/wartungsplan")
+    return "/var/spool/wartungsplan"
+
+
+def overflow_directory(config):
+    """ Directory of the items left by a run with --max-runtime, kept apart
+        from the spool of --spool and the drain action """
+    return os.path.join(spool_directory(config), "overflow")
+
+
+def spool_retries(config):
+    """ (retries, backoff) of a drain from the config """
+    retries, backoff = 5, 2.0
+    if config.has_section("spool"):
+        retries = config["spool"].getint("retries", retries)
+        backoff = config["spool"].getfloat("backoff", backoff)
+    return retries, backoff
+
+
+def drain(config, dry_run, deadline=None, connections=None):
+    """ Deliver all spooled items with the backend they were spooled by
+        until the deadline (time.monotonic()). Returns the number of items
+        that could not be delivered. connections is a ConnectionPool shared
+        with other profiles. """
+    spool = Spool(spool_directory(config))
+    retries, backoff = spool_retries(config)
+
+    kinds = {name.rsplit('.', 1)[-1] for name in spool.pending()}
+    logger.info("Spool %s has items for %s", spool.directory, kinds or "nobody")
+    failed = 0
+    for kind in sorted(kinds):
+        backend = make_backend(kind, config, dry_run)
+        backend.deadline = deadline
+        backend.connections = connections
+        failed += backend.drain(spool, retries, backoff)
+    if failed:
+        logger.error("%d items could not be delivered", failed)
+    return failed
+
+
+def read_profiles(config_files):
+    """ Returns a list of (name, config) for the config files. A config file
+        with [calendar:NAME] sections has a profile per NAME, the [SECTION:NAME]
+        sections override the options of [SECTION] for that profile. Other
+        config files are one profile. """
+    profiles = []
+    for config_file in config_files:
+        # Read Config file with utf-8 encoding (Umlaute ä, ö, ü, ... can be read)
+        config = configparser.ConfigParser()
+        with open(config_file, mode='r', encoding='utf-8') as conf:
+            config.read_file(conf)
+            logger.debug("Read config %s", config_file)
+
+        names = [section.split(':', 1)[1] for section in config.sections()
+                 if section.startswith('calendar:')]
+        if not names:
+            profiles.append((config_file, config))
+            continue
+
+        for name in names:
+            profile = configparser.ConfigParser()
+            # [SECTION] first, wherever [SECTION:NAME] is in the file
+            for section in sorted(config.sections(), key=lambda s: ':' in s):
+                base, _, suffix = section.partition(':')
+                if suffix and suffix != name:
+                    continue
+                if not profile.has_section(base):
+                    profile.add_section(base)
+                for key, value in config.items(section, raw=True):
+                    profile.set(base, key, value)
+            profiles.append((f"{config_file}:{name}", profile))
+    return profiles
+
+
+def run_profile(config, args, action=None, connections=None):
+    """ Run action or, if none was given on the command line, the action
+        configured in the calendar section for one profile. connections is
+        a ConnectionPool shared with other profiles. """
+    started = time.monotonic()
+    if not action and config.has_section("calendar"):
+        action = config["calendar"].get("action")
+    if not action:
+        raise SystemExit("No action given on the command line or in the "
+                         "calendar section")
+
+    if action == 'drain':
+        deadline = started + args.max_runtime if args.max_runtime else None
+        return 1 if drain(config, args.dry_run, deadline, connections) else 0
+
+    if action == 'serve':
+        return serve(calendar_location(config, args), config)
+
+    if action == 'diff':
+        if not args.previous:
+            raise SystemExit("Action diff needs --previous")
+        return print_diff(calendar_diff(args.previous, config, args),
+                          *parse_date_range(args.start_date, args.end_date),
+                          args.format)
+
+    # call the function selected by action
+    backend = make_backend(action, config, args.dry_run, args.format,
+                           args.period, args.group_by)
+    backend.connections = connections
+    if args.spool:
+        if not backend.spool_kind:
+            raise SystemExit(f"Action {action} can't be spooled")
+        backend.spool = Spool(spool_directory(config))
+    if args.digest or args.digest_by:
+        if backend.streaming == "starts":
+            raise SystemExit(f"Action {action} can't make digests")
+        backend.digest = args.digest_by or ""
+    if args.memory_budget is not None:
+        backend.memory_budget = int(args.memory_budget * 2**20)
+    if args.max_runtime and backend.spool_kind and not args.spool:
+        # what is left when the time is up is spooled and delivered first
+        # by the next run
+        backend.deadline = started + args.max_runtime
+        backend.overflow = Spool(overflow_directory(config))
+        if backend.drain(backend.overflow, *spool_retries(config)):
+            logger.error("Items left by a previous run could not be delivered")
+
+    if (not args.ics_calendar and config.has_section("calendar")
+            and config["calendar"].getboolean("exchange", False)):
+        return backend.act(exchange_events(config, args.start_date,
+                                           args.end_date, backend.streaming))
+
+    if args.previous:
+        # only what changed since the previous version
+        start, end = parse_date_range(args.start_date, args.end_date)
+        events, cancelled = calendar_diff(args.previous, config, args).occurrences(
+                                start.astimezone(), end.astimezone())
+        logger.info("%d new or changed occurrences, %d cancelled or changed",
+                    len(events), len(cancelled))
+        if backend.streaming == "starts":
+            events = [(event["DTSTART"].dt, event) for event in events]
+        return backend.act(events)
+
+    with tracer.span("parse", file=calendar_location(config, args)):
+        calendar = read_calendar(calendar_location(config, args), config,
+                                 parse_date_range(args.start_date, args.end_date))
+
+    wartungsplan = Wartungsplan(args.start_date, args.end_date, calendar,
+                                backend, stream=backend.streaming,
+                                jobs=args.jobs)
+    return wartungsplan.run_backend()
+
+
+def calendar_location(config, args):
+    """ The calendar file or URL from the arguments or the config """
+    if args.ics_calendar:
+        return args.ics_calendar
+    return config["calendar"]["calendarfile"]
+
+
+def calendar_diff(previous, config, args):
+    """ CalendarDiff of the previous version and the current calendar """
+    calendarfile = calendar_location(config, args)
+    if re.match(r'^https?://', calendarfile):
+        options = config["calendar"] if config.has_section("calendar") else {}
+        remote = RemoteCalendar(calendarfile, options.get("cachedir", None),
+                                float(options.get("timeout", 30)))
+        remote.read()
+        calendarfile = remote.ics_file
+    return CalendarDiff.from_files(previous, calendarfile)
+
+
+def print_diff(changes, start, end, output_format='text', out=None):
+    """ Print the changed components and the occurrences between start and
+        end they affect """
+    out = out or sys.stdout
+    if output_format not in ('text', 'jsonl'):
+        raise SystemExit(f"Format {output_format} not supported by diff")
+    new, cancelled = changes.occurrences(start.astimezone(), end.astimezone())
+    occurrences = [("new", event) for event in new]
+    occurrences.extend(("cancelled", event) for event in cancelled)
+
+    for change in changes.changes():
+        if output_format == 'jsonl':
+            out.write(json.dumps(change) + "\n")
+        else:
+            out.write(f"{change['change']:<9} {change['uid']} "
+                      f"{change['recurrence-id'] or ''}".rstrip() + "\n")
+    for kind, event in occurrences:
+        if output_format == 'jsonl':
+            out.write(json.dumps({"occurrence": kind,
+                                  "uid": str(event.get("UID", "")),
+                                  "summary": str(event.get("SUMMARY", "")),
+                                  "dtstart": str(event["DTSTART"].dt)}) + "\n")
+        else:
+            out.write(f"{kind:<9} {event['DTSTART'].dt} "
+                      f"{event.get('SUMMARY', '')}\n")
+    out.flush()
+
+
+def exchange_events(config, start_date, end_date, stream=False):
+    """ The events of the exchange sections of config for the backend.
+        Exchange expands the recurrences, so the events go to the backend as
+        they are downloaded, several mailboxes concurrently. The ics file is
+        only written if outfile is set in [exchange]. """
+    try:
+        import downloadExchange # pylint: disable=import-outside-toplevel
+    except ModuleNotFoundError as err:
+        raise ModuleNotFoundError("Install optional dependency exchangelib "
+                                  + "(pip install exchangelib)") from err
+
+    options, source_list = downloadExchange.sources(config)
+    events = itertools.chain.from_iterable(
+                 events for _, events in downloadExchange.download_sources(
+                     source_list, start_date, end_date, options=options))
+    if options.get("outfile"):
+        events = downloadExchange.write_ics(events, options["outfile"])
+    if stream == "starts":
+        return ((event["DTSTART"].dt, event) for event in events)
+    return events
+
+
+def run_profiles(profiles, args):
+    """ Run all profiles in a thread pool. A failing profile doesn't stop
+        the others. Returns the number of failed profiles. """
+    failed = []
+    # profiles sending to the same server with the same login share the
+    # connection
+    with contextlib.closing(ConnectionPool()) as connections, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_profile, config, args, args.action,
+                               connections): name
+                   for name, config in profiles}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+                if result not in (None, 0, True):
+                    raise RuntimeError(f"Returned {result}")
+                logger.info("Profile %s done", name)
+            except (Exception, SystemExit) as err: # pylint: disable=broad-exception-caught
+                logger.error("Profile %s failed: %s", name, err)
+                failed.append(name)
+    logger.info("%d profiles done, %d failed %s", len(profiles) - len(failed),
+                len(failed), sorted(failed))
+    return len(failed)
+
+
 def main():
     """ The plan main program """
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--config', '-c', default='/etc/plan.conf',
+    parser.add_argument('--config', '-c', action='append', default=None,
                         help='Directory to different config file. Default ' +
-                             'is plan.conf in same Folder as plan.py')
+                             'is /etc/plan.conf. Can be given more than ' +
+                             'once to run several profiles')
     parser.add_argument('--ics-calendar', '-i', default=None,
-                        help='Path to the ics calendar '
+                        help='Path or http(s) URL to the ics calendar '
                              '(Takes precedence over value in config)')
     # Default is no Output. Only Errors will be output.
     parser.add_argument('--verbose', '-v', action='count', default=0,
@@ -348,13 +2705,67 @@ def main():
                         help='End Date e.g. 2023-05-03. ' +
                              'Default is start-date + 1 week. ' +
                              '(00:00:00 respectively)')
+    parser.add_argument('--format', '-f', default='text',
+                        choices=ListStdout.formats,
+                        help='Output format of the list and forecast ' +
+                             'action. Default is text')
+    parser.add_argument('--period', default='week', choices=Forecast.periods,
+                        help='Forecast occurrences per day, week or month. ' +
+                             'Default is week')
+    parser.add_argument('--group-by', default=None,
+                        help='Forecast per value of this header e.g. queue')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Expand the calendar in up to this many ' +
+                             'processes, at most one per CPU, useful for ' +
+                             'long date ranges. Default is 1')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of profiles processed in parallel. ' +
+                             'Default is 4')
+    parser.add_argument('--spool', action='store_true',
+                        help='Write prepared emails/tickets to the spool ' +
+                             'directory instead of delivering them. ' +
+                             'Deliver them with the drain action')
+    parser.add_argument('--digest', action='store_true',
+                        help='One email/ticket listing all events instead ' +
+                             'of one per event')
+    parser.add_argument('--digest-by', default=None, metavar='HEADER',
+                        help='One digest per value of this header e.g. ' +
+                             'queue. Implies --digest')
+    parser.add_argument('--max-runtime', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Stop sending emails/tickets after this many ' +
+                             'seconds, the rest is spooled and sent first by ' +
+                             'the next run with --max-runtime')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        metavar='MIB',
+                        help='Keep prepared emails/tickets of this many MiB ' +
+                             'of event text in memory, spill the rest to a ' +
+                             'temporary file. Reports the peak RSS')
+    parser.add_argument('--trace', default=None,
+                        help='Append tracing spans as OpenTelemetry JSON ' +
+                             'lines to this file and report slow items')
+    parser.add_argument('--trace-sample', type=float, default=0.1,
+                        help='Fraction of the events traced, slow ones are ' +
+                             'always traced. Default is 0.1')
+    parser.add_argument('--slow', type=float, default=1.0,
+                        help='Seconds after which a traced step is slow. ' +
+                             'Default is 1.0')
+    parser.add_argument('--previous', default=None,
+                        help='Previous version of the calendar file. Only ' +
+                             'new or changed occurrences are processed')
 
     # list: List installed jobs
     # send: To call the SendEmail backend
+    # drain: Deliver what send/otrs --spool queued
+    # forecast: Number of events per period
+    # diff: Changes since the --previous calendar
+    # serve: Answer GET /occurrences?start=&end= via http
     # This list will grow with more backends
-    actions = ['version', 'list', 'send', 'otrs']
-    parser.add_argument('action', choices=actions, help="Just print the version "\
-                        "or select the desired action.")
+    actions = ['version', 'list', 'send', 'otrs', 'drain', 'forecast', 'diff',
+               'serve']
+    parser.add_argument('action', nargs='?', choices=actions,
+                        help="Just print the version or select the desired "\
+                        "action. Defaults to the action of the calendar section.")
     args = parser.parse_args()
 
     # Check if we already have a log handler
@@ -388,43 +2799,21 @@ def main():
     logger.info("Datetime utc now: %s", datetime.datetime.utcnow())
     logger.info("Datetime local time now: %s", datetime.datetime.now().astimezone())
 
-    # Read Config file with utf-8 encoding (Umlaute ä, ö, ü, ... can be read)
-    config = configparser.ConfigParser()
-    with open(args.config, mode='r', encoding='utf-8') as conf:
-        config.read_file(conf)
-        logger.debug("Read config %s", args.config)
-
-    # Get calendar location from argument
-    if args.ics_calendar:
-        calendarfile = args.ics_calendar
-    # Get calendar location from config
-    else:
-        calendarfile = config["calendar"]["calendarfile"]
-
-    with open(calendarfile, mode='r', encoding='utf-8') as calendar:
-        calendar = icalendar.Calendar.from_ical(calendar.read())
-        logger.debug("Read calendar file %s", calendarfile)
-
-    # call the function selected by action
-    backend = None
-    if args.action == 'list':
-        backend = ListStdout(None, args.dry_run)
-    if args.action == 'send':
-        backend = SendEmail({"mail":config["mail"],
-                             "headers":config["headers"]}, args.dry_run)
-    if args.action == 'otrs':
-        backend = OtrsApi({"otrs":config["otrs"],
-                           "headers":config["headers"]}, args.dry_run)
-
-    if not backend:
-        raise NameError("Action not found")
-
+    profiles = read_profiles(args.config or ['/etc/plan.conf'])
+    if args.trace:
+        tracer.configure(args.trace, args.trace_sample, args.slow)
     try:
-        wartungsplan = Wartungsplan(args.start_date, args.end_date, calendar, backend)
-
-        return wartungsplan.run_backend()
-    except Exception as err:
-        raise SystemExit(err) from err
+        if len(profiles) == 1:
+            try:
+                return run_profile(profiles[0][1], args, args.action)
+            except Exception as err:
+                raise SystemExit(err) from err
+
+        if args.ics_calendar:
+            raise SystemExit("--ics-calendar can't be used with several profiles")
+        return 1 if run_profiles(profiles, args) else 0
+    finally:
+        tracer.close()
 
 
 if __name__ == "__main__":
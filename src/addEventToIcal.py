@@ -35,13 +35,18 @@ import Wartungsplan
 
 
 def load_existing_calendar(calendar_file):
-    """ Load an existing calendar or create a new one """
-    try:
-        with open(calendar_file, 'rb') as file:
-            cal = Calendar.from_ical(file.read())
-        return cal
-    except FileNotFoundError:
-        return Calendar()
+    """ Load an existing calendar with the events of its journal or create a
+        new one """
+    journal = Wartungsplan.CalendarJournal(calendar_file)
+    with journal.lock(exclusive=False):
+        try:
+            with Wartungsplan.open_calendar(calendar_file) as file:
+                cal = Wartungsplan.parse_calendar(file.read())
+        except FileNotFoundError:
+            cal = Calendar()
+        for event in journal.events():
+            cal.add_component(event)
+    return cal
 
 
 def parse_calendar_check(calendar, start_date):
@@ -74,10 +79,10 @@ def string_to_rrule(rrule_string):
 
 
 def add_event(calendar_file, start_date, end_date, rrule, start_time,
-              end_time, duration, title, description):
-    """ Create a new event and add it to the calendar """
-    existing_cal = load_existing_calendar(calendar_file)
-
+              end_time, duration, title, description, journal=False):
+    """ Create a new event and add it to the calendar. With journal the
+        event is appended to the journal of the calendar instead of
+        rewriting it. """
     # Parse start and end dates
     start_date_str = start_date
     start_date = datetime.strptime(start_date, '%Y-%m-%d').astimezone()
@@ -103,14 +108,20 @@ def add_event(calendar_file, start_date, end_date, rrule, start_time,
     cal_event.add('description', description)
     if rrule:
         cal_event.add('rrule', string_to_rrule(rrule))
-    existing_cal.add_component(cal_event)
 
-    # Check resulting calendar
-    parse_calendar_check(existing_cal, start_date_str)
+    calendar_journal = Wartungsplan.CalendarJournal(calendar_file)
+    if journal:
+        # Check the new event only
+        new_cal = Calendar()
+        new_cal.add_component(cal_event)
+        parse_calendar_check(new_cal, start_date_str)
+        calendar_journal.append(cal_event)
+        return
 
-    # Write the updated calendar data to the file
-    with open(calendar_file, 'wb') as file:
-        file.write(existing_cal.to_ical())
+    # Check resulting calendar and write it, events in the journal are
+    # folded in
+    calendar_journal.compact([cal_event], check=lambda calendar:
+                             parse_calendar_check(calendar, start_date_str))
 
 
 def main():
@@ -130,21 +141,45 @@ def main():
                         help='End time in HH:MM format. Default is 10:00')
     parser.add_argument('--duration', default='',
                         help='HH:MM format. If set replaces --end-time')
-    parser.add_argument('--title', required=True, help='Event title')
+    parser.add_argument('--title', help='Event title')
+    parser.add_argument('--journal', action='store_true',
+                        help='Append the event to the journal of the calendar '
+                             + 'instead of rewriting it')
+    parser.add_argument('--compact', action='store_true',
+                        help='Fold the journal into the calendar, no event is '
+                             + 'added')
+    parser.add_argument('--binary', default=None, metavar='FILE',
+                        help='Also write the calendar in the binary form '
+                             + 'Wartungsplan loads fastest, e.g. plan.wpcal')
 
     args = parser.parse_args()
 
-    # Read event description from stdin
-    description = sys.stdin.read().strip()
+    if args.compact:
+        Wartungsplan.CalendarJournal(args.calendar_file).compact()
+    elif not args.title:
+        parser.error("the following arguments are required: --title")
+    else:
+        # Read event description from stdin
+        description = sys.stdin.read().strip()
+
+
+        # Add the event to the calendar
+        #print(args.calendar_file, args.start_date, args.end_date,
+        #          rrule_property, args.start_time, args.end_time,
+        #          args.duration, args.title, description)
+        add_event(args.calendar_file, args.start_date, args.end_date,
+                  args.rrule, args.start_time, args.end_time,
+                  args.duration, args.title, description, args.journal)
+
+    if args.binary:
+        write_binary(args.calendar_file, args.binary)
 
 
-    # Add the event to the calendar
-    #print(args.calendar_file, args.start_date, args.end_date,
-    #          rrule_property, args.start_time, args.end_time,
-    #          args.duration, args.title, description)
-    add_event(args.calendar_file, args.start_date, args.end_date,
-              args.rrule, args.start_time, args.end_time,
-              args.duration, args.title, description)
+def write_binary(calendar_file, binary_file):
+    """ Write the calendar with the events of its journal in binary form """
+    calendar = load_existing_calendar(calendar_file)
+    Wartungsplan.BinaryCalendar.write(calendar.walk("VEVENT"), binary_file,
+                                      calendar.get("X-WR-TIMEZONE"))
 
 if __name__ == '__main__':
     try:
@@ -31,45 +31,259 @@ A tool to download a calendar from Microsoft Exchange
 """
 
 import argparse
+import concurrent.futures
 import configparser
 import datetime
+import itertools
+import json
 import logging
+import os
+import re
 import sys
+import threading
 import dateutil.parser
 import exchangelib
 import icalendar
 
 logger = logging.getLogger(__name__)
 
+# exchangelib keeps one session pool per server and login. All mailboxes
+# using the same login share it, max_connections limits its size.
+_configurations = {}
+_configurations_lock = threading.Lock()
 
-def download(config, start_date=None, end_date=None, dry_run=False):
-    # prepare credentials for login
-    credentials = exchangelib.Credentials(config['user'],
-                                          config['password'])
-
-    xconfig = exchangelib.Configuration(server=config.get('host', 'localhost'),
-                                        credentials=credentials)
 
+def download(config, start_date=None, end_date=None, dry_run=False):
+    """ Write the events between start_date and end_date to the outfile.
+        config is an [exchange] section or a ConfigParser with several
+        exchange sections, which are downloaded concurrently. """
+    options, source_list = sources(config)
+    outfiles = {}
+    for name, source in source_list:
+        # sources without their own outfile are merged into one
+        outfile = source.get('outfile') or options.get('outfile',
+                                                       'calendar_events.ics')
+        outfiles.setdefault(outfile, []).append(name)
+
+    events = dict(download_sources(source_list, start_date, end_date,
+                                   dry_run, options))
+    for outfile, names in outfiles.items():
+        merged = itertools.chain.from_iterable(events[name] for name in names)
+        for _ in write_ics(merged, outfile):
+            pass
+        logger.info("Calendar events of %s have been exported to %s",
+                    ", ".join(names), outfile)
+
+
+def sources(config):
+    """ The common options and the (name, options) of the calendars to
+        download. A ConfigParser can have several [exchange:NAME] sections,
+        options they don't set are taken from [exchange], except outfile.
+        Without [exchange:NAME] sections [exchange] is the only source. """
+    if not isinstance(config, configparser.ConfigParser):
+        return config, [("exchange", config)]
+
+    options = config["exchange"] if config.has_section("exchange") else {}
+    source_list = []
+    for section in config.sections():
+        if not section.startswith("exchange:"):
+            continue
+        source = {key: value for key, value in options.items()
+                  if key != "outfile"}
+        source.update(config[section])
+        source_list.append((section.split(":", 1)[1], source))
+    if not source_list:
+        source_list.append(("exchange", options))
+    return options, source_list
+
+
+def download_sources(source_list, start_date=None, end_date=None,
+                     dry_run=False, options=None):
+    """ Downloads the sources concurrently. Yields (name, events) of each
+        source as soon as it is downloaded, so the total time is about
+        that of the slowest mailbox. Resolved calendar folders are cached
+        in the folder_cache file of options. """
+    options = options or {}
+    if len(source_list) == 1:
+        # a single source is streamed
+        name, source = source_list[0]
+        yield name, stream_events(source, start_date, end_date, dry_run,
+                                  options)
+        return
+
+    folders = None if dry_run else FolderCache(folder_cache_file(options))
+    workers = min(len(source_list), int(options.get('workers', 8)))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(list, iter_events(source, start_date,
+                                                     end_date, dry_run,
+                                                     folders)): name
+                       for name, source in source_list}
+            for future in concurrent.futures.as_completed(futures):
+                events = future.result()
+                logger.info("Downloaded %d events of %s", len(events),
+                            futures[future])
+                yield futures[future], events
+    finally:
+        if folders:
+            folders.save()
+
+
+def stream_events(config, start_date=None, end_date=None, dry_run=False,
+                  options=None):
+    """ iter_events with the folder cache of options """
+    folders = None
+    if not dry_run:
+        folders = FolderCache(folder_cache_file(options or config))
+    try:
+        yield from iter_events(config, start_date, end_date, dry_run, folders)
+    finally:
+        if folders:
+            folders.save()
+
+
+def folder_cache_file(options):
+    """ File with the folder IDs of the calendars found before """
+    if options.get('folder_cache'):
+        return options['folder_cache']
+    import Wartungsplan # pylint: disable=import-outside-toplevel,cyclic-import
+    return os.path.join(Wartungsplan.cache_directory(), "exchange-folders.json")
+
+
+class FolderCache:
+    """ Folder IDs of calendars by server, mailbox and calendar name, so
+        the calendar folders don't have to be walked on every run """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._changed = False
+        try:
+            with open(path, encoding='utf-8') as cache:
+                self._folders = json.load(cache)
+        except (OSError, ValueError):
+            self._folders = {}
+
+    @staticmethod
+    def key(config):
+        """ Key of the calendar of an exchange section """
+        return "|".join((config.get('host', 'localhost'), config['email'],
+                         config['calendar']))
+
+    def get(self, key):
+        """ (id, changekey) or None """
+        with self._lock:
+            folder = self._folders.get(key)
+        return tuple(folder) if folder else None
+
+    def set(self, key, folder):
+        """ Remember the folder, None forgets it """
+        with self._lock:
+            if folder is None:
+                self._changed |= self._folders.pop(key, None) is not None
+            else:
+                self._changed |= self._folders.get(key) != [folder.id,
+                                                             folder.changekey]
+                self._folders[key] = [folder.id, folder.changekey]
+
+    def save(self):
+        """ Write the cache if it changed """
+        with self._lock:
+            if not self._changed:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path + ".tmp", 'w', encoding='utf-8') as cache:
+                    json.dump(self._folders, cache)
+                os.replace(self.path + ".tmp", self.path)
+                self._changed = False
+            except OSError as err:
+                logger.warning("Folder cache %s not written: %s", self.path, err)
+
+
+def configuration(config):
+    """ The exchangelib configuration of the server and login of config.
+        It is shared, so all mailboxes with the same login use one session
+        pool of at most connections (default 4) sessions. """
+    key = (config.get('host', 'localhost'), config['user'], config['password'])
+    with _configurations_lock:
+        if key not in _configurations:
+            credentials = exchangelib.Credentials(config['user'],
+                                                  config['password'])
+            _configurations[key] = exchangelib.Configuration(
+                server=key[0], credentials=credentials,
+                max_connections=int(config.get('connections', 4)))
+        return _configurations[key]
+
+
+def find_calendar(account, name):
+    """ Walks the calendars of account for the one called name """
+    logger.debug("Walk calendars")
+    for cal_folder in account.calendar.children:
+        logger.debug("Found calendar: %s", cal_folder)
+        if str(cal_folder) == name:
+            logger.info("Found calendar: %s", cal_folder)
+            return cal_folder
+    raise FileNotFoundError(f"Calendar NOT FOUND: \"{name}\"")
+
+
+def write_ics(events, outfile):
+    """ Yields events and writes them to outfile while they pass. The file
+        is replaced only after the last event. An outfile ending in .wpcal
+        gets the binary form Wartungsplan loads fastest, .gz and .xz are
+        compressed. """
+    # Wartungsplan imports this module to read Exchange calendars
+    import Wartungsplan # pylint: disable=import-outside-toplevel,cyclic-import
+    if re.search(r'\.wpcal(\.gz|\.xz)?$', outfile):
+        written = []
+        for event in events:
+            written.append(event)
+            yield event
+        Wartungsplan.BinaryCalendar.write(written, outfile)
+        return
+
+    begin, end = icalendar.Calendar().to_ical().splitlines(keepends=True)
+    tmpfile = outfile + ".tmp"
+    try:
+        with Wartungsplan.open_calendar(tmpfile, 'wb', outfile) as f:
+            f.write(begin)
+            for event in events:
+                f.write(event.to_ical())
+                yield event
+            f.write(end)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+    os.replace(tmpfile, outfile)
+
+
+def iter_events(config, start_date=None, end_date=None, dry_run=False,
+                folders=None):
+    """ Yields the events between start_date and end_date. Recurrences are
+        already expanded by the server. folders is a FolderCache for the
+        calendar folder. """
     if not dry_run:
         # Connect to the Exchange server
         account = exchangelib.Account(
             primary_smtp_address=config['email'],
-            config=xconfig,
+            config=configuration(config),
             autodiscover=False,
             access_type=exchangelib.DELEGATE,
         )
 
-        selected_calendar = None
+        cached = None
         if config.get('calendar', None):
-            # walk calendars
-            logger.debug("Walk calendars")
-            for cal_folder in account.calendar.children:
-                logger.debug("Found calendar: %s", cal_folder)
-                if str(cal_folder) == config.get('calendar', 'Calendar'):
-                    logger.info("Found calendar: %s", cal_folder)
-                    selected_calendar = cal_folder
-            if not selected_calendar:
-                raise FileNotFoundError(f"Calendar NOT FOUND: \"{cal_folder}\"")
+            if folders:
+                cached = folders.get(folders.key(config))
+            if cached:
+                logger.debug("Use cached calendar folder %s", cached[0])
+                selected_calendar = exchangelib.FolderCollection(
+                    account=account, folders=[exchangelib.folders.Calendar(
+                        id=cached[0], changekey=cached[1])])
+            else:
+                selected_calendar = find_calendar(account, config['calendar'])
+                if folders:
+                    folders.set(folders.key(config), selected_calendar)
         else:
             # use default calendar
             selected_calendar = account.calendar
@@ -103,16 +317,29 @@ def download(config, start_date=None, end_date=None, dry_run=False):
     # icalendar.Event['rrule'] are not in any way compatible or translate
     # meaningfully.
     if not dry_run:
-        calendar_items = selected_calendar.view(start=start, end=end)
+        try:
+            calendar_items = iter(selected_calendar.view(start=start, end=end))
+            first = next(calendar_items, None)
+        except (exchangelib.errors.ErrorFolderNotFound,
+                exchangelib.errors.ErrorItemNotFound,
+                exchangelib.errors.ErrorInvalidIdMalformed):
+            if not cached:
+                raise
+            # the calendar was moved or recreated
+            logger.info("Cached calendar folder is gone, walk calendars")
+            folders.set(folders.key(config), None)
+            selected_calendar = find_calendar(account, config['calendar'])
+            folders.set(folders.key(config), selected_calendar)
+            calendar_items = iter(selected_calendar.view(start=start, end=end))
+            first = next(calendar_items, None)
+        if first is not None:
+            calendar_items = itertools.chain([first], calendar_items)
     else:
         calendar_items = [exchangelib.CalendarItem(subject="foo1", start=start, end=end),
                           exchangelib.CalendarItem(subject="foo2", start=start, end=end),
                           exchangelib.CalendarItem(subject="bar1", start=start, end=end)]
 
-    # Create a new iCalendar object
-    ical = icalendar.Calendar()
-
-    # Iterate through each calendar item and add it to the iCalendar object
+    # Iterate through each calendar item and convert it to an iCalendar event
     # ATTENTION!! Only summary, start, end, and description are copied
     for item in calendar_items:
         logger.debug("Read item: %s, %s, %s", item.subject, item.start, item.end)
@@ -123,14 +350,7 @@ def download(config, start_date=None, end_date=None, dry_run=False):
         event.add('description', item.body)
         # Add more properties as needed, such as location, attendees, etc.
 
-        ical.add_component(event)
-
-    # Save the iCalendar object to a file
-    with open(config.get('outfile', 'calendar_events.ics'), 'wb') as f:
-        f.write(ical.to_ical())
-
-    logger.info("Calendar events have been exported to %s",
-                config.get('outfile', 'calendar_events.ics'))
+        yield event
 
 
 def main():
@@ -175,7 +395,6 @@ def main():
     else:
         with open(args.config, mode='r', encoding='utf-8') as conf:
             config.read_file(conf)
-            config = config['exchange']
             logger.debug("Read config %s", args.config)
 
         return download(config, args.start_date, args.end_date)
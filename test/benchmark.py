@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+###############################################################################
+#                                                                             #
+# Benchmarks Wartungspläne CLI Tool                                           #
+#                                                                             #
+# benchmark.py                                                                #
+###############################################################################
+#                                                                             #
+# Copyright (C) 2016-2024 science + computing ag                              #
+#                                                                             #
+# This program is free software: you can redistribute it and/or modify        #
+# it under the terms of the GNU General Public License as published by        #
+# the Free Software Foundation, either version 3 of the License, or (at       #
+# your option) any later version.                                             #
+#                                                                             #
+# This program is distributed in the hope that it will be useful, but         #
+# WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU           #
+# General Public License for more details.                                    #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                             #
+###############################################################################
+
+""" Benchmarks for Wartungsplan. Results are printed as JSON lines to be
+    comparable across releases. """
+
+import argparse
+import base64
+import configparser
+import contextlib
+import datetime
+import functools
+import http.server
+import json
+import logging
+import os
+import random
+import smtplib
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import icalendar
+
+# Add Wartungsplan to PYTHONPATH
+TESTSDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(TESTSDIR))
+
+from src import Wartungsplan
+
+
+def generate_calendar(past_events, window_events, window_start,
+                      recurring=0):
+    """ A calendar with past_events single events in the years before
+        window_start, window_events single events in the week of
+        window_start and recurring daily events """
+    cal = icalendar.Calendar()
+    cal.add('prodid', '-//Wartungsplan benchmark//')
+    cal.add('version', '2.0')
+    for number in range(past_events):
+        start = window_start - datetime.timedelta(days=30 + number % 3000,
+                                                  minutes=number)
+        cal.add_component(make_event(f"past-{number}", start))
+    for number in range(window_events):
+        start = window_start + datetime.timedelta(hours=number % 160)
+        cal.add_component(make_event(f"hit-{number}", start))
+    for number in range(recurring):
+        start = window_start - datetime.timedelta(days=365, minutes=number)
+        cal.add_component(make_event(f"daily-{number}", start,
+                                     {'freq': 'DAILY'}))
+    return cal
+
+
+def make_event(uid, start, rrule=None):
+    """ One event with a header and some text """
+    event = icalendar.Event()
+    event.add('uid', uid)
+    event.add('summary', f"Maintenance {uid}")
+    event.add('dtstart', start)
+    event.add('dtend', start + datetime.timedelta(minutes=30))
+    event.add('description', f"queue: Ops{len(uid) % 4}\n"
+                             f"priority: {len(uid) % 5 + 1} normal\n\n"
+                             "Check the backups. " * 20)
+    if rrule:
+        event.add('rrule', rrule)
+    return event
+
+
+def timed(function, *args):
+    """ Returns (seconds, result) of function(*args) """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_index(sizes, hits=10):
+    """ Parse time of the full file versus the index for growing files with
+        a constant number of events in the window """
+    window_start = datetime.datetime(2024, 6, 3, 8, 0)
+    window = Wartungsplan.parse_date_range("2024-06-03", "2024-06-10")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "calendar.ics")
+            with open(path, 'wb') as ics:
+                ics.write(generate_calendar(size, hits, window_start).to_ical())
+
+            def full_parse():
+                with open(path, 'rb') as ics:
+                    return icalendar.Calendar.from_ical(ics.read())
+
+            index = Wartungsplan.CalendarIndex(path, tmp)
+            full, _ = timed(full_parse)
+            build, _ = timed(index.read, *window)
+            indexed, cal = timed(index.read, *window)
+            yield {"benchmark": "index", "events": size + hits, "hits": hits,
+                   "parsed": len(cal.walk("VEVENT")),
+                   "full_parse_s": round(full, 4),
+                   "index_build_s": round(build, 4),
+                   "index_read_s": round(indexed, 4)}
+
+
+def bench_diff(sizes, changes=10):
+    """ Diff of two versions of growing calendars with a constant number of
+        changed events """
+    window_start = datetime.datetime(2024, 6, 3, 8, 0)
+    start, end = Wartungsplan.parse_date_range("2024-06-03", "2024-06-10")
+    for size in sizes:
+        cal = generate_calendar(size, 0, window_start)
+        old = cal.to_ical()
+        for number in range(changes):
+            cal.add_component(make_event(f"hit-{number}", window_start))
+            cal.subcomponents[number]["summary"] = "Changed"
+        new = cal.to_ical()
+
+        seconds, diff = timed(Wartungsplan.CalendarDiff, old, new)
+        occurrences, (added, cancelled) = timed(diff.occurrences,
+                                                start.astimezone(),
+                                                end.astimezone())
+        yield {"benchmark": "diff", "events": size, "added": len(diff.added),
+               "modified": len(diff.modified), "new": len(added),
+               "cancelled": len(cancelled), "diff_s": round(seconds, 4),
+               "occurrences_s": round(occurrences, 4)}
+
+
+def bench_binary(sizes):
+    """ Load time of the binary form versus parsing the ics file, for the
+        Outlook fixture and growing generated calendars """
+    with open(os.path.join(TESTSDIR, "test-data",
+                           "OutlookCalendar-2023-10-06.ics"), 'rb') as ics:
+        calendars = [("outlook", ics.read())]
+    window_start = datetime.datetime(2024, 6, 3, 8, 0)
+    calendars.extend((size, generate_calendar(size, 0, window_start).to_ical())
+                     for size in sizes)
+    for name, ics in calendars:
+        parse, cal = timed(icalendar.Calendar.from_ical, ics)
+        binary = Wartungsplan.BinaryCalendar.dumps(cal.walk("VEVENT"))
+        load, _ = timed(Wartungsplan.BinaryCalendar.loads, binary)
+        yield {"benchmark": "binary", "calendar": name,
+               "events": len(cal.walk("VEVENT")), "ics_bytes": len(ics),
+               "binary_bytes": len(binary), "parse_s": round(parse, 4),
+               "load_s": round(load, 4), "speedup": round(parse / load, 1)}
+
+
+def bench_forecast(rules, years=3):
+    """ Forecast over years for daily rules, counting only the start times
+        versus expanding every occurrence """
+    cal = generate_calendar(0, 0, datetime.datetime(2024, 1, 1),
+                            recurring=rules)
+    end = f"{2024 + years}-01-01"
+    backend = Wartungsplan.Forecast(None, False, 'month', 'queue')
+
+    def count(stream):
+        plan = Wartungsplan.Wartungsplan("2024-01-01", end, cal, backend,
+                                         stream=stream)
+        if stream == "starts":
+            return backend.count(plan.events)
+        return backend.count((event["DTSTART"].dt, event)
+                             for event in plan.events)
+
+    starts, counts = timed(count, "starts")
+    expanded, _ = timed(count, True)
+    yield {"benchmark": "forecast", "rules": rules, "years": years,
+           "occurrences": sum(counts.values()),
+           "starts_s": round(starts, 4), "expanded_s": round(expanded, 4)}
+
+
+def bench_sharded(rules, jobs):
+    """ One year of daily rules expanded in one and in several processes """
+    cal = generate_calendar(0, 0, datetime.datetime(2024, 1, 1),
+                            recurring=rules)
+    start, end = Wartungsplan.parse_date_range("2024-01-01", "2025-01-01")
+    start, end = start.astimezone(), end.astimezone()
+    for number in jobs:
+        if number <= 1:
+            seconds, events = timed(
+                Wartungsplan.recurring_ical_events.of(cal).between, start, end)
+        else:
+            seconds, events = timed(Wartungsplan.expand_sharded, cal, start,
+                                    end, number)
+        yield {"benchmark": "sharded", "rules": rules, "jobs": number,
+               "occurrences": len(events), "seconds": round(seconds, 4),
+               "cpus": os.cpu_count()}
+
+
+class StandIn:
+    """ Fault injection shared by the server stand-ins: every request waits
+        latency seconds, error_rate of them fail and more than throttle
+        requests per second are refused (SMTP closes the connection) """
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.accepted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._random = random.Random(0)
+        self._recent = []
+        self._lock = threading.Lock()
+
+    def outcome(self):
+        """ Returns "ok", "error" or "throttled" for one request """
+        time.sleep(self.latency)
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [stamp for stamp in self._recent if now - stamp < 1]
+            if self.throttle and len(self._recent) >= self.throttle:
+                self.throttled += 1
+                return "throttled"
+            self._recent.append(now)
+            if self._random.random() < self.error_rate:
+                self.rejected += 1
+                return "error"
+            self.accepted += 1
+            return "ok"
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """ Just enough SMTP for smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA """
+
+    def reply(self, line):
+        """ Send one reply line """
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        standin = self.server.standin
+        self.reply("220 standin ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-standin")
+                self.reply("250 AUTH PLAIN")
+            elif command == b"AUTH":
+                base64.b64decode(line.split()[-1])
+                self.reply("235 2.7.0 Authentication successful")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                outcome = standin.outcome()
+                if outcome == "throttled":
+                    self.reply("421 4.7.0 Too many messages, closing")
+                    return
+                if outcome == "error":
+                    self.reply("451 4.3.0 Injected error")
+                else:
+                    self.reply("250 2.0.0 Ok")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 Ok")
+
+
+class OTRSHandler(http.server.BaseHTTPRequestHandler):
+    """ The routes of the GenericTicketConnectorREST used by pyotrs """
+    prefix = ("/otrs/nph-genericinterface.pl/Webservice/"
+              "GenericTicketConnectorREST")
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def answer(self, status, data):
+        """ Send data as JSON """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ SessionGet: no session is valid, pyotrs creates a new one """
+        self.answer(200, {"Error": {"ErrorCode": "SessionGet.SessionInvalid",
+                                    "ErrorMessage": "Session invalid"}})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """ AccessTokenCreate and TicketCreate """
+        standin = self.server.standin
+        request = json.loads(self.rfile.read(
+            int(self.headers["Content-Length"])))
+        if self.path == self.prefix + "/Session":
+            self.answer(200, {"AccessToken": "standin"})
+            return
+        outcome = standin.outcome()
+        if outcome == "throttled":
+            self.answer(429, {})
+        elif outcome == "error":
+            self.answer(200, {"Error": {"ErrorCode": "TicketCreate.Injected",
+                                        "ErrorMessage": "Injected error"}})
+        else:
+            number = standin.accepted
+            self.answer(200, {"TicketID": str(number),
+                              "ArticleID": str(number),
+                              "TicketNumber": f"2024060310{number:06d}",
+                              "Title": request["Ticket"]["Title"]})
+
+
+def serve(server):
+    """ Serve in a daemon thread, returns the port """
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+
+def percentile(values, percent):
+    """ Nearest rank percentile of values in milliseconds """
+    if not values:
+        return None
+    ranked = sorted(values)
+    index = max(0, -(-len(ranked) * percent // 100) - 1)
+    return round(ranked[int(index)] * 1000, 2)
+
+
+def recording(durations, failures, function):
+    """ Wraps a delivery function to record its duration and failures """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            failures.append(time.perf_counter() - start)
+            raise
+        if result is False:
+            failures.append(time.perf_counter() - start)
+        else:
+            durations.append(time.perf_counter() - start)
+        return result
+    return wrapper
+
+
+def bench_backend(kind, events, latency, error_rate, throttle, spooled,
+                  digest=None, memory_budget=None):
+    """ Deliver events through SendEmail or OtrsApi to a local stand-in of
+        the server. Without spool the first failure aborts the run, with
+        spool failed deliveries are retried by drain """
+    standin = StandIn(latency, error_rate, throttle)
+    config = configparser.ConfigParser()
+    config["headers"] = {"queue": "Misc"}
+    window_start = datetime.datetime(2024, 6, 3, 8, 0)
+    cal = generate_calendar(0, events, window_start)
+    durations, failures = [], []
+
+    with tempfile.TemporaryDirectory() as tmp, \
+         contextlib.ExitStack() as stack:
+        if kind == "smtp":
+            server = socketserver.ThreadingTCPServer(("127.0.0.1", 0),
+                                                     SMTPHandler)
+            config["mail"] = {"server": "127.0.0.1", "port": str(serve(server)),
+                              "ssl": "no", "sender": "wartungsplan@localhost",
+                              "password": "secret",
+                              "recipient": "ops@localhost"}
+            backend = Wartungsplan.SendEmail(config, False)
+            stack.enter_context(mock.patch.object(
+                smtplib.SMTP, "send_message",
+                recording(durations, failures, smtplib.SMTP.send_message)))
+        else:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                     OTRSHandler)
+            config["otrs"] = {"server": f"http://127.0.0.1:{serve(server)}",
+                              "username": "wartungsplan",
+                              "password": "secret"}
+            backend = Wartungsplan.OtrsApi(config, False)
+            client = Wartungsplan.pyotrs.Client
+            stack.enter_context(mock.patch.object(
+                Wartungsplan.pyotrs, "Client", functools.partial(
+                    client, session_id_file=os.path.join(tmp, "session"))))
+            stack.enter_context(mock.patch.object(
+                client, "ticket_create",
+                recording(durations, failures, client.ticket_create)))
+        server.standin = standin
+        stack.callback(server.server_close)
+        stack.callback(server.shutdown)
+
+        backend.digest = digest
+        if memory_budget is not None:
+            backend.memory_budget = int(memory_budget * 2**20)
+        spool = Wartungsplan.Spool(os.path.join(tmp, "spool"))
+        if spooled:
+            backend.spool = spool
+        plan = Wartungsplan.Wartungsplan("2024-06-03", "2024-06-10", cal,
+                                         backend)
+        aborted = None
+        start = time.perf_counter()
+        try:
+            plan.run_backend()
+            left = backend.drain(spool, retries=3, backoff=0.01)
+        except Exception as err: # pylint: disable=broad-exception-caught
+            aborted = type(err).__name__
+            left = None
+        seconds = time.perf_counter() - start
+
+    return [{"benchmark": kind, "events": events, "latency_s": latency,
+             "error_rate": error_rate, "throttle": throttle,
+             "spool": spooled, "digest": digest,
+             "delivered": standin.accepted,
+             "rejected": standin.rejected, "throttled": standin.throttled,
+             "aborted": aborted, "undelivered": left,
+             "failed_calls": len(failures), "seconds": round(seconds, 4),
+             "per_second": round(standin.accepted / seconds, 1),
+             "p50_ms": percentile(durations, 50),
+             "p99_ms": percentile(durations, 99),
+             "memory_budget_mib": memory_budget,
+             "spilled": backend.spilled[0],
+             "spilled_bytes": backend.spilled[1],
+             "peak_rss_mib": round(Wartungsplan.peak_rss() / 2**20, 1)}]
+
+
+def backend_benchmark(kind):
+    """ bench_backend with the command line arguments """
+    return lambda args: bench_backend(kind, args.events, args.latency,
+                                      args.error_rate, args.throttle,
+                                      args.spool, args.digest,
+                                      args.memory_budget)
+
+
+BENCHMARKS = {
+    "index": lambda args: bench_index(args.sizes),
+    "diff": lambda args: bench_diff(args.sizes),
+    "binary": lambda args: bench_binary(args.sizes),
+    "forecast": lambda args: bench_forecast(args.rules),
+    "sharded": lambda args: bench_sharded(args.rules, args.jobs),
+    "smtp": backend_benchmark("smtp"),
+    "otrs": backend_benchmark("otrs"),
+}
+
+
+def main():
+    """ Run the selected benchmarks """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', nargs='*', default=sorted(BENCHMARKS),
+                        choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 5000, 20000],
+                        help='Number of events in generated calendars')
+    parser.add_argument('--rules', type=int, default=100,
+                        help='Number of daily rules in generated calendars')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4],
+                        help='Number of processes to compare')
+    parser.add_argument('--events', type=int, default=200,
+                        help='Number of events delivered by smtp and otrs')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the stand-in servers wait per request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests the stand-ins reject')
+    parser.add_argument('--throttle', type=int, default=0,
+                        help='Requests per second the stand-ins accept, '
+                             '0: no limit')
+    parser.add_argument('--spool', action='store_true',
+                        help='Deliver through the spool with retries')
+    parser.add_argument('--digest', default=None, metavar='HEADER',
+                        help='Deliver one digest per value of this header, '
+                             'e.g. queue')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        metavar='MIB',
+                        help='MiB of event text smtp and otrs keep in '
+                             'memory before spilling to disk')
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+
+    for benchmark in args.benchmark:
+        for result in BENCHMARKS[benchmark](args):
+            result["version"] = Wartungsplan.importlib.metadata.version('Wartungsplan')
+            result["python"] = sys.version.split()[0]
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
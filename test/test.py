@@ -27,13 +27,30 @@
 
 """ Test suite for a tool than opens recurring tickets """
 
+import collections
+import concurrent.futures
+import configparser
+import csv
+import datetime
+import gzip
+import http.server
+import io
+import json
 import logging
+import lzma
 import os
 import sys
+import threading
+import time
 import unittest
 import tempfile
 import warnings
+from unittest import mock
+import exchangelib
 import icalendar
+import pytz
+import recurring_ical_events
+import requests
 
 # Add Wartungsplan to PYTHONPATH
 TESTSDIR = os.path.dirname(os.path.abspath(__file__))
@@ -136,6 +153,188 @@ class TestWartungsplan(unittest.TestCase):
             self.assertEqual(wp.run_backend(), 3)
 
 
+class TestListStdout(unittest.TestCase):
+    """ Test the list backend and its output formats """
+    @classmethod
+    def setUpClass(cls):
+        p = os.path.join(TESTSDIR, "test-data", "EveryDayExcept-2023-09-26.ics")
+        with open(p, encoding='utf-8') as c:
+            cls.cal = icalendar.Calendar.from_ical(c.read())
+
+    def list_events(self, output_format):
+        """ Output of the list backend for three days """
+        out = io.StringIO()
+        b = Wartungsplan.ListStdout(None, False, output_format, out)
+        wp = Wartungsplan.Wartungsplan("2023-09-25", "2023-09-28", self.cal, b,
+                                       stream=True)
+        wp.run_backend()
+        return out.getvalue()
+
+    def test_stream_matches_between(self):
+        """ Streamed expansion yields the same events """
+        for name in os.listdir(os.path.join(TESTSDIR, "test-data")):
+            with open(os.path.join(TESTSDIR, "test-data", name), 'rb') as c:
+                cal = icalendar.Calendar.from_ical(c.read())
+            start, end = Wartungsplan.parse_date_range("2023-05-01", "2023-10-10")
+            self.assertEqual(
+                sorted(e.to_ical() for e in Wartungsplan.iter_occurrences(
+                    cal, start.astimezone(), end.astimezone())),
+                sorted(e.to_ical() for e in recurring_ical_events.of(cal).between(
+                    start.astimezone(), end.astimezone())))
+
+    def test_order(self):
+        """ The text output lists series by series, the occurrences of a
+            series by start """
+        cal = icalendar.Calendar()
+        for uid, hour in (("late", 10), ("early", 8)):
+            event = icalendar.Event()
+            event.add('uid', uid)
+            event.add('summary', uid)
+            event.add('dtstart', datetime.datetime(2023, 9, 25, hour))
+            event.add('dtend', datetime.datetime(2023, 9, 25, hour, 30))
+            event.add('rrule', {'freq': 'DAILY'})
+            cal.add_component(event)
+        moved = icalendar.Event()
+        moved.add('uid', 'late')
+        moved.add('summary', 'late moved')
+        moved.add('recurrence-id', datetime.datetime(2023, 9, 26, 10))
+        moved.add('dtstart', datetime.datetime(2023, 9, 25, 9))
+        moved.add('dtend', datetime.datetime(2023, 9, 25, 9, 30))
+        cal.add_component(moved)
+
+        out = io.StringIO()
+        b = Wartungsplan.ListStdout(None, False, 'text', out)
+        Wartungsplan.Wartungsplan("2023-09-25", "2023-09-27", cal, b,
+                                  stream=True).run_backend()
+        lines = out.getvalue().splitlines()
+        self.assertEqual([(summary, start[:16]) for summary, start in
+                          zip(lines[::5], lines[2::5])],
+                         [("late moved", "2023-09-25 09:00"),
+                          ("late", "2023-09-25 10:00"),
+                          ("early", "2023-09-25 08:00"),
+                          ("early", "2023-09-26 08:00")])
+
+    def test_formats(self):
+        """ Every format has one record per occurrence """
+        self.assertEqual(self.list_events('text').count('-----\n'), 2)
+
+        lines = self.list_events('jsonl').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[1])["dtstart"], "2023-09-27T17:30:00+02:00")
+
+        rows = list(csv.DictReader(io.StringIO(self.list_events('csv'))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["summary"], "Every day except for 26.09.2023")
+
+        cal = icalendar.Calendar.from_ical(self.list_events('ics'))
+        self.assertEqual(len(cal.walk("VEVENT")), 2)
+
+
+class TestForecast(unittest.TestCase):
+    """ Test counting occurrences per period """
+    def test_starts_match_between(self):
+        """ Counting start times gives the same result as expanding """
+        hourly = icalendar.Event()
+        hourly.add('uid', 'hourly')
+        hourly.add('sequence', 2)
+        hourly.add('dtstart', datetime.datetime(2023, 9, 1, 10))
+        hourly.add('rrule', {'freq': 'HOURLY', 'count': 30})
+        hourly_cal = icalendar.Calendar()
+        hourly_cal.add_component(hourly)
+        cals = [hourly_cal]
+        for name in os.listdir(os.path.join(TESTSDIR, "test-data")):
+            with open(os.path.join(TESTSDIR, "test-data", name), 'rb') as c:
+                cals.append(icalendar.Calendar.from_ical(c.read()))
+        start, end = Wartungsplan.parse_date_range("2023-05-01", "2023-10-10")
+        start, end = start.astimezone(), end.astimezone()
+        for cal in cals:
+            self.assertEqual(
+                sorted(str(s) for s, _ in Wartungsplan.iter_occurrence_starts(
+                    cal, start, end)),
+                sorted(str(e["DTSTART"].dt) for e in
+                       recurring_ical_events.of(cal).between(start, end)))
+
+    def test_starts_of_rule_sets(self):
+        """ RRULE, RDATE, EXDATE and moved occurrences give the same starts
+            and counts as between() """
+        berlin = pytz.timezone("Europe/Berlin")
+        def local(day, hour=9):
+            return berlin.localize(datetime.datetime(2024, 3, day, hour))
+        weekly = icalendar.Event()
+        weekly.add("uid", "weekly")
+        weekly.add("dtstart", local(4))
+        weekly.add("dtend", local(4, 10))
+        weekly.add("rrule", {"freq": "weekly", "byday": ["mo", "th"],
+                             "until": datetime.datetime(2024, 4, 22, 8,
+                                                        tzinfo=pytz.utc)})
+        weekly.add("exdate", [local(7)])
+        weekly.add("exdate", [datetime.date(2024, 3, 14)])
+        weekly.add("rdate", [local(16, 12)])
+        moved_in = icalendar.Event()
+        moved_in.add("uid", "weekly")
+        moved_in.add("recurrence-id", local(11))
+        moved_in.add("dtstart", local(12, 14))
+        moved_in.add("dtend", local(12, 15))
+        moved_out = icalendar.Event()
+        moved_out.add("uid", "weekly")
+        moved_out.add("recurrence-id", local(18))
+        moved_out.add("dtstart", berlin.localize(datetime.datetime(2024, 6, 1, 9)))
+        moved_out.add("dtend", berlin.localize(datetime.datetime(2024, 6, 1, 10)))
+        whole_days = icalendar.Event()
+        whole_days.add("uid", "whole days")
+        whole_days.add("dtstart", datetime.date(2024, 2, 28))
+        whole_days.add("dtend", datetime.date(2024, 2, 29))
+        whole_days.add("rrule", {"freq": "daily", "count": 40})
+        whole_days.add("exdate", [datetime.date(2024, 3, 3)])
+        calendar = icalendar.Calendar()
+        for event in (weekly, moved_in, moved_out, whole_days):
+            calendar.add_component(event)
+
+        for first, last in (("2024-03-01", "2024-05-01"),
+                            ("2024-03-12", "2024-03-31"),
+                            ("2024-03-29", "2024-04-02")):
+            start, end = Wartungsplan.parse_date_range(first, last)
+            start, end = start.astimezone(), end.astimezone()
+            starts = sorted(str(s) for s, _ in
+                            Wartungsplan.iter_occurrence_starts(calendar,
+                                                                start, end))
+            expanded = recurring_ical_events.of(calendar).between(start, end)
+            self.assertEqual(len(starts), len(expanded), first)
+            self.assertEqual(starts, sorted(str(e["DTSTART"].dt)
+                                            for e in expanded), first)
+
+    def test_count_per_week(self):
+        """ Starts counted by day are folded into ISO weeks, for dates and
+            datetimes of several series """
+        b = Wartungsplan.Forecast(None, False, 'week')
+        first, second = icalendar.Event(), icalendar.Event()
+        berlin = pytz.timezone("Europe/Berlin")
+        starts = [(datetime.date(2024, 12, 29), first),
+                  (datetime.date(2024, 12, 30), first),
+                  (berlin.localize(datetime.datetime(2024, 12, 31, 23)), second),
+                  (berlin.localize(datetime.datetime(2025, 1, 6, 0, 30)), second),
+                  (datetime.date(2025, 1, 5), first)]
+        self.assertEqual(b.count(starts), {("2024-W52", ""): 1,
+                                           ("2025-W01", ""): 3,
+                                           ("2025-W02", ""): 1})
+
+    def test_count_by_header(self):
+        """ Counts per month and queue header, header default from config """
+        p = os.path.join(TESTSDIR, "test-data", "EveryDayWithHeavyHTML.ics")
+        with open(p, encoding='utf-8') as c:
+            cal = icalendar.Calendar.from_ical(c.read())
+        out = io.StringIO()
+        b = Wartungsplan.Forecast({"headers": {"queue": "Misc"}}, False,
+                                  'month', 'queue', 'csv', out)
+        with warnings.catch_warnings(record=True):
+            Wartungsplan.Wartungsplan("2023-06-01", "2023-08-01", cal, b,
+                                      stream="starts").run_backend()
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows, [["period", "queue", "count"],
+                                ["2023-06", "Misc", "30"],
+                                ["2023-07", "Misc", "31"]])
+
+
 class TestSendEmail(unittest.TestCase):
     """ Test the SendEmail backend """
     def test_split_message(self):
@@ -171,6 +370,210 @@ Kind creature,"""
         self.assertEqual(len(text.split('\n')), 2)
 
 
+    def test_ssl(self):
+        """ SMTP over SSL unless ssl is off, in plain dicts too """
+        for ssl, plain in ((None, False), ("yes", False), (True, False),
+                           ("no", True), ("False", True), (False, True)):
+            config = {"mail": {"server": "smtp.example.com", "port": 25,
+                               "sender": "a@example.com", "password": ""}}
+            if ssl is not None:
+                config["mail"]["ssl"] = ssl
+            with mock.patch.object(Wartungsplan.smtplib, "SMTP") as smtp, \
+                 mock.patch.object(Wartungsplan.smtplib, "SMTP_SSL") as smtp_ssl:
+                smtp.return_value.sock = mock.Mock(spec=["getpeername"])
+                Wartungsplan.SendEmail(config)._connect()
+            self.assertEqual(smtp.called, plain, ssl)
+            self.assertEqual(smtp_ssl.called, not plain, ssl)
+
+
+    def test_connection_closed(self):
+        """ run_backend() quits its SMTP session, a shared pool stays open
+            for the other profiles """
+        config = {"mail": {"server": "smtp.example.com", "port": 465,
+                           "sender": "a@example.com", "recipient": "b@example.com",
+                           "password": ""}, "headers": {}}
+        p = os.path.join(TESTSDIR, "test-data", "Every2ndTuesday-2023-05-02.ics")
+        with open(p, 'rb') as c:
+            cal = icalendar.Calendar.from_ical(c.read())
+        with mock.patch.object(Wartungsplan.smtplib, "SMTP_SSL") as smtp_ssl:
+            smtp_ssl.return_value.sock = mock.Mock(spec=["getpeername"])
+            smtp = smtp_ssl.return_value
+            b = Wartungsplan.SendEmail(config)
+            Wartungsplan.Wartungsplan("2023-05-02", "2023-06-06", cal,
+                                      b).run_backend()
+            self.assertEqual(smtp.send_message.call_count, 2)
+            smtp.quit.assert_called_once()
+            self.assertIsNone(b.connections)
+
+            smtp.reset_mock()
+            b.connections = Wartungsplan.ConnectionPool()
+            Wartungsplan.Wartungsplan("2023-05-02", "2023-06-06", cal,
+                                      b).run_backend()
+            self.assertEqual(smtp.send_message.call_count, 2)
+            smtp.quit.assert_not_called()
+            b.connections.close()
+            smtp.quit.assert_called_once()
+
+class TestDigest(unittest.TestCase):
+    """ Test combining the events into digests """
+    def setUp(self):
+        self.events = []
+        for day, queue, summary in ((5, "Ops1", "Backup"), (3, "Ops2", "Patch"),
+                                    (4, "Ops1", "Reboot")):
+            self.events.append(icalendar.Event({
+                "summary": summary,
+                "dtstart": icalendar.vDDDTypes(datetime.datetime(2024, 6, day, 8)),
+                "description": f"Queue: {queue}\nPriority: 3 normal\n\n"
+                               f"Do the {summary}\nand check it"}))
+
+    def test_email_per_queue(self):
+        """ One email per queue listing its events by start """
+        config = {"mail": {"sender": "a@example.com", "recipient": "b@example.com"},
+                  "headers": {"queue": "Misc", "priority": "1 very low"}}
+        b = Wartungsplan.SendEmail(config, True)
+        b.digest = "Queue"
+        sent = []
+        with mock.patch.object(b, "_perform_action", sent.extend):
+            b.act(self.events)
+        # the digest with the earliest event first
+        self.assertEqual([msg["Subject"] for msg in sent],
+                         ["1 task for Ops2", "2 tasks for Ops1"])
+        self.assertEqual(sent[1]["queue"], "Ops1")
+        self.assertEqual(sent[1]["priority"], "3 normal")
+        body = sent[1].get_content()
+        self.assertLess(body.index("Reboot"), body.index("Backup"))
+        self.assertIn("  Do the Backup\n  and check it", body)
+
+    def test_one_ticket(self):
+        """ Without header everything goes into one ticket """
+        config = {"otrs": {}, "headers": {"queue": "Misc"}}
+        b = Wartungsplan.OtrsApi(config, True)
+        b.digest = ""
+        tickets = []
+        with mock.patch.object(b, "_perform_action", tickets.extend):
+            b.act(self.events)
+        self.assertEqual(len(tickets), 1)
+        ticket, article = tickets[0]
+        self.assertEqual(ticket.to_dct()["Ticket"]["Title"], "3 tasks")
+        # the queues differ, the configured one is used
+        self.assertEqual(ticket.to_dct()["Ticket"]["Queue"], "Misc")
+        self.assertEqual(article.to_dct()["Body"].count("* 2024-06-0"), 3)
+
+
+class TestProfiles(unittest.TestCase):
+    """ Test running several profiles in one process """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.tmp.name, "plan.conf")
+        data = os.path.join(TESTSDIR, "test-data")
+        with open(self.config, 'w', encoding='utf-8') as conf:
+            conf.write(f"""[calendar]
+calendarfile = {data}/Every2ndTuesday-2023-05-02.ics
+
+[mail]
+server = smtp.example.com
+port = 465
+password = secret
+sender = wartungsplan@example.com
+recipient = team0@example.com
+
+[headers]
+X-Priority = 3
+
+[calendar:team1]
+
+[calendar:team2]
+calendarfile = {data}/EveryDayExcept-2023-09-26.ics
+[mail:team2]
+recipient = team2@example.com
+
+[calendar:broken]
+calendarfile = {data}/does-not-exist.ics
+""")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_profiles(self):
+        """ Profile sections override the common sections """
+        profiles = dict(Wartungsplan.read_profiles([self.config]))
+        self.assertEqual(len(profiles), 3)
+        team1 = profiles[self.config + ":team1"]
+        team2 = profiles[self.config + ":team2"]
+        self.assertTrue(team1["calendar"]["calendarfile"].endswith("Tuesday-2023-05-02.ics"))
+        self.assertEqual(team1["mail"]["recipient"], "team0@example.com")
+        self.assertTrue(team2["calendar"]["calendarfile"].endswith("-2023-09-26.ics"))
+        self.assertEqual(team2["mail"]["recipient"], "team2@example.com")
+        self.assertEqual(team2["mail"]["sender"], "wartungsplan@example.com")
+
+    def test_profile_before_common_section(self):
+        """ [SECTION:NAME] overrides [SECTION] in either order """
+        config = os.path.join(self.tmp.name, "reversed.conf")
+        for first, second in (("[mail:team1]\nrecipient = team1@example.com\n",
+                               "[mail]\nrecipient = team0@example.com\n"),
+                              ("[mail]\nrecipient = team0@example.com\n",
+                               "[mail:team1]\nrecipient = team1@example.com\n")):
+            with open(config, 'w', encoding='utf-8') as conf:
+                conf.write("[calendar:team1]\n" + first + second)
+            profiles = dict(Wartungsplan.read_profiles([config]))
+            self.assertEqual(profiles[config + ":team1"]["mail"]["recipient"],
+                             "team1@example.com")
+
+    def test_shared_smtp_connection(self):
+        """ All teams send over one SMTP connection, a broken profile doesn't
+            stop the others """
+        class FakeSMTP:
+            """ Records connections and messages """
+            connects = 0
+            sent = []
+            def __init__(self, server, port):
+                FakeSMTP.connects += 1
+                self.sock = mock.Mock()
+            def login(self, user, password):
+                """ Accept every login """
+            def noop(self):
+                """ The connection is alive """
+                return (250, b"OK")
+            def send_message(self, msg):
+                """ Record the message """
+                FakeSMTP.sent.append(msg["To"])
+            def quit(self):
+                """ Nothing to close """
+
+        args = ["Wartungsplan", "-c", self.config, "-s", "2023-09-26",
+                "-e", "2023-10-11", "send"]
+        with mock.patch.object(Wartungsplan.smtplib, "SMTP_SSL", FakeSMTP), \
+             mock.patch.object(sys, "argv", args), \
+             warnings.catch_warnings(record=True):
+            self.assertEqual(Wartungsplan.main(), 1)
+        self.assertEqual(FakeSMTP.connects, 1)
+        self.assertEqual(FakeSMTP.sent.count("team0@example.com"), 1)
+        self.assertEqual(FakeSMTP.sent.count("team2@example.com"), 14)
+
+    def test_command_line_action(self):
+        """ The action on the command line wins over the profile action,
+            the profile action is used without one """
+        with open(self.config, 'a', encoding='utf-8') as conf:
+            conf.write("[calendar:team3]\naction = send\n")
+        profiles = dict(Wartungsplan.read_profiles([self.config]))
+        team3 = profiles[self.config + ":team3"]
+        args = mock.Mock(dry_run=False, format="text", period="day",
+                         group_by=None, spool=False, digest=False,
+                         digest_by=None, max_runtime=None,
+                         memory_budget=None, jobs=1, ics_calendar=None,
+                         previous=None, start_date="2023-05-02",
+                         end_date="2023-05-03")
+        with mock.patch.object(Wartungsplan.smtplib, "SMTP_SSL") as smtp, \
+             mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            Wartungsplan.run_profile(team3, args, "list")
+            smtp.assert_not_called()
+            self.assertIn("2023-05-02", stdout.getvalue())
+            Wartungsplan.run_profile(team3, args)
+            smtp.assert_called()
+            with self.assertRaises(SystemExit):
+                Wartungsplan.run_profile(profiles[self.config + ":team2"], args)
+
+
 class TestOtrsApi(unittest.TestCase):
     """ Test the OtrsApi Backend """
     def test_split_message(self):
@@ -264,6 +667,762 @@ not: allowed"""
         self.assertEqual(ticket, t1)
         self.assertEqual(article, a1)
 
+    def test_footer(self):
+        """ The footer of the otrs section is appended to the article """
+        config = configparser.ConfigParser()
+        config['otrs'] = {'footer': 'Created by Wartungsplan'}
+        b = Wartungsplan.OtrsApi(config, True)
+        _, article = b._prepare_event({}, "Text", {'summary':'One'})
+        self.assertEqual(article.to_dct()['Body'],
+                         "Text\n\nCreated by Wartungsplan")
+
+    def test_ticket_not_created(self):
+        """ An empty reply of OTRS is a failure, the other tickets are still
+            created """
+        config = {"otrs": {"server": "https://otrs.example.com",
+                           "username": "u", "password": "p", "queue": "q1"}}
+        b = Wartungsplan.OtrsApi(config, False)
+        tickets = [b._prepare_event({}, "Text", {"summary": summary})
+                   for summary in ("One", "Two")]
+        client = mock.Mock()
+        client.ticket_create.side_effect = [False, {"TicketID": "7"}]
+        with mock.patch.object(b, "_connect", return_value=client):
+            self.assertFalse(b._perform_action(tickets))
+        self.assertEqual(client.ticket_create.call_count, 2)
+        self.assertEqual(tickets[0][1].to_dct()["Body"], "Text\n\n")
+
+
+class TestMemoryBudget(unittest.TestCase):
+    """ Test spilling prepared payloads to disk """
+    def setUp(self):
+        self.config = {"mail":{"sender":"a@example.com",
+                               "recipient":"b@example.com"},
+                       "headers":{"priority":"3 normal"}}
+
+    def backend(self):
+        """ SendEmail recording the messages it sends """
+        class RecordingEmail(Wartungsplan.SendEmail):
+            """ Records instead of sending """
+            def __init__(self, config):
+                super().__init__(config)
+                self.sent = []
+
+            def _perform_action(self, actions_data):
+                for msg in actions_data:
+                    self.sent.append((msg["Subject"], msg.get_content().strip()))
+        return RecordingEmail(self.config)
+
+    def events(self):
+        """ Events with big descriptions and different priorities """
+        events = []
+        for number in range(20):
+            event = icalendar.Event()
+            event.add("summary", f"Task {number}")
+            event.add("dtstart", datetime.datetime(2024, 1, 1, 8, number))
+            event.add("description", f"priority: {number % 5 + 1} x\n\n"
+                                     + f"Text {number:02d} " * 1000)
+            events.append(event)
+        return events
+
+    def test_spill(self):
+        """ Payloads beyond the budget are spilled and delivered in the same
+            order with the same content """
+        unlimited = self.backend()
+        unlimited.act(self.events())
+        self.assertEqual(unlimited.spilled, (0, 0))
+
+        limited = self.backend()
+        limited.memory_budget = 50000
+        files = []
+        temporary_file = tempfile.TemporaryFile
+        def temporary(*args, **kwargs):
+            files.append(temporary_file(*args, **kwargs))
+            return files[-1]
+        with mock.patch("tempfile.TemporaryFile", temporary):
+            limited.act(self.events())
+        self.assertEqual(limited.sent, unlimited.sent)
+        self.assertEqual([subject for subject, _ in limited.sent][:4],
+                         ["Task 4", "Task 9", "Task 14", "Task 19"])
+        spilled, spilled_bytes = limited.spilled
+        self.assertEqual(spilled, 14)
+        self.assertGreater(spilled_bytes, 14 * 8000)
+        self.assertTrue(files[0].closed)
+        self.assertGreater(Wartungsplan.peak_rss(), 2**20)
+        with mock.patch.dict(sys.modules, {"resource": None}):
+            self.assertEqual(Wartungsplan.peak_rss(), 0)
+
+    def test_spill_to_spool(self):
+        """ Spilled payloads go to the spool and the overflow like the
+            others """
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = self.backend()
+            backend.memory_budget = 0
+            backend.spool = Wartungsplan.Spool(tmp)
+            backend.act(self.events())
+            self.assertEqual(backend.spilled[0], 20)
+            self.assertEqual(len(backend.spool.pending()), 20)
+            self.assertEqual(backend.drain(backend.spool), 0)
+            self.assertEqual(len(backend.sent), 20)
+
+
+class TestSpool(unittest.TestCase):
+    """ Test spooling prepared payloads and draining them """
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.spool = Wartungsplan.Spool(self.spool_dir.name)
+        self.config = {"mail":{"sender":"a@example.com",
+                               "recipient":"b@example.com"},
+                       "headers":{"X-Priority":"3"}}
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def test_spool_email(self):
+        """ Messages end up in new/ and read back as the same message """
+        b = Wartungsplan.SendEmail(self.config)
+        b.spool = self.spool
+        b.act([icalendar.Event({"summary":"One", "description":"X-Priority: 1\n\nText"}),
+               icalendar.Event({"summary":"Two"})])
+        pending = self.spool.pending()
+        self.assertEqual(len(pending), 2)
+        self.assertTrue(all(name.endswith(".send") for name in pending))
+        msg = b._deserialize(self.spool.claim(pending[0]))
+        self.assertEqual(msg["Subject"], "One")
+        self.assertEqual(msg["X-Priority"], "1")
+        self.assertEqual(msg.get_content().strip(), "Text")
+        # claimed items can't be claimed twice
+        self.assertIsNone(self.spool.claim(pending[0]))
+
+    def test_spool_otrs(self):
+        """ Tickets survive the round trip through the spool """
+        b = Wartungsplan.OtrsApi({"otrs":{"queue":"q1"}}, False)
+        b.spool = self.spool
+        b.act([icalendar.Event({"summary":"One", "description":"Text"})])
+        name, = self.spool.pending()
+        ticket, article = b._deserialize(self.spool.claim(name))
+        self.assertEqual(ticket.to_dct()["Ticket"]["Queue"], "q1")
+        self.assertEqual(article.to_dct()["Body"], "Text\n\n")
+
+    def test_claim_old_item(self):
+        """ An item spooled long ago and just claimed is not recovered by
+            another drain """
+        name = self.spool.put("send", b"data")
+        old = time.time() - 2 * self.spool.stale_after
+        os.utime(os.path.join(self.spool_dir.name, "new", name), (old, old))
+        self.assertEqual(self.spool.claim(name), b"data")
+        other = Wartungsplan.Spool(self.spool_dir.name)
+        self.assertEqual(other.pending(), [])
+        self.assertIsNone(other.claim(name))
+
+        # a claim left behind by a crashed drain is recovered
+        os.utime(os.path.join(self.spool_dir.name, "cur", name), (old, old))
+        self.assertEqual(other.pending(), [name])
+
+    def test_drain_retries(self):
+        """ Failed deliveries are retried, undeliverable items kept """
+        class FlakyEmail(Wartungsplan.SendEmail):
+            """ Fails the first delivery attempts """
+            failures = 2
+            sent = []
+            def _perform_action(self, actions_data):
+                if self.failures:
+                    self.failures -= 1
+                    raise ConnectionError("Server down")
+                self.sent.extend(actions_data)
+
+        b = FlakyEmail(self.config)
+        b.spool = self.spool
+        b.act([icalendar.Event({"summary":"One"})])
+        b.spool = None
+
+        self.assertEqual(b.drain(self.spool, retries=2, backoff=0), 1)
+        self.assertEqual(len(self.spool.pending()), 1)
+        self.assertEqual(b.drain(self.spool, retries=2, backoff=0), 0)
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(b.sent[0]["Subject"], "One")
+
+    def test_max_runtime(self):
+        """ Most urgent first, what is left after the deadline is spooled """
+        class SlowEmail(Wartungsplan.SendEmail):
+            """ Every delivery takes a tenth of the budget """
+            sent = []
+            def _perform_action(self, actions_data):
+                for msg in actions_data:
+                    self.sent.append(msg["Subject"])
+                    clock[0] += 1
+
+        clock = [0]
+        b = SlowEmail(self.config)
+        b.overflow = self.spool
+        b.deadline = 2
+        events = []
+        for day, priority, summary in ((3, "", "Low"), (5, "5 very high", "Urgent"),
+                                       (4, "3 normal", "Normal"), (3, "3 normal", "Earlier")):
+            events.append(icalendar.Event({
+                "summary": summary,
+                "dtstart": icalendar.vDDDTypes(datetime.datetime(2024, 6, day, 8)),
+                "description": f"Priority: {priority}\n\nText"}))
+        with mock.patch.object(Wartungsplan.time, "monotonic", lambda: clock[0]):
+            b.act(events)
+            self.assertEqual(b.sent, ["Urgent", "Earlier"])
+            self.assertEqual(len(self.spool.pending()), 2)
+
+            # the next run delivers the rest
+            b.deadline = 10
+            self.assertEqual(b.drain(self.spool), 0)
+        self.assertEqual(b.sent, ["Urgent", "Earlier", "Normal", "Low"])
+
+        # a dry run doesn't leave anything for the next run
+        b = SlowEmail(self.config, True)
+        b.overflow = self.spool
+        b.deadline = clock[0] + 1
+        with mock.patch.object(Wartungsplan.time, "monotonic", lambda: clock[0]):
+            b.act(events)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_overflow(self):
+        """ The overflow has its own directory and is drained with the
+            configured retries """
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "calendar": {"calendarfile": os.path.join(
+                TESTSDIR, "test-data", "Every2ndTuesday-2023-05-02.ics")},
+            "mail": self.config["mail"], "headers": self.config["headers"],
+            "spool": {"directory": self.spool_dir.name, "retries": "1",
+                      "backoff": "0"}})
+        b = Wartungsplan.SendEmail(config)
+        b.spool = self.spool
+        b.act([icalendar.Event({"summary":"Spooled"})])
+        b.spool = Wartungsplan.Spool(Wartungsplan.overflow_directory(config))
+        b.act([icalendar.Event({"summary":"Left"})])
+
+        args = mock.Mock(dry_run=False, spool=False, digest=False,
+                         digest_by=None, max_runtime=60, memory_budget=None,
+                         jobs=1, ics_calendar=None, previous=None,
+                         start_date="2020-01-01", end_date="2020-01-02")
+        with mock.patch.object(Wartungsplan.SendEmail, "_perform_action",
+                               side_effect=ConnectionError) as perform:
+            Wartungsplan.run_profile(config, args, "send")
+        self.assertEqual(perform.call_count, 1)
+        self.assertEqual(perform.call_args[0][0][0]["Subject"], "Left")
+        self.assertEqual(len(self.spool.pending()), 1)
+        self.assertEqual(len(b.spool.pending()), 1)
+
+
+class CalendarHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves calendar_data gzip compressed with an ETag """
+    calendar_data = b""
+    requests = []
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ Answer conditional GET requests """
+        etag = '"%d"' % len(self.calendar_data)
+        self.requests.append(self.headers)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = gzip.compress(self.calendar_data)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class TestRemoteCalendar(unittest.TestCase):
+    """ Test downloading calendars via http """
+    def setUp(self):
+        p = os.path.join(TESTSDIR, "test-data", "Every2ndTuesday-2023-05-02.ics")
+        with open(p, 'rb') as c:
+            CalendarHandler.calendar_data = c.read()
+        CalendarHandler.requests = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), CalendarHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/cal.ics" % self.server.server_port
+        self.cachedir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.cachedir.cleanup()
+
+    def test_conditional_download(self):
+        """ The second download is revalidated and not parsed again """
+        remote = Wartungsplan.RemoteCalendar(self.url, self.cachedir.name)
+        cal = remote.read()
+        self.assertEqual(len(cal.walk("VEVENT")), 1)
+        self.assertIn("gzip", CalendarHandler.requests[0]["Accept-Encoding"])
+
+        with mock.patch.object(icalendar.Calendar, "from_ical") as from_ical:
+            cal = remote.read()
+            from_ical.assert_not_called()
+        self.assertEqual(CalendarHandler.requests[1]["If-None-Match"], '"1011"')
+        wp = Wartungsplan.Wartungsplan("2023-05-02", "2023-06-06", cal,
+                                       DummyBackend(None))
+        self.assertEqual(wp.run_backend(), 2)
+
+    def test_server_down(self):
+        """ Fall back to the last good copy """
+        remote = Wartungsplan.RemoteCalendar(self.url, self.cachedir.name)
+        remote.read()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.assertEqual(len(remote.read().walk("VEVENT")), 1)
+
+        remote = Wartungsplan.RemoteCalendar(self.url, tempfile.mkdtemp(
+                                                 dir=self.cachedir.name))
+        with self.assertRaises(Wartungsplan.requests.RequestException):
+            remote.read()
+
+
+    def test_error_page(self):
+        """ A page that is no calendar falls back to the last good copy, the
+            parsed copy is cached as binary calendar """
+        remote = Wartungsplan.RemoteCalendar(self.url, self.cachedir.name)
+        remote.read()
+        with open(remote.parsed_file, 'rb') as parsed:
+            self.assertTrue(parsed.read().startswith(
+                Wartungsplan.BinaryCalendar.magic))
+        CalendarHandler.calendar_data = b"<html><body>Proxy error</body></html>"
+        with mock.patch.object(icalendar.Calendar, "from_ical",
+                               wraps=icalendar.Calendar.from_ical) as from_ical:
+            self.assertEqual(len(remote.read().walk("VEVENT")), 1)
+            self.assertEqual(from_ical.call_count, 1)
+
+        remote = Wartungsplan.RemoteCalendar(self.url, tempfile.mkdtemp(
+                                                 dir=self.cachedir.name))
+        with self.assertRaises(ValueError):
+            remote.read()
+
+class TestPreviewServer(unittest.TestCase):
+    """ Test the serve action """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ics = os.path.join(self.tmp.name, "calendar.ics")
+        self.write("Backup")
+        config = configparser.ConfigParser()
+        config.read_dict({"serve": {"port": "0"}})
+        self.server = Wartungsplan.preview_server(self.ics, config)
+        self.server.preview.check_interval = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = (f"http://127.0.0.1:{self.server.server_address[1]}"
+                    "/occurrences?start=2024-06-03&end=2024-06-10")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def write(self, summary):
+        """ A daily event """
+        event = icalendar.Event()
+        event.add('uid', 'daily')
+        event.add('summary', summary)
+        event.add('dtstart', datetime.datetime(2024, 1, 1, 8))
+        event.add('rrule', {'freq': 'DAILY'})
+        cal = icalendar.Calendar()
+        cal.add_component(event)
+        with open(self.ics, 'wb') as ics:
+            ics.write(cal.to_ical())
+
+    def test_occurrences(self):
+        """ Cached answers with ETag, a changed file is parsed again """
+        response = requests.get(self.url, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        occurrences = response.json()["occurrences"]
+        self.assertEqual(len(occurrences), 7)
+        self.assertEqual(occurrences[0]["summary"], "Backup")
+        etag = response.headers["ETag"]
+
+        response = requests.get(self.url, headers={"If-None-Match": etag},
+                                timeout=10)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.server.preview.windows), 2)
+
+        self.write("Restore")
+        os.utime(self.ics, ns=(0, 0))
+        response = requests.get(self.url, headers={"If-None-Match": etag},
+                                timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["occurrences"][0]["summary"], "Restore")
+
+    def test_concurrent_readers(self):
+        """ Many readers get the same answer """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            bodies = set(pool.map(
+                lambda _: requests.get(self.url, timeout=10).content, range(64)))
+        self.assertEqual(len(bodies), 1)
+
+    def test_errors(self):
+        """ Unknown paths and dates """
+        response = requests.get(self.url.replace("occurrences", "events"),
+                                timeout=10)
+        self.assertEqual(response.status_code, 404)
+        response = requests.get(self.url + "x", timeout=10)
+        self.assertEqual(response.status_code, 400)
+
+
+class TestShardedExpansion(unittest.TestCase):
+    """ Test expanding the calendar in several processes """
+    def test_same_as_single_process(self):
+        """ Same events in the same order as between() """
+        # a modification of series A after series B
+        a = icalendar.Event()
+        a.add('uid', 'A')
+        a.add('dtstart', datetime.datetime(2023, 9, 1, 10))
+        a.add('rrule', {'freq': 'DAILY'})
+        b = icalendar.Event()
+        b.add('uid', 'B')
+        b.add('dtstart', datetime.datetime(2023, 9, 1, 11))
+        b.add('rrule', {'freq': 'WEEKLY'})
+        a_moved = icalendar.Event()
+        a_moved.add('uid', 'A')
+        a_moved.add('recurrence-id', datetime.datetime(2023, 9, 3, 10))
+        a_moved.add('dtstart', datetime.datetime(2023, 9, 3, 15))
+        interleaved = icalendar.Calendar()
+        for event in (a, b, a_moved):
+            interleaved.add_component(event)
+        cals = [interleaved]
+        for name in sorted(os.listdir(os.path.join(TESTSDIR, "test-data"))):
+            with open(os.path.join(TESTSDIR, "test-data", name), 'rb') as c:
+                cals.append(icalendar.Calendar.from_ical(c.read()))
+
+        start, end = Wartungsplan.parse_date_range("2023-05-01", "2023-11-01")
+        start, end = start.astimezone(), end.astimezone()
+        for cal in cals:
+            self.assertEqual(
+                [e.to_ical() for e in Wartungsplan.expand_sharded(cal, start, end, 3)],
+                [e.to_ical() for e in recurring_ical_events.of(cal).between(start, end)])
+            self.assertEqual(
+                [e.to_ical() for e in Wartungsplan.expand_traced(cal, start, end)],
+                [e.to_ical() for e in recurring_ical_events.of(cal).between(start, end)])
+
+    def test_wartungsplan_jobs(self):
+        """ The jobs option of Wartungsplan """
+        p = os.path.join(TESTSDIR, "test-data", "OutlookCalendar-2023-10-06.ics")
+        with open(p, encoding='utf-8') as c:
+            cal = icalendar.Calendar.from_ical(c.read())
+        with mock.patch.object(Wartungsplan.os, "cpu_count", return_value=4), \
+             mock.patch.object(Wartungsplan, "SHARD_MIN_EVENTS", 0):
+            wp = Wartungsplan.Wartungsplan("2023-10-07", "2023-10-08", cal,
+                                           DummyBackend(None), jobs=2)
+        self.assertEqual(wp.run_backend(), 3)
+
+    def test_streamed_list_jobs(self):
+        """ list prints the same with several processes """
+        cal = icalendar.Calendar()
+        for uid, hour in (("late", 10), ("early", 8)):
+            event = icalendar.Event()
+            event.add('uid', uid)
+            event.add('summary', uid)
+            event.add('dtstart', datetime.datetime(2023, 9, 25, hour))
+            event.add('dtend', datetime.datetime(2023, 9, 25, hour, 30))
+            event.add('rrule', {'freq': 'DAILY'})
+            cal.add_component(event)
+        moved = icalendar.Event()
+        moved.add('uid', 'late')
+        moved.add('summary', 'late moved')
+        moved.add('recurrence-id', datetime.datetime(2023, 9, 26, 10))
+        moved.add('dtstart', datetime.datetime(2023, 9, 25, 9))
+        moved.add('dtend', datetime.datetime(2023, 9, 25, 9, 30))
+        cal.add_component(moved)
+
+        outputs = []
+        for jobs in (1, 2):
+            out = io.StringIO()
+            b = Wartungsplan.ListStdout(None, False, 'csv', out)
+            with mock.patch.object(Wartungsplan.os, "cpu_count", return_value=4), \
+                 mock.patch.object(Wartungsplan, "SHARD_MIN_EVENTS", 0):
+                Wartungsplan.Wartungsplan("2023-09-25", "2023-09-28", cal, b,
+                                          stream=True, jobs=jobs).run_backend()
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0].splitlines()[1].split(",")[1], "late moved")
+
+    def test_shard_jobs(self):
+        """ Not more processes than CPUs, small calendars in this process """
+        small = icalendar.Calendar()
+        big = icalendar.Calendar()
+        for number in range(Wartungsplan.SHARD_MIN_EVENTS):
+            event = icalendar.Event()
+            event.add('uid', str(number))
+            event.add('dtstart', datetime.datetime(2023, 9, 1, 10))
+            if number < 10:
+                small.add_component(event)
+            big.add_component(event)
+        for cpus, calendar, jobs in ((8, big, 4), (2, big, 2), (1, big, 1),
+                                     (None, big, 1), (8, small, 1)):
+            with mock.patch.object(Wartungsplan.os, "cpu_count",
+                                   return_value=cpus):
+                self.assertEqual(Wartungsplan.shard_jobs(calendar, 4), jobs)
+
+        with mock.patch.object(Wartungsplan.os, "cpu_count", return_value=1), \
+             mock.patch.object(Wartungsplan, "expand_sharded") as sharded:
+            wp = Wartungsplan.Wartungsplan("2023-09-01", "2023-09-02", big,
+                                           DummyBackend(None), jobs=4)
+        sharded.assert_not_called()
+        self.assertEqual(wp.run_backend(), Wartungsplan.SHARD_MIN_EVENTS)
+
+
+class TestTracer(unittest.TestCase):
+    """ Test tracing spans and the slow item report """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trace = os.path.join(self.tmp.name, "trace.json")
+        p = os.path.join(TESTSDIR, "test-data", "OutlookCalendar-2023-10-06.ics")
+        with open(p, encoding='utf-8') as c:
+            self.cal = icalendar.Calendar.from_ical(c.read())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_traced(self, sample, slow):
+        """ Send the events of a week with a tracer, returns the spans and
+            the report """
+        tracer = Wartungsplan.Tracer()
+        tracer.configure(self.trace, sample, slow)
+        config = {"mail": {"sender": "a@example.com", "recipient": "b@example.com"},
+                  "headers": {}}
+        report = io.StringIO()
+        with mock.patch.object(Wartungsplan, "tracer", tracer), \
+             mock.patch.object(sys, "stdout", io.StringIO()), \
+             mock.patch.object(sys, "stderr", report):
+            wp = Wartungsplan.Wartungsplan("2023-10-07", "2023-10-14", self.cal,
+                                           Wartungsplan.SendEmail(config, True))
+            wp.run_backend()
+            tracer.close()
+        spans = []
+        with open(self.trace, encoding='utf-8') as trace:
+            for line in trace:
+                for resource in json.loads(line)["resourceSpans"]:
+                    for scope in resource["scopeSpans"]:
+                        spans.extend(scope["spans"])
+        return spans, report.getvalue()
+
+    def test_spans(self):
+        """ Every step of every event is traced with the UID and summary """
+        spans, report = self.run_traced(1.0, None)
+        names = collections.Counter(span["name"] for span in spans)
+        self.assertEqual(names["occurrence"], names["prepare_event"])
+        self.assertEqual(names["occurrence"], names["apply_headers"])
+        self.assertGreater(names["occurrence"], 0)
+        self.assertGreater(names["expand"], 0)
+        ids = {span["spanId"]: span for span in spans}
+        for span in spans:
+            if span["name"] == "prepare_event":
+                self.assertEqual(ids[span["parentSpanId"]]["name"], "occurrence")
+            if span["name"] == "occurrence":
+                keys = [attribute["key"] for attribute in span["attributes"]]
+                self.assertEqual(keys, ["uid", "summary"])
+                self.assertLessEqual(int(span["startTimeUnixNano"]),
+                                     int(span["endTimeUnixNano"]))
+        self.assertEqual(report, "")
+
+    def test_sampling_and_slow_items(self):
+        """ Not sampled spans are only kept if slow """
+        spans, _ = self.run_traced(0.0, 3600)
+        self.assertEqual(spans, [])
+        spans, report = self.run_traced(0.0, 0)
+        self.assertIn("slow items (>= 0s)", report)
+        self.assertEqual(len(report.splitlines()),
+                         1 + Wartungsplan.Tracer.report_size)
+
+    def test_disabled(self):
+        """ Disabled tracing hands out the same empty context """
+        tracer = Wartungsplan.Tracer()
+        with tracer.span("parse") as span:
+            self.assertIsNone(span)
+        self.assertIs(tracer.span("expand"), tracer.span("parse"))
+
+
+class TestCalendarIndex(unittest.TestCase):
+    """ Test reading only the events of a window via the index """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.b = DummyBackend(None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_events_as_full_parse(self):
+        """ The index returns the same occurrences for the test calendars """
+        for name, start, end in [
+                ("OutlookCalendar-2023-10-06.ics", "2023-10-07", "2023-10-08"),
+                ("EveryDayExcept-2023-09-26.ics", "2023-09-26", "2023-09-27"),
+                ("Every2ndTuesday-2023-05-02.ics", "2023-05-02", "2023-06-06"),
+                ("TimezoneBangkok3rdOr4th-05-2023.ics", "2023-05-03", None)]:
+            p = os.path.join(TESTSDIR, "test-data", name)
+            with open(p, 'rb') as c:
+                cal = icalendar.Calendar.from_ical(c.read())
+            index = Wartungsplan.CalendarIndex(p, self.tmp.name)
+            indexed = index.read(*Wartungsplan.parse_date_range(start, end))
+            self.assertEqual(
+                Wartungsplan.Wartungsplan(start, end, cal, self.b).run_backend(),
+                Wartungsplan.Wartungsplan(start, end, indexed, self.b).run_backend())
+
+    def test_only_window_is_parsed(self):
+        """ Past events are skipped and the index follows file changes """
+        cal = icalendar.Calendar()
+        for day in range(1, 29):
+            event = icalendar.Event()
+            event.add('uid', f"feb-{day}")
+            event.add('summary', 'Past')
+            event.add('dtstart', datetime.datetime(2023, 2, day, 10))
+            event.add('dtend', datetime.datetime(2023, 2, day, 11))
+            cal.add_component(event)
+        weekly = icalendar.Event()
+        weekly.add('uid', 'weekly')
+        weekly.add('summary', 'Weekly until March')
+        weekly.add('dtstart', datetime.datetime(2023, 1, 2, 10))
+        weekly.add('rrule', {'freq': 'WEEKLY', 'until': datetime.datetime(2023, 3, 1)})
+        cal.add_component(weekly)
+        p = os.path.join(self.tmp.name, "cal.ics")
+        with open(p, 'wb') as c:
+            c.write(cal.to_ical())
+
+        index = Wartungsplan.CalendarIndex(p, self.tmp.name)
+        window = Wartungsplan.parse_date_range("2023-02-10", "2023-02-11")
+        # one day slack for timezones: 9th - 12th and the weekly series
+        self.assertEqual(len(index.read(*window).walk("VEVENT")), 5)
+        window = Wartungsplan.parse_date_range("2023-05-01", None)
+        self.assertEqual(len(index.read(*window).walk("VEVENT")), 0)
+
+        event = icalendar.Event()
+        event.add('uid', 'may')
+        event.add('dtstart', datetime.datetime(2023, 5, 2, 10))
+        cal.add_component(event)
+        with open(p, 'wb') as c:
+            c.write(cal.to_ical())
+        self.assertEqual(len(index.read(*window).walk("VEVENT")), 1)
+
+    def test_count(self):
+        """ Series with COUNT end at their last occurrence """
+        cal = icalendar.Calendar()
+        for uid, count in (("ended", 8), ("running", 30)):
+            event = icalendar.Event()
+            event.add('uid', uid)
+            event.add('dtstart', datetime.datetime(2023, 1, 2, 10))
+            event.add('rrule', {'freq': 'WEEKLY', 'count': count})
+            cal.add_component(event)
+        p = os.path.join(self.tmp.name, "cal.ics")
+        with open(p, 'wb') as c:
+            c.write(cal.to_ical())
+
+        index = Wartungsplan.CalendarIndex(p, self.tmp.name)
+        # the 8th occurrence is on February 20th
+        for start, uids in (("2023-02-21", ["ended", "running"]),
+                            ("2023-02-22", ["running"])):
+            window = Wartungsplan.parse_date_range(start, "2023-03-01")
+            self.assertEqual([str(event["UID"]) for event in
+                              index.read(*window).walk("VEVENT")], uids)
+
+
+class TestCalendarDiff(unittest.TestCase):
+    """ Test the diff of two calendar versions """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old = os.path.join(self.tmp.name, "old.ics")
+        self.new = os.path.join(self.tmp.name, "new.ics")
+        start = datetime.datetime(2024, 6, 3, 8, 0)
+        self.write(self.old, [
+            self.event("daily", start, "Backup", rrule={"freq": "daily"}),
+            self.event("gone", start, "Patch"),
+            self.event("same", start, "Reboot", stamp=1),
+            self.event("text", start, "Check")])
+        override = self.event("daily", start + datetime.timedelta(days=2, hours=2),
+                              "Backup later", sequence=1)
+        override.add("recurrence-id", start + datetime.timedelta(days=2))
+        self.write(self.new, [
+            self.event("daily", start, "Backup", rrule={"freq": "daily"}),
+            override,
+            self.event("same", start, "Reboot", stamp=2),
+            self.event("text", start, "Check", "Other text"),
+            self.event("new", start + datetime.timedelta(days=1), "Update")])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def event(uid, start, summary, description="", rrule=None, stamp=0,
+              sequence=0):
+        """ An event of the test calendars """
+        event = icalendar.Event()
+        event.add("uid", uid)
+        event.add("summary", summary)
+        event.add("description", description)
+        event.add("dtstart", start)
+        event.add("dtend", start + datetime.timedelta(hours=1))
+        event.add("dtstamp", datetime.datetime(2024, 1, 1, stamp))
+        event.add("sequence", sequence)
+        if rrule:
+            event.add("rrule", rrule)
+        return event
+
+    @staticmethod
+    def write(path, events):
+        """ Write events to the calendar file path """
+        cal = icalendar.Calendar()
+        for event in events:
+            cal.add_component(event)
+        with open(path, 'wb') as ics:
+            ics.write(cal.to_ical())
+
+    def test_changes(self):
+        """ Components are matched by UID and RECURRENCE-ID, DTSTAMP doesn't
+            count """
+        changes = Wartungsplan.CalendarDiff.from_files(self.old, self.new)
+        self.assertEqual(changes.added, [("daily", "20240605T080000"),
+                                         ("new", None)])
+        self.assertEqual(changes.removed, [("gone", None)])
+        self.assertEqual(changes.modified, [("text", None)])
+        added = list(changes.changes())[0]
+        self.assertEqual(added["sequence"], 1)
+
+    def test_occurrences(self):
+        """ Only the changed occurrences of changed series """
+        changes = Wartungsplan.CalendarDiff.from_files(self.old, self.new)
+        start, end = Wartungsplan.parse_date_range("2024-06-03", "2024-06-10")
+        new, cancelled = changes.occurrences(start, end)
+        self.assertEqual(sorted((str(e["UID"]), e["DTSTART"].dt.day) for e in new),
+                         [("daily", 5), ("new", 4), ("text", 3)])
+        self.assertEqual(sorted((str(e["UID"]), e["DTSTART"].dt.day) for e in cancelled),
+                         [("daily", 5), ("gone", 3), ("text", 3)])
+
+    def test_missing_previous(self):
+        """ Without previous version everything is new """
+        changes = Wartungsplan.CalendarDiff.from_files(self.old + "x", self.new)
+        self.assertEqual(len(changes.added), 5)
+        self.assertEqual(changes.removed, [])
+
+    def test_main(self):
+        """ diff action and list with --previous """
+        args = ["Wartungsplan", "-c",
+                os.path.join(os.path.dirname(TESTSDIR), "plan.conf.sample"),
+                "-i", self.new, "--previous", self.old, "-s", "2024-06-03",
+                "-e", "2024-06-10"]
+        with mock.patch.object(sys, "argv", args + ["-f", "jsonl", "diff"]), \
+             mock.patch.object(sys, "stdout", io.StringIO()) as out:
+            Wartungsplan.main()
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line.get("change", line.get("occurrence"))
+                          for line in lines],
+                         ["added", "added", "removed", "modified"]
+                         + ["new"] * 3 + ["cancelled"] * 3)
+
+        with mock.patch.object(sys, "argv", args + ["-f", "jsonl", "list"]), \
+             mock.patch.object(sys, "stdout", io.StringIO()) as out:
+            Wartungsplan.main()
+        self.assertEqual(sorted(json.loads(line)["summary"]
+                                for line in out.getvalue().splitlines()),
+                         ["Backup later", "Check", "Update"])
+
 
 class TestAddEventToIcal(unittest.TestCase):
     """ Test tool to add event or create new calendar """
@@ -313,6 +1472,63 @@ class TestAddEventToIcal(unittest.TestCase):
             self.assertEqual(wp.run_backend(), 2)
         os.unlink(calendar_file)
 
+    def test_concurrent_adds(self):
+        """ Adding without journal at the same time loses no event """
+        with tempfile.TemporaryDirectory() as tmp:
+            calendar_file = os.path.join(tmp, "plan.ics")
+            def add(number):
+                addEventToIcal.add_event(calendar_file, '2023-09-25', '',
+                                         'FREQ=DAILY', '11:00', '', '0:20',
+                                         f'Test{number}', 'Again')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(add, range(20)))
+            cal = Wartungsplan.read_calendar(calendar_file)
+            self.assertEqual(len(cal.walk("VEVENT")), 20)
+            self.assertFalse(os.path.exists(calendar_file + ".tmp"))
+
+    def test_journal(self):
+        """ Events are appended to the journal, read with the calendar and
+            folded into it by compaction """
+        with tempfile.TemporaryDirectory() as tmp:
+            calendar_file = os.path.join(tmp, "plan.ics")
+            addEventToIcal.add_event(calendar_file, '2023-09-25', '',
+                                     'FREQ=DAILY', '11:00', '', '0:20',
+                                     'Test1', 'Here we go again')
+            with open(calendar_file, 'rb') as c:
+                written = c.read()
+
+            def add(number):
+                addEventToIcal.add_event(calendar_file, '2023-09-25', '',
+                                         'FREQ=WEEKLY', '11:00', '', '0:20',
+                                         f'Journal{number}', 'Again',
+                                         journal=True)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(add, range(20)))
+            with open(calendar_file, 'rb') as c:
+                self.assertEqual(c.read(), written)
+
+            cal = Wartungsplan.read_calendar(calendar_file)
+            wp = Wartungsplan.Wartungsplan("2023-09-25", "2023-09-26", cal, self.b)
+            self.assertEqual(wp.run_backend(), 21)
+            self.assertEqual(len(addEventToIcal.load_existing_calendar(
+                calendar_file).walk("VEVENT")), 21)
+
+            # a writer killed while appending
+            with open(calendar_file + ".journal", 'ab') as journal:
+                journal.write(b"BEGIN:VEVENT\r\nSUMMARY:Half")
+            self.assertEqual(len(Wartungsplan.read_calendar(calendar_file)
+                                 .walk("VEVENT")), 21)
+
+            journal = Wartungsplan.CalendarJournal(calendar_file)
+            self.assertEqual(journal.compact(), 20)
+            self.assertFalse(os.path.exists(calendar_file + ".journal"))
+            with open(calendar_file, 'rb') as c:
+                cal = icalendar.Calendar.from_ical(c.read())
+            self.assertEqual(sorted(str(event["SUMMARY"])
+                                    for event in cal.walk("VEVENT"))[:3],
+                             ["Journal0", "Journal1", "Journal10"])
+            self.assertEqual(len(cal.walk("VEVENT")), 21)
+
     def test_string_to_rrule(self):
         """ Test value separation """
         rrules = [
@@ -333,14 +1549,420 @@ class TestAddEventToIcal(unittest.TestCase):
             self.assertEqual(parsed, addEventToIcal.string_to_rrule(text))
 
 
+class TestBinaryCalendar(unittest.TestCase):
+    """ Test the binary form of calendars """
+    @classmethod
+    def setUpClass(cls):
+        """ Set up common test case resources. """
+        cls.tests_data_dir = os.path.join(TESTSDIR, "test-data")
+
+    def occurrences(self, calendar):
+        """ The occurrences of calendar with the properties backends use """
+        return [(str(event.get("UID")), event["DTSTART"].dt,
+                 event["DTEND"].dt, str(event.get("SUMMARY")),
+                 str(event.get("DESCRIPTION")))
+                for event in recurring_ical_events.of(calendar).between(
+                    (2023, 1, 1), (2024, 6, 1))]
+
+    def test_fixtures(self):
+        """ All fixtures have the same occurrences in binary form """
+        for name in sorted(os.listdir(self.tests_data_dir)):
+            with open(os.path.join(self.tests_data_dir, name), 'rb') as ics:
+                calendar = icalendar.Calendar.from_ical(ics.read())
+            data = Wartungsplan.BinaryCalendar.dumps(
+                calendar.walk("VEVENT"), calendar.get("X-WR-TIMEZONE"))
+            self.assertTrue(data.startswith(b"WPCAL"))
+            self.assertEqual(self.occurrences(
+                                 Wartungsplan.BinaryCalendar.loads(data)),
+                             self.occurrences(calendar), name)
+
+    def test_properties(self):
+        """ Dates, time zones, durations, lists and overridden occurrences
+            survive the binary form """
+        berlin = pytz.timezone("Europe/Berlin")
+        def local(day, hour=9):
+            return berlin.localize(datetime.datetime(2024, 3, day, hour))
+        start = local(29)
+        series = icalendar.Event()
+        series.add("uid", "series")
+        series.add("sequence", 3)
+        series.add("dtstart", start)
+        series.add("duration", datetime.timedelta(minutes=90))
+        series.add("rrule", {"freq": "daily", "count": 4})
+        series.add("exdate", [local(30)])
+        series.add("exdate", [local(31)])
+        series.add("rdate", [datetime.datetime(2024, 4, 2, 8, 0,
+                                               tzinfo=pytz.utc)])
+        series.add("summary", "Säule prüfen")
+        moved = icalendar.Event()
+        moved.add("uid", "series")
+        moved.add("recurrence-id", local(30))
+        moved.add("dtstart", local(28, 11))
+        moved.add("dtend", local(28, 12))
+        moved.add("summary", "Säule prüfen")
+        whole_day = icalendar.Event()
+        whole_day.add("dtstart", datetime.date(2024, 3, 30))
+        whole_day.add("dtend", datetime.date(2024, 3, 31))
+        whole_day.add("summary", "Säule prüfen")
+
+        calendar = icalendar.Calendar()
+        for event in (series, moved, whole_day):
+            calendar.add_component(event)
+        data = Wartungsplan.BinaryCalendar.dumps(calendar.walk("VEVENT"))
+        loaded = Wartungsplan.BinaryCalendar.loads(data)
+        self.assertEqual(data.count("Säule prüfen".encode('utf-8')), 1)
+        self.assertEqual(loaded.walk("VEVENT")[0]["SEQUENCE"], 3)
+
+        def starts(calendar):
+            return sorted(str(event["DTSTART"].dt) for event in
+                          recurring_ical_events.of(calendar).between(
+                              (2024, 3, 1), (2024, 5, 1)))
+        self.assertEqual(starts(loaded), starts(calendar))
+        # DST started on March 31st
+        self.assertEqual(starts(loaded), ["2024-03-28 11:00:00+01:00",
+                                          "2024-03-29 09:00:00+01:00",
+                                          "2024-03-30",
+                                          "2024-04-01 09:00:00+02:00",
+                                          "2024-04-02 08:00:00+00:00"])
+
+    def test_calendar_timezone(self):
+        """ Floating times keep the X-WR-TIMEZONE of the calendar """
+        calendar = icalendar.Calendar()
+        calendar.add("X-WR-TIMEZONE", "America/New_York")
+        event = icalendar.Event()
+        event.add("uid", "floating")
+        event.add("dtstart", datetime.datetime(2023, 2, 28, 21))
+        event.add("duration", datetime.timedelta(hours=1))
+        calendar.add_component(event)
+        loaded = Wartungsplan.BinaryCalendar.loads(Wartungsplan.BinaryCalendar.dumps(
+            calendar.walk("VEVENT"), calendar.get("X-WR-TIMEZONE")))
+        self.assertEqual(str(loaded["X-WR-TIMEZONE"]), "America/New_York")
+        self.assertEqual(self.occurrences(loaded), self.occurrences(calendar))
+
+    def test_many_properties(self):
+        """ An event may have more than 255 properties """
+        start = datetime.datetime(2024, 1, 1, 9, tzinfo=pytz.utc)
+        series = icalendar.Event()
+        series.add("uid", "daily")
+        series.add("dtstart", start)
+        series.add("duration", datetime.timedelta(hours=1))
+        series.add("rrule", {"freq": "daily", "count": 400})
+        for day in range(300):
+            series.add("exdate", [start + datetime.timedelta(days=day)])
+        calendar = icalendar.Calendar()
+        calendar.add_component(series)
+        loaded = Wartungsplan.BinaryCalendar.loads(
+            Wartungsplan.BinaryCalendar.dumps(calendar.walk("VEVENT")))
+        self.assertEqual(len(loaded.walk("VEVENT")[0]["EXDATE"]), 300)
+        self.assertEqual(len(recurring_ical_events.of(loaded).between(
+                             (2024, 1, 1), (2025, 6, 1))), 100)
+
+    def test_localize_without_pytz(self):
+        """ Without pytz the time zones come from zoneinfo """
+        Wartungsplan._localize.cache_clear() # pylint: disable=protected-access
+        try:
+            with mock.patch.object(Wartungsplan, "pytz", None):
+                local = Wartungsplan._localize("Europe/Berlin") # pylint: disable=protected-access
+                self.assertEqual(str(local(datetime.datetime(2024, 4, 1, 9))),
+                                 "2024-04-01 09:00:00+02:00")
+        finally:
+            Wartungsplan._localize.cache_clear() # pylint: disable=protected-access
+
+    def test_read_calendar(self):
+        """ read_calendar recognizes binary calendars, other versions are
+            rejected """
+        with open(os.path.join(self.tests_data_dir,
+                               "EveryDayExcept-2023-09-26.ics"), 'rb') as ics:
+            calendar = icalendar.Calendar.from_ical(ics.read())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "plan.wpcal")
+            Wartungsplan.BinaryCalendar.write(calendar.walk("VEVENT"), path)
+            self.assertEqual(self.occurrences(Wartungsplan.read_calendar(path)),
+                             self.occurrences(calendar))
+
+            with open(path, 'rb') as binary:
+                data = bytearray(binary.read())
+            data[6] += 1
+            with self.assertRaises(ValueError):
+                Wartungsplan.BinaryCalendar.loads(bytes(data))
+
+    def test_producers(self):
+        """ downloadExchange and addEventToIcal write binary calendars """
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, "exchange.wpcal")
+            downloadExchange.download({'user':'', 'password': '',
+                                       'outfile': outfile},
+                                      '2024-01-01', '', dry_run=True)
+            calendar = Wartungsplan.read_calendar(outfile)
+            self.assertEqual([str(event["SUMMARY"])
+                              for event in calendar.walk("VEVENT")],
+                             ["foo1", "foo2", "bar1"])
+
+            calendar_file = os.path.join(tmp, "plan.ics")
+            addEventToIcal.add_event(calendar_file, '2023-09-25', '',
+                                     'FREQ=DAILY', '11:00', '', '0:20',
+                                     'Test1', 'Here we go again')
+            addEventToIcal.write_binary(calendar_file,
+                                        os.path.join(tmp, "plan.wpcal"))
+            self.assertEqual(
+                self.occurrences(Wartungsplan.read_calendar(
+                    os.path.join(tmp, "plan.wpcal"))),
+                self.occurrences(Wartungsplan.read_calendar(calendar_file)))
+
+
+class TestCompressedCalendars(unittest.TestCase):
+    """ Test gzip and xz compressed calendars """
+    @classmethod
+    def setUpClass(cls):
+        """ Set up common test case resources. """
+        with open(os.path.join(TESTSDIR, "test-data",
+                               "EveryDayExcept-2023-09-26.ics"), 'rb') as ics:
+            cls.ics = ics.read()
+        cls.window = Wartungsplan.parse_date_range("2023-09-25", "2023-10-10")
+
+    def starts(self, calendar):
+        """ Start times of the occurrences in the window """
+        return sorted(event["DTSTART"].dt for event in
+                      recurring_ical_events.of(calendar).between(*self.window))
+
+    def test_read(self):
+        """ Compressed calendars are recognized by their content and read
+            like plain ones, also with the index option """
+        expected = self.starts(icalendar.Calendar.from_ical(self.ics))
+        config = configparser.ConfigParser()
+        with tempfile.TemporaryDirectory() as tmp:
+            config.read_dict({"calendar": {"index": "yes", "cachedir": tmp}})
+            for name, compress in (("plan.ics.gz", gzip.compress),
+                                   ("plan.ics.xz", lzma.compress),
+                                   ("gzip.ics", gzip.compress)):
+                path = os.path.join(tmp, name)
+                with open(path, 'wb') as compressed:
+                    compressed.write(compress(self.ics))
+                self.assertEqual(self.starts(Wartungsplan.read_calendar(path)),
+                                 expected, name)
+                self.assertEqual(self.starts(Wartungsplan.read_calendar(
+                    path, config, self.window)), expected, name)
+                self.assertEqual(self.starts(Wartungsplan.parse_calendar(
+                    compress(self.ics))), expected, name)
+
+            diff = Wartungsplan.CalendarDiff.from_files(
+                os.path.join(tmp, "plan.ics.gz"), os.path.join(tmp, "plan.ics.xz"))
+            self.assertEqual(list(diff.changes()), [])
+
+    def test_text_mode(self):
+        """ Text modes read and write utf-8, compressed or not """
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("plan.ics", "plan.ics.gz", "plan.ics.xz"):
+                path = os.path.join(tmp, name)
+                with Wartungsplan.open_calendar(path, 'w') as calendar:
+                    calendar.write("SUMMARY:Säule prüfen\r\n")
+                with Wartungsplan.open_calendar(path, 'r') as calendar:
+                    self.assertEqual(calendar.read(), "SUMMARY:Säule prüfen\n",
+                                     name)
+                with Wartungsplan.open_calendar(path) as calendar:
+                    self.assertIn("Säule".encode('utf-8'), calendar.read(), name)
+
+    def test_write(self):
+        """ Calendars are compressed when written with extension .gz or .xz """
+        with tempfile.TemporaryDirectory() as tmp:
+            calendar_file = os.path.join(tmp, "plan.ics.gz")
+            for journal in (False, True):
+                addEventToIcal.add_event(calendar_file, '2023-09-25', '',
+                                         'FREQ=DAILY', '11:00', '', '0:20',
+                                         'Test1', 'Here we go again',
+                                         journal=journal)
+            Wartungsplan.CalendarJournal(calendar_file).compact()
+            with gzip.open(calendar_file) as compressed:
+                cal = icalendar.Calendar.from_ical(compressed.read())
+            self.assertEqual(len(cal.walk("VEVENT")), 2)
+            self.assertEqual(len(addEventToIcal.load_existing_calendar(
+                calendar_file).walk("VEVENT")), 2)
+
+            for name in ("exchange.ics.xz", "exchange.wpcal.gz"):
+                outfile = os.path.join(tmp, name)
+                downloadExchange.download({'user':'', 'password': '',
+                                           'outfile': outfile},
+                                          '2024-01-01', '', dry_run=True)
+                with open(outfile, 'rb') as compressed:
+                    self.assertIn(compressed.read(2), (b"\xfd7", b"\x1f\x8b"))
+                self.assertEqual(len(Wartungsplan.read_calendar(outfile)
+                                     .walk("VEVENT")), 3)
+
+
 class TestDownloadExchange(unittest.TestCase):
     """ Test tool to download a date range from exchange calendar """
 
     def test_run(self):
         """ Test downloadExchange test capability """
-        downloadExchange.download({'user':'', 'password': ''}, '2024-01-01', '', dry_run=True)
-        downloadExchange.download({'user':'', 'password': ''}, '2225-01-01', '', dry_run=True)
-        downloadExchange.download({'user':'', 'password': ''}, '', '', dry_run=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {'user':'', 'password': '',
+                      'outfile': os.path.join(tmp, "calendar_events.ics")}
+            downloadExchange.download(config, '2024-01-01', '', dry_run=True)
+            downloadExchange.download(config, '2225-01-01', '', dry_run=True)
+            downloadExchange.download(config, '', '', dry_run=True)
+
+    def test_iter_events(self):
+        """ Events are yielded without writing a file """
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, "out.ics")
+            events = downloadExchange.iter_events({'user':'', 'password': '',
+                                                   'outfile': outfile},
+                                                  '2024-01-01', '', dry_run=True)
+            self.assertEqual([str(event["SUMMARY"]) for event in events],
+                             ["foo1", "foo2", "bar1"])
+            self.assertFalse(os.path.exists(outfile))
+
+    def test_write_ics(self):
+        """ The file is written while the events pass and only replaced when
+            all passed """
+        with tempfile.TemporaryDirectory() as tmp:
+            outfile = os.path.join(tmp, "out.ics")
+            events = downloadExchange.iter_events({'user':'', 'password': ''},
+                                                  '2024-01-01', '', dry_run=True)
+            written = downloadExchange.write_ics(events, outfile)
+            next(written)
+            self.assertFalse(os.path.exists(outfile))
+            self.assertEqual(len(list(written)), 2)
+            with open(outfile, 'rb') as ics:
+                cal = icalendar.Calendar.from_ical(ics.read())
+            self.assertEqual(len(cal.walk("VEVENT")), 3)
+
+            # an aborted download leaves the last file alone
+            written = downloadExchange.write_ics(iter([]), outfile + "2")
+            written.close()
+            self.assertEqual(os.listdir(tmp), ["out.ics"])
+
+    def test_pipeline(self):
+        """ Wartungsplan takes the events from exchange without a calendar
+            file """
+        config = configparser.ConfigParser()
+        config.read_dict({"calendar": {"exchange": "yes"},
+                          "exchange": {"user": "", "password": ""}})
+        args = mock.Mock(ics_calendar=None, previous=None, digest=False,
+                         digest_by=None, max_runtime=None, memory_budget=None,
+                         start_date="2024-01-01", end_date=None,
+                         dry_run=False, format="jsonl", period="week",
+                         group_by=None, spool=False, jobs=1)
+        iter_events = downloadExchange.iter_events
+        def dummy(config, start_date, end_date, dry_run=False, folders=None):
+            return iter_events(config, start_date, end_date, dry_run=True)
+        with mock.patch("downloadExchange.iter_events", dummy), \
+             mock.patch.object(sys, "stdout", io.StringIO()) as out:
+            Wartungsplan.run_profile(config, args, "list")
+        summaries = [json.loads(line)["summary"]
+                     for line in out.getvalue().splitlines()]
+        self.assertEqual(summaries, ["foo1", "foo2", "bar1"])
+
+    def test_sources(self):
+        """ [exchange:NAME] sections take the options they don't set from
+            [exchange], except the outfile """
+        config = configparser.ConfigParser()
+        config.read_dict({"exchange": {"user": "u", "password": "p",
+                                       "email": "a@example.com",
+                                       "outfile": "all.ics"}})
+        options, source_list = downloadExchange.sources(config)
+        self.assertEqual(options["outfile"], "all.ics")
+        self.assertEqual([name for name, _ in source_list], ["exchange"])
+
+        config.read_dict({"exchange:team": {"calendar": "Team"},
+                          "exchange:lab": {"email": "lab@example.com",
+                                           "outfile": "lab.ics"}})
+        _, source_list = downloadExchange.sources(config)
+        sources = dict(source_list)
+        self.assertEqual(list(sources), ["team", "lab"])
+        self.assertEqual(sources["team"]["email"], "a@example.com")
+        self.assertEqual(sources["team"]["calendar"], "Team")
+        self.assertNotIn("outfile", sources["team"])
+        self.assertEqual(sources["lab"]["user"], "u")
+        self.assertEqual(sources["lab"]["outfile"], "lab.ics")
+
+    def test_concurrent(self):
+        """ Mailboxes are downloaded at the same time and written to their
+            own or a merged file """
+        iter_events = downloadExchange.iter_events
+        def slow(config, start_date, end_date, dry_run=False, folders=None):
+            time.sleep(0.3)
+            for event in iter_events(config, start_date, end_date, dry_run):
+                event["SUMMARY"] = config["email"] + " " + event["SUMMARY"]
+                yield event
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config = configparser.ConfigParser()
+            config.read_dict({
+                "exchange": {"user": "", "password": "",
+                             "outfile": os.path.join(tmp, "all.ics")},
+                "exchange:a": {"email": "a"},
+                "exchange:b": {"email": "b",
+                               "outfile": os.path.join(tmp, "b.ics")},
+                "exchange:c": {"email": "c"}})
+            with mock.patch.object(downloadExchange, "iter_events", slow):
+                started = time.monotonic()
+                downloadExchange.download(config, "2024-01-01", dry_run=True)
+                self.assertLess(time.monotonic() - started, 0.6)
+
+            summaries = {}
+            for name in ("all.ics", "b.ics"):
+                with open(os.path.join(tmp, name), 'rb') as ics:
+                    cal = icalendar.Calendar.from_ical(ics.read())
+                summaries[name] = [str(event["SUMMARY"])
+                                   for event in cal.walk("VEVENT")]
+            self.assertEqual(summaries["all.ics"],
+                             ["a foo1", "a foo2", "a bar1",
+                              "c foo1", "c foo2", "c bar1"])
+            self.assertEqual(summaries["b.ics"], ["b foo1", "b foo2", "b bar1"])
+
+    def test_folder_cache(self):
+        """ The calendar folder is walked once, then its ID is taken from
+            the cache until the folder is gone """
+        item = exchangelib.CalendarItem(
+            subject="foo", start=exchangelib.EWSDateTime(2024, 1, 1,
+                tzinfo=exchangelib.EWSTimeZone("UTC")),
+            end=exchangelib.EWSDateTime(2024, 1, 2,
+                tzinfo=exchangelib.EWSTimeZone("UTC")))
+        folder = mock.Mock(id="id1", changekey="ck1")
+        folder.__str__ = mock.Mock(return_value="Team")
+        folder.view.return_value = [item]
+        account = mock.Mock(default_timezone=exchangelib.EWSTimeZone("UTC"))
+        account.calendar.children = [folder]
+        cached = mock.Mock()
+        cached.view.return_value = [item]
+        config = {"user": "u", "password": "p", "email": "a@example.com",
+                  "calendar": "Team"}
+
+        with tempfile.TemporaryDirectory() as tmp, \
+             mock.patch("exchangelib.Account", return_value=account), \
+             mock.patch("exchangelib.FolderCollection",
+                        return_value=cached) as collection:
+            config["folder_cache"] = os.path.join(tmp, "folders.json")
+            def download():
+                return [str(event["SUMMARY"]) for event in
+                        downloadExchange.stream_events(config, "2024-01-01")]
+
+            self.assertEqual(download(), ["foo"])
+            self.assertEqual(folder.view.call_count, 1)
+            with open(config["folder_cache"], encoding='utf-8') as cache:
+                self.assertEqual(list(json.load(cache).values()),
+                                 [["id1", "ck1"]])
+
+            account.calendar.children = []
+            self.assertEqual(download(), ["foo"])
+            self.assertEqual(folder.view.call_count, 1)
+            self.assertEqual(collection.call_args.kwargs["folders"][0].id, "id1")
+
+            # the folder was recreated
+            cached.view.side_effect = exchangelib.errors.ErrorFolderNotFound("")
+            folder.id = "id2"
+            account.calendar.children = [folder]
+            self.assertEqual(download(), ["foo"])
+            with open(config["folder_cache"], encoding='utf-8') as cache:
+                self.assertEqual(list(json.load(cache).values()),
+                                 [["id2", "ck1"]])
+
+        # without folder_cache next to the downloaded calendars
+        with tempfile.TemporaryDirectory() as tmp, \
+             mock.patch.dict(os.environ, {"CACHE_DIRECTORY": tmp}):
+            self.assertEqual(downloadExchange.folder_cache_file({}),
+                             os.path.join(tmp, "exchange-folders.json"))
 
 
 if __name__ == '__main__':
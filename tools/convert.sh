@@ -52,7 +52,7 @@ function addEvent(){
 
   s=${startTime[${wp[0]}]}
   #echo LOG: cat \"$DIR/$filename\" \| addEventToIcal --start-date $startDate --rrule \"$rr\" --start-time $s --duration $duration --title \"$@\" \"$calendar-$out.ics\"
-  cat "$DIR/$filename" | addEventToIcal --start-date $startDate --rrule "$rr" --start-time $s --duration $duration --title "$t" "$calendar-$out.ics"
+  cat "$DIR/$filename" | addEventToIcal --start-date $startDate --rrule "$rr" --start-time $s --duration $duration --title "$t" --journal "$calendar-$out.ics"
 }
 
 
@@ -84,6 +84,12 @@ do
 done < <(ls $DIR)
 
 
+# fold the journals into the calendars
+for c in $calendar-*.ics
+do
+  addEventToIcal --compact "$c"
+done
+
 echo "------------------"
 echo "Created $n_events events"
 echo "Total events in all $calendar-\*.ics files:"